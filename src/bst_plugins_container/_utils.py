@@ -0,0 +1,239 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers shared by the docker source and the docker_image element.
+
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import stat
+import uuid
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_SIZE = re.compile(r"^\s*(\d+)\s*([KMGT]?)B?\s*$", re.IGNORECASE)
+
+
+# locked():
+#
+# Hold a lock on the file at 'path', creating it if needed. The lock is held
+# by the open file, so it is released if the process dies. Lock files are
+# left behind, as removing them could let two processes lock different files
+# for the same path.
+#
+# Args:
+#    path (str): Path to the lock file
+#    operation (int): fcntl.LOCK_EX or fcntl.LOCK_SH, optionally combined
+#                     with fcntl.LOCK_NB
+#
+# Raises:
+#    BlockingIOError, if the lock is busy and LOCK_NB was given
+#
+@contextlib.contextmanager
+def locked(path, operation=fcntl.LOCK_EX):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# remove_tree():
+#
+# Remove a directory tree, including read-only directories extracted from
+# layers.
+#
+def remove_tree(path):
+    def make_writable(function, failed_path, _):
+        parent = os.path.dirname(failed_path)
+        os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+        function(failed_path)
+
+    shutil.rmtree(path, onerror=make_writable)
+
+
+# process_exists():
+#
+# Args:
+#    pid (int): A process ID
+#
+# Returns:
+#    (bool): Whether a process with this ID is running
+#
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# parse_size():
+#
+# Args:
+#    text (str): A size in bytes, optionally suffixed with K, M, G or T
+#
+# Returns:
+#    (int): The size in bytes
+#
+# Raises:
+#    ValueError, if 'text' is not a valid size
+#
+def parse_size(text):
+    match = _SIZE.match(str(text))
+    if not match:
+        raise ValueError("Invalid size: {}".format(text))
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]
+
+
+# LRUCache
+#
+# Base class of the caches of the docker source and the docker_image element,
+# which are shared by every process of the build host. Each entry is a
+# directory holding an entry.json file, whose modification time records when
+# the entry was last used.
+#
+# Entries are used under a shared lock on _lock_path(), and only evicted under
+# an exclusive one, so that several processes can use the cache while it is
+# being trimmed. Entries are prepared in a directory from _temp_path() and
+# renamed into place, so that incomplete entries are never used.
+#
+# Subclasses implement _entry_path(), _list_keys() and _entry_size().
+#
+# Args:
+#    directory (str): Directory of the cache
+#    max_size (int): Maximum size of the entries, in bytes
+#
+class LRUCache:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    # evict():
+    #
+    # Remove the least recently used entries until the cache fits in its
+    # maximum size. Entries in use by any process are kept.
+    #
+    # Returns:
+    #    (int): The number of removed entries
+    #
+    def evict(self):
+        entries = []
+        total_size = 0
+        for key in self._list_keys():
+            entry_file = os.path.join(self._entry_path(key), "entry.json")
+            try:
+                entry_stat = os.stat(entry_file)
+                with open(entry_file) as f:
+                    size = self._entry_size(key, json.load(f))
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((entry_stat.st_mtime_ns, key, size))
+            total_size += size
+
+        removed = 0
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                with locked(
+                    self._lock_path(key), fcntl.LOCK_EX | fcntl.LOCK_NB
+                ):
+                    temp_path = self._temp_path()
+                    os.rename(self._entry_path(key), temp_path)
+            except BlockingIOError:
+                continue
+            except FileNotFoundError:
+                # Evicted by another process
+                total_size -= size
+                continue
+            remove_tree(temp_path)
+            total_size -= size
+            removed += 1
+
+        self._remove_stale_temp_dirs()
+        return removed
+
+    # _entry_path():
+    #
+    # Args:
+    #    key (str): Key of an entry
+    #
+    # Returns:
+    #    (str): Path to the directory of the entry
+    #
+    def _entry_path(self, key):
+        raise NotImplementedError()
+
+    # _list_keys():
+    #
+    # Returns:
+    #    (iterable): The keys of the entries in the cache
+    #
+    def _list_keys(self):
+        raise NotImplementedError()
+
+    # _entry_size():
+    #
+    # Args:
+    #    key (str): Key of an entry
+    #    entry (dict): The content of its entry.json file
+    #
+    # Returns:
+    #    (int): The disk space used by the entry
+    #
+    def _entry_size(self, key, entry):
+        raise NotImplementedError()
+
+    def _lock_path(self, key):
+        return os.path.join(self.directory, "locks", key + ".lock")
+
+    # Path to a new temporary directory, on the same filesystem as the
+    # entries. It is named after the process, so that it can be removed by a
+    # later eviction if the process dies.
+    def _temp_path(self):
+        temp_dir = os.path.join(self.directory, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(
+            temp_dir, "{}-{}".format(os.getpid(), uuid.uuid4().hex)
+        )
+
+    # Remove what is left by processes which are not running anymore.
+    # Anything else is left alone.
+    def _remove_stale_temp_dirs(self):
+        temp_dir = os.path.join(self.directory, "tmp")
+        try:
+            names = os.listdir(temp_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            try:
+                pid = int(name.split("-", 1)[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not process_exists(pid):
+                try:
+                    remove_tree(os.path.join(temp_dir, name))
+                except FileNotFoundError:
+                    # Removed by another process
+                    pass
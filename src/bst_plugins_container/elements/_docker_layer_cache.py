@@ -0,0 +1,141 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of the layer tarballs created by docker_image elements
+
+Layers are looked up by a key which the element derives from the artifacts
+staged in them, so that a layer is only exported and hashed once, whichever
+element and build needs it:
+
+  <directory>/entries/<key>/layer.tar*  The layer tarball, compressed or not
+  <directory>/entries/<key>/entry.json  The name and digests of the tarball
+
+Several builds can use the cache while it is being trimmed, see LRUCache.
+Eviction removes the least recently used entries first.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+
+from bst_plugins_container._utils import LRUCache, locked
+
+
+class LayerTarCache(LRUCache):
+    """A cache of layer tarballs
+
+    :param directory: directory of the cache
+    :param max_size: maximum size of the layers in the cache, in bytes
+    """
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, "entries", key)
+
+    @contextlib.contextmanager
+    def use(self, key):
+        """use a layer from the cache
+
+        The entry will not be evicted until the context is left.
+
+        :param key: key of the layer
+        :return: yields the digest and diff_id of the layer and the path to
+          its tarball, or None if the layer is not in the cache
+        """
+        entry_path = self._entry_path(key)
+        with locked(self._lock_path(key), fcntl.LOCK_SH):
+            entry_file = os.path.join(entry_path, "entry.json")
+            try:
+                with open(entry_file) as f:
+                    entry = json.load(f)
+            except FileNotFoundError:
+                entry = None
+
+            if entry is not None:
+                # Mark the entry as recently used
+                os.utime(entry_file)
+                yield (
+                    (entry["digest"], entry["diff_id"]),
+                    os.path.join(entry_path, entry["file"]),
+                )
+                return
+
+        yield None
+
+    def add(self, key, tar_name, layer):
+        """move a layer tarball into the cache, unless it already has it
+
+        :param key: key of the layer
+        :param tar_name: path to the tarball, in a directory created by
+          tempdir()
+        :param layer: sha256 hex digests of the tarball and of its
+          uncompressed content (a.k.a. diff_id)
+        """
+        with locked(self._lock_path(key), fcntl.LOCK_EX):
+            entry_path = self._entry_path(key)
+            if os.path.exists(entry_path):
+                return
+
+            # Prepare the entry somewhere else first, so that incomplete
+            # entries are never used
+            temp_path = self._temp_path()
+            os.makedirs(temp_path)
+            try:
+                file_name = os.path.basename(tar_name)
+                os.rename(tar_name, os.path.join(temp_path, file_name))
+                digest, diff_id = layer
+                with open(os.path.join(temp_path, "entry.json"), "w") as f:
+                    json.dump(
+                        {
+                            "digest": digest,
+                            "diff_id": diff_id,
+                            "file": file_name,
+                        },
+                        f,
+                    )
+
+                os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+                os.rename(temp_path, entry_path)
+            except BaseException:
+                shutil.rmtree(temp_path, ignore_errors=True)
+                raise
+
+    @contextlib.contextmanager
+    def tempdir(self):
+        """create a temporary directory to create layers in
+
+        It is on the same filesystem as the cache, so that layers created in
+        it can be moved into the cache.
+
+        :return: yields the path to the directory
+        """
+        path = self._temp_path()
+        os.makedirs(path)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _list_keys(self):
+        try:
+            return os.listdir(os.path.join(self.directory, "entries"))
+        except FileNotFoundError:
+            return []
+
+    def _entry_size(self, key, entry):
+        return os.path.getsize(
+            os.path.join(self._entry_path(key), entry["file"])
+        )
@@ -0,0 +1,301 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers to write the tarballs of the docker_image element"""
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import shutil
+import tarfile
+import zlib
+
+from buildstream.utils import BST_ARBITRARY_TIMESTAMP
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class HashingWriter:
+    """Write-only file object which hashes what is written through it
+
+    This lets tarballs be hashed as they are produced, rather than read back
+    once they have been written.
+
+    :param fileobj: file object to write to
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._fileobj.write(data)
+
+    def tell(self):
+        """return the number of bytes written so far
+
+        `tarfile` asks for the position when it starts writing.
+        """
+        return self.size
+
+    def hexdigest(self):
+        """return the sha256 hex digest of what has been written so far"""
+        return self._hash.hexdigest()
+
+
+class _StreamedMember(HashingWriter):
+    # The name of the member, which must be set before it is closed
+    name = None
+
+
+class TarStreamWriter:
+    """Write a tarball one member at a time
+
+    Unlike `tarfile`, the content of a member can be streamed into the
+    tarball before its name and size are known, so that members named after
+    their own digest can be written without keeping a copy of them anywhere
+    else. This needs `fileobj` to be seekable.
+
+    :param fileobj: file object to write the tarball to
+    :param mtime: modification time of the members
+    """
+
+    def __init__(self, fileobj, mtime=BST_ARBITRARY_TIMESTAMP):
+        self._fileobj = fileobj
+        self._mtime = mtime
+
+    def add_directory(self, name):
+        """add a directory
+
+        :param name: name of the directory
+        """
+        self._fileobj.write(self._header(name, tarfile.DIRTYPE, 0))
+
+    def add_file(self, name, data):
+        """add a regular file
+
+        :param name: name of the file
+        :param data: content of the file, as bytes
+        """
+        self._fileobj.write(self._header(name, tarfile.REGTYPE, len(data)))
+        self._fileobj.write(data)
+        self._pad(len(data))
+
+    @contextlib.contextmanager
+    def add_stream(self):
+        """add a regular file, streaming its content
+
+        Yields a writable file object which hashes what is written to it. Its
+        `name` attribute must be set before the context is left.
+        """
+        # Leave room for the header, which is written once the name and size
+        # of the member are known
+        header_offset = self._fileobj.tell()
+        self._fileobj.write(tarfile.NUL * tarfile.BLOCKSIZE)
+
+        member = _StreamedMember(self._fileobj)
+        yield member
+
+        header = self._header(member.name, tarfile.REGTYPE, member.size)
+        if len(header) != tarfile.BLOCKSIZE:
+            raise ValueError("Member name too long: {}".format(member.name))
+        end_offset = self._fileobj.tell()
+        self._fileobj.seek(header_offset)
+        self._fileobj.write(header)
+        self._fileobj.seek(end_offset)
+        self._pad(member.size)
+
+    def add_path(self, name, path):
+        """add a regular file, copying its content from a file on disk
+
+        :param name: name of the file
+        :param path: path of the file to copy
+        """
+        size = os.path.getsize(path)
+        self._fileobj.write(self._header(name, tarfile.REGTYPE, size))
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self._fileobj)
+        self._pad(size)
+
+    def close(self):
+        """write the end of archive marker, as `tarfile` does"""
+        self._fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        remainder = self._fileobj.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self._fileobj.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+    def _header(self, name, member_type, size):
+        info = tarfile.TarInfo(name)
+        info.type = member_type
+        info.size = size
+        info.mtime = self._mtime
+        info.mode = 0o755 if member_type == tarfile.DIRTYPE else 0o644
+        # The GNU format stores sizes of more than 8 GiB in the same header
+        return info.tobuf(tarfile.GNU_FORMAT)
+
+    def _pad(self, size):
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self._fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+
+class LayerCompression:
+    """How layers are compressed
+
+    Layers are compressed in independent blocks, which are concatenated as
+    several gzip members or zstd frames, so that blocks can be compressed in
+    parallel. The output is the same whatever the number of threads.
+
+    :param algorithm: one of ALGORITHMS
+    :param level: compression level, or None for the algorithm's default
+    :param threads: number of blocks to compress at the same time
+    """
+
+    ALGORITHMS = ["none", "gzip", "zstd"]
+
+    # Valid and default levels of each algorithm
+    LEVELS = {"gzip": (range(0, 10), 6), "zstd": (range(1, 23), 3)}
+
+    # Extension of the layer tarballs compressed with each algorithm
+    _EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, algorithm="none", level=None, threads=1):
+        self.algorithm = algorithm
+        if level is None and algorithm in self.LEVELS:
+            _, level = self.LEVELS[algorithm]
+        self.level = level
+        self.threads = threads
+
+    @property
+    def file_name(self):
+        """name of the layer tarballs"""
+        return "layer.tar" + self._EXTENSIONS[self.algorithm]
+
+    def compress_block(self, block):
+        """return a block compressed into a gzip member or zstd frame of its own
+
+        :param block: data to compress, as bytes
+        """
+        if self.algorithm == "gzip":
+            # A window size of 31 makes zlib write a gzip header, with no
+            # file name or timestamp
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+        return zstandard.ZstdCompressor(level=self.level).compress(block)
+
+
+class CompressingWriter:
+    """Write-only file object which compresses what is written through it
+
+    What is written is hashed before it is compressed, and compressed in
+    blocks of BLOCK_SIZE on a pool of threads. Compressed blocks are written
+    to `fileobj` in order, the last ones only when the writer is closed.
+
+    :param fileobj: file object to write the compressed data to
+    :param compression: LayerCompression to use
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, fileobj, compression):
+        self._fileobj = fileobj
+        self._compression = compression
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = None
+        if compression.threads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=compression.threads
+            )
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.BLOCK_SIZE:
+            self._compress(bytes(self._buffer[: self.BLOCK_SIZE]))
+            del self._buffer[: self.BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        """return the number of bytes written so far, before compression"""
+        return self.size
+
+    def hexdigest(self):
+        """return the sha256 hex digest of what has been written so far, before compression"""
+        return self._hash.hexdigest()
+
+    def close(self):
+        """compress and write what is left"""
+        if self._buffer:
+            self._compress(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._fileobj.write(self._pending.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _compress(self, block):
+        if self._executor is None:
+            self._fileobj.write(self._compression.compress_block(block))
+            return
+
+        self._pending.append(
+            self._executor.submit(self._compression.compress_block, block)
+        )
+        # Keep every thread busy, without holding on to the whole layer
+        while len(self._pending) > self._compression.threads * 2:
+            self._fileobj.write(self._pending.popleft().result())
+
+
+def export_layer(directory, output, compression):
+    """export a directory as a layer tarball
+
+    :param directory: Directory to export
+    :param output: HashingWriter to write the layer to
+    :param compression: LayerCompression to use
+    :return: the sha256 hex digests of the layer, and of the uncompressed
+      tarball (a.k.a. diff_id), which are the same for uncompressed layers
+    """
+    if compression.algorithm == "none":
+        with tarfile.open(fileobj=output, mode="w") as tarobj:
+            directory.export_to_tar(tarobj, "")
+        return output.hexdigest(), output.hexdigest()
+
+    with CompressingWriter(output, compression) as writer:
+        with tarfile.open(fileobj=writer, mode="w") as tarobj:
+            directory.export_to_tar(tarobj, "")
+    return output.hexdigest(), writer.hexdigest()
@@ -35,17 +35,32 @@ The default configuration is as such:
      :language: yaml
 """
 
+import concurrent.futures
+import contextlib
 from datetime import datetime, date
 import hashlib
 import json
 import os
+import platform
 import re
 import tarfile
 import tempfile
 
+import buildstream
 from buildstream import Element, ElementError
 from buildstream.utils import BST_ARBITRARY_TIMESTAMP
 
+from bst_plugins_container._utils import parse_size
+from bst_plugins_container.elements._docker_layer_cache import LayerTarCache
+from bst_plugins_container.elements._docker_tar import (
+    CompressingWriter,
+    HashingWriter,
+    LayerCompression,
+    TarStreamWriter,
+    export_layer,
+    zstandard,
+)
+
 
 class DockerElement(Element):
     # pylint: disable=too-many-instance-attributes
@@ -75,6 +90,13 @@ class DockerElement(Element):
                 "health-check",
                 "image-names",
                 "timestamp",
+                "assembly",
+                "max-parallel-layers",
+                "layer-cache",
+                "layer-cache-size",
+                "compression",
+                "compression-level",
+                "compression-threads",
             ]
         )
 
@@ -91,6 +113,32 @@ class DockerElement(Element):
         self._volumes = node.get_sequence("volumes").as_str_list()
         self._working_dir = node.get_str("working-dir")
         self._timestamp = node.get_str("timestamp")
+        self._assembly = node.get_str("assembly")
+        self._max_parallel_layers = node.get_int("max-parallel-layers")
+
+        layer_cache = node.get_str("layer-cache", None)
+        if layer_cache:
+            layer_cache_size = node.get_scalar("layer-cache-size")
+            try:
+                max_size = parse_size(layer_cache_size.as_str())
+            except ValueError as e:
+                raise ElementError(
+                    "{}: Invalid layer-cache-size".format(
+                        layer_cache_size.get_provenance()
+                    )
+                ) from e
+            self._layer_cache = LayerTarCache(
+                os.path.expanduser(layer_cache), max_size
+            )
+        else:
+            self._layer_cache = None
+
+        self._compression = LayerCompression(
+            node.get_str("compression"),
+            node.get_int("compression-level", None),
+            node.get_int("compression-threads"),
+        )
+
         self._health_check = {
             "Tests": health_check_node.get_sequence(
                 "tests", default=["NONE"]
@@ -202,8 +250,56 @@ class DockerElement(Element):
                     reason="docker-wrong-timestamp-format",
                 ) from e
 
+        assembly_options = ["staged", "streamed"]
+        if self._assembly not in assembly_options:
+            raise ElementError(
+                "{}: Invalid assembly {}. Options include: {}".format(
+                    self, self._assembly, assembly_options
+                ),
+                reason="docker-invalid-assembly",
+            )
+
+        if self._max_parallel_layers < 1:
+            raise ElementError(
+                "{}: max-parallel-layers must be at least 1".format(self),
+                reason="docker-invalid-max-parallel-layers",
+            )
+
+        self._check_compression()
+
+    def _check_compression(self):
+        """check that layers can be compressed as configured"""
+        compression = self._compression
+        if compression.algorithm not in compression.ALGORITHMS:
+            raise ElementError(
+                "{}: Invalid compression {}. Options include: {}".format(
+                    self, compression.algorithm, compression.ALGORITHMS
+                ),
+                reason="docker-invalid-compression",
+            )
+        if compression.algorithm in compression.LEVELS:
+            levels, _ = compression.LEVELS[compression.algorithm]
+            if compression.level not in levels:
+                raise ElementError(
+                    "{}: {} compression level must be between {} and {}".format(
+                        self, compression.algorithm, levels[0], levels[-1]
+                    ),
+                    reason="docker-invalid-compression-level",
+                )
+        if compression.algorithm == "zstd" and zstandard is None:
+            raise ElementError(
+                "{}: zstd compression requires the 'zstandard' Python "
+                "package".format(self),
+                reason="docker-missing-zstandard",
+            )
+        if compression.threads < 1:
+            raise ElementError(
+                "{}: compression-threads must be at least 1".format(self),
+                reason="docker-invalid-compression-threads",
+            )
+
     def get_unique_key(self):
-        return {
+        key = {
             "exposed-ports": self._exposed_ports,
             "env": self._env,
             "entry-point": self._entry_point,
@@ -215,6 +311,15 @@ class DockerElement(Element):
             "image-spec-version": self.IMAGE_SPEC_VERSION,
             "layer-config-version": self.LAYER_CONFIG_VERSION,
         }
+        # The tarballs of both assemblies hold the same files, in a different
+        # order
+        if self._assembly != "staged":
+            key["assembly"] = self._assembly
+        # The number of threads does not change how layers are compressed
+        if self._compression.algorithm != "none":
+            key["compression"] = self._compression.algorithm
+            key["compression-level"] = self._compression.level
+        return key
 
     def configure_sandbox(self, sandbox):
         pass
@@ -226,19 +331,44 @@ class DockerElement(Element):
     def assemble(self, sandbox):
         basedir = sandbox.get_virtual_directory()
 
-        # where layers will be built
-        layer_dir = basedir.descend("layers", create=True)
         # where final image will be produced
         image_dir = basedir.descend("image", create=True)
 
-        # `layer_digests[0]` is the base layer, `layer_digest[n]` is the nth layer from the bottom
-        layer_digests = [
-            self._create_layer(layer_path, layer_dir)
-            for layer_path in self._layer_directories(sandbox)
-        ]
+        if self._assembly == "streamed":
+            self._assemble_streamed(sandbox, image_dir)
+        else:
+            self._assemble_staged(sandbox, basedir, image_dir)
+
+        return "/image"
+
+    def _assemble_staged(self, sandbox, basedir, image_dir):
+        """create every file of the image in a directory, and then pack it into image.tar
+
+        :param sandbox: sandbox of `docker_image` element
+        :param basedir: root directory of the sandbox
+        :param image_dir: directory to create image.tar in
+        """
+        # where layers will be built
+        layer_dir = basedir.descend("layers", create=True)
+
+        # `layers[0]` is the base layer, `layers[n]` is the nth layer from the bottom
+        if self._creates_layer_files:
+            with self._create_layer_files(sandbox) as layer_files:
+                layers = [
+                    self._import_layer(layer_dir, layer, tar_name)
+                    for layer, tar_name in layer_files
+                ]
+        else:
+            layers = [
+                self._create_layer(layer_path, layer_dir)
+                for layer_path in self._layer_directories(sandbox)
+            ]
+        layer_digests = [hash_digest for hash_digest, _ in layers]
 
         # create image level files
-        image_id = self._create_image_config(layer_dir, layer_digests)
+        image_id = self._create_image_config(
+            layer_dir, [diff_id for _, diff_id in layers]
+        )
         self._create_repositories_file(layer_dir, layer_digests[0])
         self._create_manifest(layer_dir, layer_digests, image_id)
 
@@ -248,7 +378,224 @@ class DockerElement(Element):
                 with tarfile.open(fileobj=f, mode="w") as tar_handle:
                     layer_dir.export_to_tar(tar_handle, "")
 
-        return "/image"
+    def _assemble_streamed(self, sandbox, image_dir):
+        """write the layers of the image straight into image.tar, followed by its configuration
+
+        Layers are hashed as they are written, so that no other copy of them
+        is ever made, unless they are created in parallel or the layer cache
+        is enabled.
+
+        :param sandbox: sandbox of `docker_image` element
+        :param image_dir: directory to create image.tar in
+        """
+        with image_dir.open_file("image.tar", mode="wb") as f:
+            image_tar = TarStreamWriter(f)
+
+            if self._creates_layer_files:
+                with self._create_layer_files(sandbox) as layer_files:
+                    layers = [
+                        self._add_layer_file(image_tar, layer, tar_name)
+                        for layer, tar_name in layer_files
+                    ]
+            else:
+                layers = [
+                    self._stream_layer(layer_path, image_tar)
+                    for layer_path in self._layer_directories(sandbox)
+                ]
+            layer_digests = [hash_digest for hash_digest, _ in layers]
+
+            image_config = self._image_config(
+                [diff_id for _, diff_id in layers]
+            )
+            image_id = hashlib.sha256(image_config).hexdigest()
+            image_tar.add_file("{}.json".format(image_id), image_config)
+            image_tar.add_file(
+                "manifest.json", self._manifest(layer_digests, image_id)
+            )
+            image_tar.add_file(
+                "repositories", self._repositories(layer_digests[0])
+            )
+            image_tar.close()
+
+    def _stream_layer(self, changeset_dir, image_tar):
+        """write the following members to image_tar for the layer specified in changeset_dir
+
+            ├── <hash_digest>
+                ├── VERSION
+                ├── json
+                └── layer.tar
+
+        :param changeset_dir: change-set for particular layer
+        :param image_tar: TarStreamWriter of the image
+        :return: hash_digest and diff_id of layer
+        """
+        with self.timed_activity(
+            "Create {} Layer".format(changeset_dir),
+            silent_nested=True,
+        ):
+            with image_tar.add_stream() as member:
+                layer = export_layer(changeset_dir, member, self._compression)
+                hash_digest, _ = layer
+                member.name = "{}/{}".format(
+                    hash_digest, self._compression.file_name
+                )
+
+            self._add_layer_metadata(image_tar, hash_digest)
+
+        return layer
+
+    def _add_layer_file(self, image_tar, layer, tar_name):
+        """add a layer which was already created to image_tar, as _stream_layer() does
+
+        :param image_tar: TarStreamWriter of the image
+        :param layer: hash_digest and diff_id of the layer
+        :param tar_name: path to the layer's tarball
+        :return: hash_digest and diff_id of layer
+        """
+        hash_digest, _ = layer
+        image_tar.add_path(
+            "{}/{}".format(hash_digest, self._compression.file_name), tar_name
+        )
+        self._add_layer_metadata(image_tar, hash_digest)
+        return layer
+
+    def _add_layer_metadata(self, image_tar, hash_digest):
+        """add the VERSION and json files of a layer to image_tar
+
+        :param image_tar: TarStreamWriter of the image
+        :param hash_digest: digest of the layer
+        """
+        image_tar.add_file(
+            "{}/VERSION".format(hash_digest),
+            self.LAYER_CONFIG_VERSION.encode(),
+        )
+        image_tar.add_file(
+            "{}/json".format(hash_digest), self._layer_json(hash_digest)
+        )
+        image_tar.add_directory(hash_digest)
+
+    @property
+    def _creates_layer_files(self):
+        """whether layers are created by _create_layer_files()"""
+        return self._max_parallel_layers > 1 or self._layer_cache is not None
+
+    @contextlib.contextmanager
+    def _create_layer_files(self, sandbox):
+        """create the tarballs of all layers, or find them in the layer cache
+
+        Layers are created on a pool of 'max-parallel-layers' threads. They
+        are moved into the layer cache if it is enabled, or otherwise left
+        in temporary files which are removed when the context is left.
+
+        :param sandbox: sandbox of `docker_image` element
+        :return: list of the hash_digest and diff_id, and path of each
+          layer's tarball, from the bottom-most to the top-most layer
+        """
+        layer_paths = list(self._layer_directories(sandbox))
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(
+                self.timed_activity(
+                    "Create {} Layers".format(len(layer_paths)),
+                    silent_nested=True,
+                )
+            )
+            if self._layer_cache is None:
+                tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+                yield self._write_layer_files(layer_paths, tmpdir)
+                return
+
+            layer_keys = self._layer_keys()
+            layer_files = [
+                stack.enter_context(self._layer_cache.use(layer_key))
+                for layer_key in layer_keys
+            ]
+            missing = [
+                index
+                for index, layer_file in enumerate(layer_files)
+                if layer_file is None
+            ]
+            self.info(
+                "Found {} of {} layers in the layer cache".format(
+                    len(layer_files) - len(missing), len(layer_files)
+                )
+            )
+            with self._layer_cache.tempdir() as tmpdir:
+                created = self._write_layer_files(
+                    [layer_paths[index] for index in missing], tmpdir
+                )
+                for index, (layer, tar_name) in zip(missing, created):
+                    self._layer_cache.add(layer_keys[index], tar_name, layer)
+                    # Layers which were just added are the most recently
+                    # used, and so the last ones to be evicted
+                    layer_files[index] = stack.enter_context(
+                        self._layer_cache.use(layer_keys[index])
+                    )
+            yield layer_files
+
+        removed = self._layer_cache.evict()
+        if removed:
+            self.info("Removed {} layers from the layer cache".format(removed))
+
+    def _write_layer_files(self, layer_paths, tmpdir):
+        """create the tarballs of layers on a pool of 'max-parallel-layers' threads
+
+        :param layer_paths: list of Directory objects of the layers
+        :param tmpdir: directory to create the tarballs in
+        :return: list of the hash_digest and diff_id, and path of each
+          layer's tarball
+        """
+        tar_names = []
+        for index in range(len(layer_paths)):
+            os.mkdir(os.path.join(tmpdir, str(index)))
+            tar_names.append(
+                os.path.join(tmpdir, str(index), self._compression.file_name)
+            )
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_parallel_layers
+        ) as executor:
+            layers = list(
+                executor.map(self._write_layer_file, layer_paths, tar_names)
+            )
+        return list(zip(layers, tar_names))
+
+    def _layer_keys(self):
+        """return the key of each layer in the layer cache
+
+        The content of a layer only depends on the artifacts staged in it,
+        and on how they are packed.
+
+        :return: list of keys, from the bottom-most to the top-most layer
+        """
+        return [
+            hashlib.sha256(
+                _dump_json(
+                    {
+                        "artifacts": [
+                            element.get_artifact_name() for element in elements
+                        ],
+                        "layer-format": self._layer_format(),
+                    }
+                )
+            ).hexdigest()
+            for _, elements in self._layer_elements()
+        ]
+
+    def _layer_format(self):
+        """return the settings which change how layers are packed
+
+        Layers are written by BuildStream's `export_to_tar()` and Python's
+        `tarfile`, whose output may change between versions. Both versions
+        are part of the key, so that layers cached with one version are never
+        used by builds with another.
+        """
+        return {
+            "buildstream-version": buildstream.__version__,
+            "python-version": platform.python_version(),
+            "tar-format": tarfile.DEFAULT_FORMAT,
+            "compression": self._compression.algorithm,
+            "compression-level": self._compression.level,
+            "compression-block-size": CompressingWriter.BLOCK_SIZE,
+        }
 
     def _layer_directories(self, sandbox):
         """yield directories of staged layers
@@ -267,9 +614,7 @@ class DockerElement(Element):
         :param sandbox: sandbox of `docker_image` element
         :return: list of paths to where the layers have been staged
         """
-        # keep track of visited nodes
-        visited = set()
-        for dependency in self.dependencies(recurse=False):
+        for dependency, elements in self._layer_elements():
             # turn each immediate build dependency into a layer
             dep_name = dependency.normal_name
             with self.timed_activity(
@@ -277,24 +622,39 @@ class DockerElement(Element):
             ):
                 # create intermediate checkout directory for layer
                 relative_path = os.path.join("dependencies", dep_name)
-                self._stage_layer(sandbox, relative_path, dependency, visited)
+                for element in elements:
+                    # add each element's diff-set
+                    element.stage_artifact(sandbox, path=relative_path)
 
-    def _stage_layer(self, sandbox, layer_path, element, visited):
-        """stages all run-time dependencies of `element` in 'layer_path` according to a dfs traversal
+    def _layer_elements(self):
+        """list the elements to stage in the layer of each build dependency
+
+        :return: list of tuples of each immediate build dependency, and the
+          elements to stage in its layer in order
+        """
+        # keep track of visited nodes
+        visited = set()
+        layers = []
+        for dependency in self.dependencies(recurse=False):
+            elements = []
+            self._visit_layer_elements(dependency, visited, elements)
+            layers.append((dependency, elements))
+        return layers
+
+    def _visit_layer_elements(self, element, visited, elements):
+        """lists all run-time dependencies of `element` in `elements` according to a dfs traversal
 
-        :param sandbox: sandbox of `docker_image` element
-        :param layer_path: path to where stage artifact of element
         :param element: element attempting to be staged
         :param visited: elements that have already been staged
-        :return:
+        :param elements: list of elements to stage in the layer
         """
         if element not in visited:
             visited.add(element)
             # only interested in run time dependencies of immediate build dependencies
             for dependency in element.dependencies():
-                self._stage_layer(sandbox, layer_path, dependency, visited)
+                self._visit_layer_elements(dependency, visited, elements)
             # add current element's diff-set
-            element.stage_artifact(sandbox, path=layer_path)
+            elements.append(element)
 
     def _create_repositories_file(self, outputdir, top_layer_digest):
         """creates a repository file which contains all of the image's tags
@@ -302,13 +662,20 @@ class DockerElement(Element):
         :param outputdir: directory to place file
         :param top_layer_digest: top layer digest
         """
+        with outputdir.open_file("repositories", mode="wb") as f:
+            f.write(self._repositories(top_layer_digest))
+
+    def _repositories(self, top_layer_digest):
+        """return the content of the repository file
+
+        :param top_layer_digest: top layer digest
+        :return: the repository file, as bytes
+        """
         repositories = {
             name: "{}:{}".format(tag, top_layer_digest)
             for name, tag in self.names
         }
-
-        with outputdir.open_file("repositories", mode="w") as f:
-            json.dump(repositories, f, sort_keys=True)
+        return _dump_json(repositories)
 
     def _create_manifest(self, outputdir, layer_digests, config_digest):
         """creates the image manifest
@@ -317,12 +684,22 @@ class DockerElement(Element):
         :param layer_digests: list of layer digests
         :param config_digest: digest of image
         """
+        with outputdir.open_file("manifest.json", mode="wb") as f:
+            f.write(self._manifest(layer_digests, config_digest))
+
+    def _manifest(self, layer_digests, config_digest):
+        """return the content of the image manifest
+
+        :param layer_digests: list of layer digests
+        :param config_digest: digest of image
+        :return: the manifest, as bytes
+        """
         manifest = [
             {
                 "Config": "{}.json".format(config_digest),
                 # ordered bottom-most to top-most layer
                 "Layers": [
-                    "{}/layer.tar".format(layer_digest)
+                    "{}/{}".format(layer_digest, self._compression.file_name)
                     for layer_digest in layer_digests
                 ],
                 "RepoTags": [
@@ -330,18 +707,31 @@ class DockerElement(Element):
                 ],
             }
         ]
+        return _dump_json(manifest)
 
-        with outputdir.open_file("manifest.json", mode="w") as f:
-            json.dump(manifest, f, sort_keys=True)
-
-    def _create_image_config(self, outputdir, layer_digests):
+    def _create_image_config(self, outputdir, diff_ids):
         """creates image configuration file
 
         :param outputdir: directory to place
-        :param layer_digests:
+        :param diff_ids: list of digests of the uncompressed layers
         :return: the hex-digest of the hash of the config (a.k.a. image digest)
         """
+        image_config = self._image_config(diff_ids)
+        image_digest = hashlib.sha256(image_config).hexdigest()
 
+        # Import the json configuration into CAS with the expected name, based
+        # on the hash
+        with outputdir.open_file(f"{image_digest}.json", mode="wb") as f:
+            f.write(image_config)
+
+        return image_digest
+
+    def _image_config(self, diff_ids):
+        """return the content of the image configuration file
+
+        :param diff_ids: list of digests of the uncompressed layers
+        :return: the configuration, as bytes
+        """
         image_config = {
             "created": self._created,
             "author": self._author,
@@ -356,8 +746,7 @@ class DockerElement(Element):
             },
             "rootfs": {
                 "diff_ids": [
-                    "sha256:{}".format(layer_digest)
-                    for layer_digest in layer_digests
+                    "sha256:{}".format(diff_id) for diff_id in diff_ids
                 ],
                 "type": "layers",
             },
@@ -366,25 +755,12 @@ class DockerElement(Element):
                     "created": self._created,
                     "created_by": "BuildStream Docker Image Plugin",
                 }
-                for _ in layer_digests
+                for _ in diff_ids
             ],
         }
-
-        # Calculate hash of the json configuration using a temporary file
-        with tempfile.NamedTemporaryFile(mode="w") as f:
-            json.dump(image_config, f, sort_keys=True)
-            f.flush()
-            image_digest = self._hash_digest(f.name)
-
-        # Import the json configuration into CAS with the expected name, based
-        # on the hash
-        with outputdir.open_file(f"{image_digest}.json", mode="w") as f:
-            json.dump(image_config, f, sort_keys=True)
-
-        return image_digest
+        return _dump_json(image_config)
 
     def _create_layer(self, changeset_dir, layer_dir):
-        # pylint: disable=too-many-locals
         """creates the following file structure in layer_dir for the layer specified in chageset_dir
 
             ├── <hash_digest>
@@ -394,7 +770,7 @@ class DockerElement(Element):
 
         :param changeset_dir: change-set for particular layer
         :param layer_dir: directory where layer will be built
-        :return: hash_digest of layer
+        :return: hash_digest and diff_id of layer
         """
         with self.timed_activity(
             "Create {} Layer".format(changeset_dir),
@@ -402,68 +778,74 @@ class DockerElement(Element):
         ):
             # Create layer.tar
             with tempfile.TemporaryDirectory() as tmpdir:
-                # Export dependencies to a tarball on disk
-                tar_name = os.path.join(tmpdir, "layer.tar")
-                with tarfile.open(name=tar_name, mode="w") as tarobj:
-                    changeset_dir.export_to_tar(tarobj, "")
-
-                # Calculate checksum, and import into CAS with the correct
-                # directory structure
-                hash_digest = self._hash_digest(tar_name)
-                target_dir = layer_dir.descend(hash_digest, create=True)
-                target_dir.import_single_file(tar_name)
-
-            # Create VERSION file
-            with target_dir.open_file("VERSION", mode="w") as version_handle:
-                version_handle.write(self.LAYER_CONFIG_VERSION)
-
-            # Create json file
-            v1_json = {
-                "id": hash_digest,
-                "created": self._created,
-                "author": self._author,
-                "checksum": "tarsum.v1+sha256:{}".format(hash_digest),
-                "config": {
-                    "ExposedPorts": self._exposed_ports,
-                    "Env": self._env,
-                    "EntryPoint": self._entry_point,
-                    "Cmd": self._cmd,
-                    "Volumes": self._volumes,
-                    "WorkingDir": self._working_dir,
-                },
-            }
-            with target_dir.open_file("json", mode="w") as json_f:
-                json.dump(v1_json, json_f, sort_keys=True)
+                # Export dependencies to a tarball on disk, hashing it as it
+                # is written rather than reading it back
+                tar_name = os.path.join(tmpdir, self._compression.file_name)
+                layer = self._write_layer_file(changeset_dir, tar_name)
+                return self._import_layer(layer_dir, layer, tar_name)
 
-        return hash_digest
+    def _write_layer_file(self, changeset_dir, tar_name):
+        """export a layer to a tarball on disk
 
-    def _hash_digest(self, file):
-        """return hash digest of file
+        :param changeset_dir: change-set for particular layer
+        :param tar_name: path to the tarball to create
+        :return: hash_digest and diff_id of layer
+        """
+        with open(tar_name, "wb") as tar_handle:
+            return export_layer(
+                changeset_dir, HashingWriter(tar_handle), self._compression
+            )
 
-        :param file: name of file to calculate hash of
-        :param algorithm: hash algorithm that wants to be used
-        :return: hash digest of specified file
+    def _import_layer(self, layer_dir, layer, tar_name):
+        """import a layer's tarball into layer_dir, with its VERSION and json files
+
+        :param layer_dir: directory where layer will be built
+        :param layer: hash_digest and diff_id of the layer
+        :param tar_name: path to the layer's tarball, named after the
+          compression of layers
+        :return: hash_digest and diff_id of layer
         """
-        hash_algorithm = hashlib.sha256()
-        with open(file, "rb") as file_handle:
-            for block in self._read_file_block(file_handle):
-                hash_algorithm.update(block)
-        return hash_algorithm.hexdigest()
-
-    @staticmethod
-    def _read_file_block(file_handle, block_size=8192):
-        """yield chunk_size blocks of file
-
-        :param file_handle: handle to file
-        :param chunk_size: block size of file to be read
-        :return: block of file
+        hash_digest, _ = layer
+
+        # Import into CAS with the correct directory structure
+        target_dir = layer_dir.descend(hash_digest, create=True)
+        target_dir.import_single_file(tar_name)
+
+        # Create VERSION file
+        with target_dir.open_file("VERSION", mode="w") as version_handle:
+            version_handle.write(self.LAYER_CONFIG_VERSION)
+
+        # Create json file
+        with target_dir.open_file("json", mode="wb") as json_f:
+            json_f.write(self._layer_json(hash_digest))
+
+        return layer
+
+    def _layer_json(self, hash_digest):
+        """return the content of the json file of a layer
+
+        :param hash_digest: digest of the layer
+        :return: the json file, as bytes
         """
-        while True:
-            data = file_handle.read(block_size)
-            if not data:
-                break
-            else:
-                yield data
+        v1_json = {
+            "id": hash_digest,
+            "created": self._created,
+            "author": self._author,
+            "checksum": "tarsum.v1+sha256:{}".format(hash_digest),
+            "config": {
+                "ExposedPorts": self._exposed_ports,
+                "Env": self._env,
+                "EntryPoint": self._entry_point,
+                "Cmd": self._cmd,
+                "Volumes": self._volumes,
+                "WorkingDir": self._working_dir,
+            },
+        }
+        return _dump_json(v1_json)
+
+
+def _dump_json(obj):
+    return json.dumps(obj, sort_keys=True).encode()
 
 
 def setup():
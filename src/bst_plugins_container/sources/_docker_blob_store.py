@@ -0,0 +1,134 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# A content-addressed store of image blobs, shared between source mirrors.
+#
+# Blobs are hard linked into the store once they have been downloaded and
+# verified, and hard linked out of it instead of being downloaded again. The
+# store never holds a copy of its own: the link count of each blob tells how
+# many mirrors still use it, and blobs which are only linked from the store
+# itself are removed by prune().
+
+import errno
+import os
+import re
+import uuid
+
+_HEX_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    # path():
+    #
+    # Args:
+    #    digest (str): Digest of the blob, e.g. 'sha256:...'
+    #
+    # Returns:
+    #    (str): Where the blob is kept in the store
+    #
+    def path(self, digest):
+        algorithm, hex_digest = digest.split(":", 1)
+        return os.path.join(self.directory, algorithm, hex_digest)
+
+    # link_to():
+    #
+    # Hard link a blob from the store to 'destination'. The caller is
+    # responsible for verifying the content of the blob.
+    #
+    # Args:
+    #    digest (str): Digest of the blob
+    #    destination (str): Path to link the blob to, which must not exist
+    #
+    # Returns:
+    #    (bool): False if the blob is not in the store, or the store is on
+    #            another filesystem than 'destination'
+    #
+    def link_to(self, digest, destination):
+        try:
+            os.link(self.path(digest), destination)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM):
+                return False
+            raise
+        return True
+
+    # add():
+    #
+    # Share a verified blob through the store, unless it already has it.
+    #
+    # Args:
+    #    digest (str): Digest of the blob
+    #    path (str): Path to the blob
+    #
+    # Returns:
+    #    (bool): Whether the store now has the blob
+    #
+    def add(self, digest, path):
+        store_path = self.path(digest)
+        if os.path.exists(store_path):
+            return True
+
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        # Link under a temporary name first, so that the blob appears in the
+        # store atomically, even if another process adds it concurrently.
+        temp_path = "{}.{}.tmp".format(store_path, uuid.uuid4().hex)
+        try:
+            os.link(path, temp_path)
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM):
+                return False
+            raise
+        try:
+            os.rename(temp_path, store_path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        return True
+
+    # prune():
+    #
+    # Remove the blobs which are not linked from any mirror anymore.
+    #
+    # Returns:
+    #    (list): Digests of the removed blobs
+    #
+    def prune(self):
+        removed = []
+        try:
+            algorithms = os.listdir(self.directory)
+        except FileNotFoundError:
+            return removed
+
+        for algorithm in algorithms:
+            algorithm_dir = os.path.join(self.directory, algorithm)
+            if not os.path.isdir(algorithm_dir):
+                continue
+            for name in os.listdir(algorithm_dir):
+                if not _HEX_DIGEST.match(name):
+                    continue
+                path = os.path.join(algorithm_dir, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.unlink(path)
+                        removed.append("{}:{}".format(algorithm, name))
+                except FileNotFoundError:
+                    # Pruned concurrently by another process
+                    pass
+        return removed
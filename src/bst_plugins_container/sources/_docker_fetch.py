@@ -0,0 +1,269 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# Fetching the layer blobs of an image into the source mirror, from the
+# mirror itself, the shared blob store or the registry.
+
+import concurrent.futures
+import os
+import time
+
+import requests
+
+from buildstream import SourceError
+from buildstream.utils import move_atomic, sha256sum
+
+from bst_plugins_container.sources._docker_metrics import throughput
+
+
+# LayerFetcher
+#
+# Args:
+#    source (DockerSource): The source to fetch layers for
+#    verify_blob (callable): Checks the digest of a blob, see
+#                            DockerSource._verify_blob()
+#    verified_blobs (VerifiedBlobs): The index of verified blobs of the
+#                                    mirror
+#
+class LayerFetcher:
+    def __init__(self, source, verify_blob, verified_blobs):
+        self._source = source
+        self._verify_blob = verify_blob
+        self._verified_blobs = verified_blobs
+        self._mirror_dir = source.get_mirror_directory()
+
+    # fetch_layers():
+    #
+    # Download and verify the given layer blobs into the mirror, using up to
+    # 'max-parallel-downloads' concurrent downloads.
+    #
+    # Args:
+    #    layer_sizes (dict): Digests of the layers to download, mapped to
+    #                        their size according to the manifest
+    #    directory (str): Temporary directory to use
+    #
+    # Returns:
+    #    (list): The metrics of each layer, as returned by _fetch_layer()
+    #
+    # Raises:
+    #    SourceError, if any of the layers could not be fetched
+    #
+    def fetch_layers(self, layer_sizes, directory):
+        futures = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._source.max_parallel_downloads
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self._fetch_layer,
+                        layer_digest,
+                        layer_size,
+                        directory,
+                    )
+                    for layer_digest, layer_size in layer_sizes.items()
+                ]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # Don't start any more downloads if one of them failed
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # BuildStream keeps the context of the job in thread-local
+            # storage, so messages must be sent from this thread rather than
+            # from the download threads
+            for future in futures:
+                if (
+                    future.done()
+                    and not future.cancelled()
+                    and future.exception() is None
+                ):
+                    for warning in future.result()[1]:
+                        self._source.warn(warning)
+        return [future.result()[0] for future in futures]
+
+    # share_blobs():
+    #
+    # Add the given blobs of the mirror to the blob store, and remove the
+    # blobs which no source mirror uses anymore from it.
+    #
+    # Args:
+    #    layer_digests (iterable): Digests of the blobs to share
+    #
+    def share_blobs(self, layer_digests):
+        for layer_digest in layer_digests:
+            self._share_blob(
+                layer_digest,
+                os.path.join(self._mirror_dir, layer_digest + ".tar.gz"),
+            )
+        self._prune_blob_store()
+
+    # _fetch_layer():
+    #
+    # Get a layer blob into the mirror, unless it already has it. Blobs are
+    # taken from the shared blob store if possible, and only downloaded from
+    # the registry otherwise.
+    #
+    # Only one process downloads a given blob at a time, others needing the
+    # same blob wait for it and then verify and use it.
+    #
+    # Returns:
+    #    (dict): The metrics of the layer: its 'source', which is one of
+    #            'mirror', 'blob-store' or 'registry', the 'bytes_downloaded'
+    #            and the time spent in 'download_seconds', waiting for
+    #            another process in 'wait_seconds' and in 'verify_seconds'
+    #    (list): Warnings to report
+    #
+    def _fetch_layer(self, layer_digest, layer_size, directory):
+        warnings = []
+        blob_path = os.path.join(self._mirror_dir, layer_digest + ".tar.gz")
+        metrics = {
+            "digest": layer_digest,
+            "size": layer_size,
+            "bytes_downloaded": 0,
+        }
+
+        # Other images may share this layer, and have fetched it already
+        start = time.monotonic()
+        try:
+            self._verify_blob(blob_path, expected_digest=layer_digest)
+            metrics["source"] = "mirror"
+            metrics["verify_seconds"] = time.monotonic() - start
+            return metrics, warnings
+        except FileNotFoundError:
+            pass
+        except SourceError as e:
+            warnings.append("Fetching layer again: {}".format(e))
+            try:
+                os.unlink(blob_path)
+            except FileNotFoundError:
+                pass
+
+        if self._source.blob_store:
+            store_path = os.path.join(directory, layer_digest + ".tar.gz")
+            start = time.monotonic()
+            if self._link_from_blob_store(layer_digest, store_path, warnings):
+                move_atomic(store_path, blob_path)
+                self._verified_blobs.add(blob_path, layer_digest)
+                metrics["source"] = "blob-store"
+                metrics["verify_seconds"] = time.monotonic() - start
+                return metrics, warnings
+
+        try:
+            self._download_layer(layer_digest, layer_size, blob_path, metrics)
+        except (OSError, requests.RequestException) as e:
+            raise SourceError(e) from e
+        return metrics, warnings
+
+    # Download a layer blob from the registry into the mirror, unless another
+    # process is already doing it, and add its metrics to 'metrics'.
+    def _download_layer(self, layer_digest, layer_size, blob_path, metrics):
+        # Keep incomplete downloads out of the temporary directory, so that
+        # they can be resumed by the next fetch if this one fails.
+        partial_dir = os.path.join(self._mirror_dir, "partial")
+        os.makedirs(partial_dir, exist_ok=True)
+        partial_path = os.path.join(partial_dir, layer_digest)
+        try:
+            resumed_size = os.stat(partial_path).st_size
+        except FileNotFoundError:
+            resumed_size = 0
+
+        start = time.monotonic()
+        downloaded = self._source.client.blob(
+            self._source.image,
+            layer_digest,
+            download_to=blob_path,
+            partial_path=partial_path,
+            lock_path=os.path.join(
+                self._mirror_dir, "locks", layer_digest + ".lock"
+            ),
+            size=layer_size,
+        )
+        seconds = time.monotonic() - start
+
+        # Blobs are verified while they are downloaded
+        if downloaded:
+            self._verified_blobs.add(blob_path, layer_digest)
+            metrics["source"] = "registry"
+            metrics["bytes_downloaded"] = (
+                os.stat(blob_path).st_size - resumed_size
+            )
+            metrics["download_seconds"] = seconds
+            metrics["throughput"] = throughput(
+                metrics["bytes_downloaded"], seconds
+            )
+        else:
+            # Another process downloaded it while we waited
+            start = time.monotonic()
+            self._verify_blob(blob_path, expected_digest=layer_digest)
+            metrics["source"] = "mirror"
+            metrics["wait_seconds"] = seconds
+            metrics["verify_seconds"] = time.monotonic() - start
+
+    # Blobs in the store are verified when they are linked out of it, as
+    # anything with write access to the store could have changed them.
+    # Problems are added to 'warnings' rather than reported, as this runs in
+    # a download thread.
+    def _link_from_blob_store(self, layer_digest, blob_path, warnings):
+        try:
+            if not self._source.blob_store.link_to(layer_digest, blob_path):
+                return False
+            blob_digest = "sha256:" + sha256sum(blob_path)
+        except OSError as e:
+            warnings.append(
+                "Unable to use blob {} from the blob store: {}".format(
+                    layer_digest, e
+                )
+            )
+            return False
+
+        if blob_digest != layer_digest:
+            warnings.append(
+                "Blob {} in the blob store is corrupt; got content hash "
+                "of {}.".format(layer_digest, blob_digest)
+            )
+            os.unlink(blob_path)
+            return False
+        return True
+
+    def _share_blob(self, layer_digest, blob_path):
+        try:
+            if not self._source.blob_store.add(layer_digest, blob_path):
+                self._source.warn(
+                    "Unable to share blob {}: the blob store must be on the "
+                    "same filesystem as the source mirror".format(layer_digest)
+                )
+        except OSError as e:
+            self._source.warn(
+                "Unable to add blob {} to the blob store: {}".format(
+                    layer_digest, e
+                )
+            )
+
+    def _prune_blob_store(self):
+        try:
+            removed = self._source.blob_store.prune()
+        except OSError as e:
+            self._source.warn("Unable to prune the blob store: {}".format(e))
+            return
+        if removed:
+            self._source.info(
+                "Removed {} unused blobs from the blob store".format(
+                    len(removed)
+                )
+            )
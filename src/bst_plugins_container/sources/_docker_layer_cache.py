@@ -0,0 +1,168 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# A cache of extracted layers, so that staging the same image again only
+# needs to hard link files rather than decompress and extract every layer.
+#
+# Each entry holds the complete tree of a layer, along with its index as
+# returned by index_layer(), so that the merged filesystem of an image can be
+# planned and staged without reading any of its layer tarballs:
+#
+#   <directory>/sha256/<hex>/tree/       The extracted layer
+#   <directory>/sha256/<hex>/entry.json  The layer's index and size
+#
+# Several processes can stage from the cache while it is being trimmed, see
+# LRUCache. Eviction removes the least recently used entries first.
+
+import contextlib
+import fcntl
+import json
+import os
+
+from buildstream.utils import save_file_atomic
+
+from bst_plugins_container._utils import LRUCache, locked, remove_tree
+from bst_plugins_container.sources._docker_layers import (
+    MergePlan,
+    extract_layer,
+    index_layer,
+)
+
+
+class LayerCache(LRUCache):
+    def _entry_path(self, key):
+        algorithm, hex_digest = key.split(":", 1)
+        return os.path.join(self.directory, algorithm, hex_digest)
+
+    # has():
+    #
+    # Args:
+    #    digest (str): Digest of the layer
+    #
+    # Returns:
+    #    (bool): Whether the layer is in the cache, it may still be evicted
+    #            before it is used
+    #
+    def has(self, digest):
+        return os.path.exists(self._entry_path(digest))
+
+    # add():
+    #
+    # Extract a layer into the cache, unless it already has it.
+    #
+    # Args:
+    #    digest (str): Digest of the layer
+    #    layer_tar_path (str): Path to the verified layer tarball
+    #
+    # Returns:
+    #    (dict): The statistics of the extraction, as returned by
+    #            extract_layer(), or None if the layer was already cached
+    #
+    def add(self, digest, layer_tar_path):
+        with locked(self._lock_path(digest), fcntl.LOCK_EX):
+            entry_path = self._entry_path(digest)
+            if os.path.exists(entry_path):
+                return None
+
+            # Extract somewhere else first, so that incomplete entries are
+            # never used. If we die, they are removed by a later eviction.
+            temp_path = self._temp_path()
+            tree_path = os.path.join(temp_path, "tree")
+            os.makedirs(tree_path)
+            try:
+                stats = extract_layer(
+                    layer_tar_path, tree_path, MergePlan(), 0
+                )
+                with save_file_atomic(
+                    os.path.join(temp_path, "entry.json"), "w"
+                ) as f:
+                    json.dump(
+                        {
+                            "index": index_layer(layer_tar_path),
+                            "size": _tree_size(tree_path),
+                        },
+                        f,
+                    )
+
+                os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+                os.rename(temp_path, entry_path)
+            except BaseException:
+                remove_tree(temp_path)
+                raise
+
+            return stats
+
+    # use():
+    #
+    # Use a layer from the cache, adding it first if needed. The entry will
+    # not be evicted until the context is left.
+    #
+    # Args:
+    #    digest (str): Digest of the layer
+    #    layer_tar_path (str): Path to the verified layer tarball
+    #
+    # Yields:
+    #    (str, list): Path to the extracted layer, and its index
+    #
+    @contextlib.contextmanager
+    def use(self, digest, layer_tar_path):
+        entry_path = self._entry_path(digest)
+        while True:
+            with locked(self._lock_path(digest), fcntl.LOCK_SH):
+                try:
+                    with open(os.path.join(entry_path, "entry.json")) as f:
+                        entry = json.load(f)
+                except FileNotFoundError:
+                    entry = None
+
+                if entry is not None:
+                    # Mark the entry as recently used
+                    os.utime(os.path.join(entry_path, "entry.json"))
+                    yield (
+                        os.path.join(entry_path, "tree"),
+                        [tuple(item) for item in entry["index"]],
+                    )
+                    return
+
+            self.add(digest, layer_tar_path)
+
+    def _list_keys(self):
+        try:
+            algorithms = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for algorithm in algorithms:
+            if algorithm in ("locks", "tmp"):
+                continue
+            for hex_digest in os.listdir(
+                os.path.join(self.directory, algorithm)
+            ):
+                yield "{}:{}".format(algorithm, hex_digest)
+
+    def _entry_size(self, key, entry):
+        return entry["size"]
+
+
+# The disk space used by the files of a tree, counting hard links once
+def _tree_size(directory):
+    inodes = set()
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            file_stat = os.lstat(os.path.join(root, name))
+            if file_stat.st_ino not in inodes:
+                inodes.add(file_stat.st_ino)
+                size += file_stat.st_size
+    return size
@@ -0,0 +1,614 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# Helpers for merging the layers of a Docker image into a single filesystem.
+#
+# Merging happens in two phases. First the members of every layer but the
+# bottom-most one are indexed, and a MergePlan resolves overwrites, whiteouts
+# and opaque directories from the top of the image downwards. Then each layer
+# is extracted, skipping every member which is replaced or removed by a layer
+# above it, so that each path is only ever written once.
+#
+# Members of the merged filesystem can further be selected with a PathFilter,
+# so that unwanted paths are never extracted at all.
+#
+# Indexing a layer decompresses it, so the layers which are indexed are
+# decompressed twice the first time they are staged. Their indices can be
+# saved with load_layer_index(), so that later stages only decompress each
+# layer once, to extract it.
+#
+# Both phases handle every layer independently, so they can be run for all
+# layers in parallel. This lives outside of the plugin module so that these
+# functions can be imported by worker processes.
+
+import contextlib
+import copy
+import fnmatch
+import gzip
+import json
+import os
+import tarfile
+import time
+
+from buildstream import SourceError
+from buildstream.utils import link_files, save_file_atomic
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Media types of the layers we know how to extract
+LAYER_MEDIA_TYPES = [
+    "application/vnd.docker.image.rootfs.diff.tar.gzip",
+    "application/vnd.oci.image.layer.v1.tar",
+    "application/vnd.oci.image.layer.v1.tar+gzip",
+    "application/vnd.oci.image.layer.v1.tar+zstd",
+]
+
+# Kinds of members recorded in a layer index
+DIRECTORY = "directory"
+NON_DIRECTORY = "non-directory"
+WHITEOUT = "whiteout"
+OPAQUE = "opaque"
+
+_WHITEOUT_PREFIX = ".wh."
+_OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+
+class ReadableTarInfo(tarfile.TarInfo):
+    """
+    The goal is to override`TarFile`'s `extractall` semantics by ensuring that on extraction, the
+    files are readable by the owner of the file. This is done by over-riding the accessor for the
+    mode` attribute in `TarInfo`, class that encapsulates the internal meta-data of the tarball,
+    so that the owner-read bit is always set.
+    """
+
+    @property
+    def mode(self):
+        # ensure file is readable by owner
+        return self.__permission | 0o400
+
+    @mode.setter
+    def mode(self, permission):
+        self.__permission = permission
+
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+# A file object which measures how long reading from it takes, which for a
+# decompressing stream is mostly decompression time.
+class _TimedReader:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.seconds = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        try:
+            return self._fileobj.read(size)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+# _open_layer():
+#
+# Open a layer tarball for reading in a single streaming pass.
+#
+# Layers are kept in the source mirror by digest only, so rather than relying
+# on their media type, the compression is detected from the content. zstd
+# needs the 'zstandard' package.
+#
+# Args:
+#    layer_tar_path (str): Path to the layer tarball
+#    tarinfo (type): The TarInfo class to use for members
+#    stats (dict): If given, the time spent reading and decompressing the
+#                  layer is added to its 'decompress_seconds'
+#
+# Yields:
+#    (tarfile.TarFile): The layer tarball
+#
+@contextlib.contextmanager
+def _open_layer(layer_tar_path, tarinfo=tarfile.TarInfo, stats=None):
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(open(layer_tar_path, "rb"))
+        magic = f.read(len(_ZSTD_MAGIC))
+        f.seek(0)
+
+        if magic.startswith(_GZIP_MAGIC):
+            stream = stack.enter_context(gzip.GzipFile(fileobj=f))
+        elif magic == _ZSTD_MAGIC:
+            if zstandard is None:
+                raise SourceError(
+                    "Layer {} is compressed with zstd, which requires the "
+                    "'zstandard' Python package".format(
+                        os.path.basename(layer_tar_path)
+                    )
+                )
+            # Layers may be made of several zstd frames
+            stream = stack.enter_context(
+                zstandard.ZstdDecompressor().stream_reader(
+                    f, read_across_frames=True
+                )
+            )
+        else:
+            stream = f
+
+        reader = _TimedReader(stream)
+        try:
+            # Let tarfile detect any other compression itself
+            with tarfile.open(
+                fileobj=reader,
+                mode="r|*" if stream is f else "r|",
+                tarinfo=tarinfo,
+            ) as tar:
+                yield tar
+        finally:
+            if stats is not None:
+                stats["decompress_seconds"] = (
+                    stats.get("decompress_seconds", 0) + reader.seconds
+                )
+
+
+# Normalize a member name so that './usr/bin/' and 'usr/bin' compare equal
+def _normalize(name):
+    return os.path.normpath(name.lstrip("/"))
+
+
+def _parents(path):
+    parent = os.path.dirname(path)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
+
+
+# Device nodes cannot be staged, and neither can anything in /dev
+def _is_staged(member):
+    return not (_normalize(member.name).startswith("dev/") or member.isdev())
+
+
+# index_layer():
+#
+# List the members of a layer which affect the layers below it.
+#
+# Args:
+#    layer_tar_path (str): Path to the layer tarball
+#
+# Returns:
+#    (list): (path, kind) tuples, where kind is one of DIRECTORY,
+#            NON_DIRECTORY, WHITEOUT or OPAQUE. For whiteouts, path is the
+#            path being removed, for opaque whiteouts the directory which is
+#            made opaque.
+#
+def index_layer(layer_tar_path):
+    index = []
+    with _open_layer(layer_tar_path) as tar:
+        for member in tar:
+            name = _normalize(member.name)
+            basename = os.path.basename(name)
+            if basename == _OPAQUE_WHITEOUT:
+                index.append((os.path.dirname(name), OPAQUE))
+            elif basename.startswith(_WHITEOUT_PREFIX):
+                index.append(
+                    (
+                        os.path.join(
+                            os.path.dirname(name),
+                            basename[len(_WHITEOUT_PREFIX) :],
+                        ),
+                        WHITEOUT,
+                    )
+                )
+            elif not _is_staged(member):
+                continue
+            elif member.isdir():
+                index.append((name, DIRECTORY))
+            else:
+                index.append((name, NON_DIRECTORY))
+    return index
+
+
+# load_layer_index():
+#
+# Like index_layer(), but the index is saved to 'index_path' the first time,
+# and read from there afterwards.
+#
+# Args:
+#    layer_tar_path (str): Path to the layer tarball
+#    index_path (str): Path to save the index of the layer to, which must be
+#                      unique to the content of the layer
+#
+# Returns:
+#    (list): The index of the layer, as returned by index_layer()
+#
+def load_layer_index(layer_tar_path, index_path):
+    try:
+        with open(index_path) as f:
+            return [tuple(item) for item in json.load(f)]
+    except FileNotFoundError:
+        pass
+
+    index = index_layer(layer_tar_path)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    with save_file_atomic(index_path, "w") as f:
+        json.dump(index, f)
+    return index
+
+
+# PathFilter
+#
+# Selects paths with shell-style glob patterns. Patterns are matched against
+# paths relative to the root of the image one component at a time, so that
+# '*' never matches a '/', and a pattern matching a directory also matches
+# everything underneath it.
+#
+# Args:
+#    include (list): Patterns of the paths to select, or None to select
+#                    everything which is not excluded
+#    exclude (list): Patterns of the paths not to select
+#
+class PathFilter:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, include=None, exclude=None):
+        self._include = [_split_path(pattern) for pattern in include or []]
+        self._exclude = [_split_path(pattern) for pattern in exclude or []]
+
+    # matches():
+    #
+    # Args:
+    #    path (str): The normalized path of a member
+    #    is_directory (bool): Whether the member is a directory
+    #
+    # Returns:
+    #    (bool): Whether the member is selected. Directories which may
+    #            contain selected paths are selected too.
+    #
+    def matches(self, path, is_directory):
+        parts = _split_path(path)
+        if any(_glob_match(pattern, parts) for pattern in self._exclude):
+            return False
+        if not self._include:
+            return True
+        return any(
+            _glob_match(pattern, parts)
+            or (is_directory and _may_contain(pattern, parts))
+            for pattern in self._include
+        )
+
+
+def _split_path(path):
+    return [part for part in path.split("/") if part not in ("", ".")]
+
+
+def _components_match(pattern, parts):
+    return all(
+        fnmatch.fnmatchcase(part, component)
+        for part, component in zip(parts, pattern)
+    )
+
+
+# Whether 'parts', or one of its parents, matches 'pattern'
+def _glob_match(pattern, parts):
+    return len(parts) >= len(pattern) and _components_match(pattern, parts)
+
+
+# Whether 'parts' is a parent of the paths matching 'pattern'
+def _may_contain(pattern, parts):
+    return len(parts) < len(pattern) and _components_match(pattern, parts)
+
+
+# MergePlan
+#
+# Works out which layer provides each path of the merged image filesystem.
+#
+# Layers are identified by their level, 0 being the bottom-most layer. They
+# must be added from the top of the image downwards, and only the layers above
+# a given level need to have been added to know what to extract from it.
+#
+# Args:
+#    path_filter (PathFilter): Selects which paths of the merged filesystem
+#                              to stage, or None to stage all of them
+#
+class MergePlan:
+    def __init__(self, path_filter=None):
+        self.path_filter = path_filter
+        # Each of these maps a path to the highest level which:
+        #
+        # provides the path
+        self._provided = {}
+        # has a path underneath it, so it must be a directory
+        self._directories = {}
+        # removes the path and everything underneath it, either with a
+        # whiteout or by replacing it with a non-directory
+        self._removed = {}
+        # makes the directory opaque, removing everything underneath it
+        self._opaque = {}
+
+    # add_layer():
+    #
+    # Args:
+    #    level (int): The level of the layer
+    #    index (list): The layer's index, as returned by index_layer()
+    #
+    def add_layer(self, level, index):
+        for path, kind in index:
+            if kind == WHITEOUT:
+                self._removed.setdefault(path, level)
+            elif kind == OPAQUE:
+                self._opaque.setdefault(path, level)
+            else:
+                # A non-directory removes what lower layers have underneath
+                # its path even when it is itself hidden, as a directory
+                # created again above it starts empty
+                if kind == NON_DIRECTORY:
+                    self._removed.setdefault(path, level)
+                if self.is_visible(level, path, kind == DIRECTORY):
+                    self._provided.setdefault(path, level)
+                    for parent in _parents(path):
+                        self._directories.setdefault(parent, level)
+
+    # is_visible():
+    #
+    # Whether a member of the layer at 'level' is part of the merged
+    # filesystem, given the layers above it.
+    #
+    # Args:
+    #    level (int): The level of the layer
+    #    path (str): The normalized path of the member
+    #    is_directory (bool): Whether the member is a directory
+    #
+    # Returns:
+    #    (bool): False if a layer above replaces or removes the member
+    #
+    def is_visible(self, level, path, is_directory):
+        def above(mapping, key):
+            return mapping.get(key, -1) > level
+
+        if above(self._provided, path) or above(self._removed, path):
+            return False
+        if not is_directory and above(self._directories, path):
+            return False
+        for parent in _parents(path):
+            if above(self._removed, parent) or above(self._opaque, parent):
+                return False
+        return True
+
+    # is_selected():
+    #
+    # Whether a member of the merged filesystem is selected by the plan's
+    # path filter.
+    #
+    # Args:
+    #    path (str): The normalized path of the member
+    #    is_directory (bool): Whether the member is a directory
+    #
+    # Returns:
+    #    (bool): False if the member is not to be staged
+    #
+    def is_selected(self, path, is_directory):
+        return self.path_filter is None or self.path_filter.matches(
+            path, is_directory
+        )
+
+
+# plan_merge():
+#
+# Args:
+#    indices (list): Index of every layer but the bottom-most one, as
+#                    returned by index_layer(), bottom-most first
+#    path_filter (PathFilter): Selects which paths to stage, if not all
+#
+# Returns:
+#    (MergePlan): The plan for merging the layers
+#
+def plan_merge(indices, path_filter=None):
+    plan = MergePlan(path_filter)
+    for level, index in reversed(list(enumerate(indices, start=1))):
+        plan.add_layer(level, index)
+    return plan
+
+
+# extract_layer():
+#
+# Extract a layer to a directory in a single streaming pass.
+#
+# Whiteouts, device nodes, files in /dev, members which are replaced or
+# removed by a layer above and members which the plan does not select are
+# not extracted.
+#
+# Args:
+#    layer_tar_path (str): Path to the layer tarball
+#    directory (str): Directory to extract the layer into
+#    plan (MergePlan): The plan of the layers above this one
+#    level (int): The level of this layer
+#
+# Returns:
+#    (dict): Statistics about the extraction: the number of 'members'
+#            extracted, of 'whiteouts' removing files from lower layers, of
+#            members 'hidden' by upper layers and 'filtered' out by the
+#            plan, and the time spent in 'decompress_seconds' and in total
+#            in 'extract_seconds'
+#
+def extract_layer(layer_tar_path, directory, plan, level):
+    start = time.perf_counter()
+    stats = {"members": 0, "whiteouts": 0, "hidden": 0, "filtered": 0}
+    extracted = set()
+    directories = []
+    # Hard links whose target is not part of the merged filesystem, mapped
+    # by target path
+    orphan_links = {}
+
+    with _open_layer(
+        layer_tar_path, tarinfo=ReadableTarInfo, stats=stats
+    ) as tar:
+        for member in tar:
+            name = _normalize(member.name)
+            if os.path.basename(name).startswith(_WHITEOUT_PREFIX):
+                stats["whiteouts"] += 1
+                continue
+            if not _is_staged(member):
+                continue
+            if not plan.is_visible(level, name, member.isdir()):
+                stats["hidden"] += 1
+                continue
+            if not plan.is_selected(name, member.isdir()):
+                stats["filtered"] += 1
+                continue
+
+            if member.islnk():
+                target = _normalize(member.linkname)
+                if target not in extracted:
+                    orphan_links.setdefault(target, []).append(member)
+                    continue
+
+            if member.isdir():
+                # Like TarFile.extractall(), create directories writable
+                # and only apply their attributes once all of their
+                # content has been extracted.
+                directories.append(member)
+                member = copy.copy(member)
+                member.mode = 0o700
+                tar.extract(member, path=directory, set_attrs=False)
+            else:
+                tar.extract(member, path=directory)
+            extracted.add(name)
+            stats["members"] += 1
+
+        _set_directory_attributes(tar, directories, directory)
+
+    if orphan_links:
+        stats["members"] += _extract_orphan_links(
+            layer_tar_path, directory, orphan_links, stats
+        )
+
+    stats["extract_seconds"] = time.perf_counter() - start
+    return stats
+
+
+# extract_layers():
+#
+# Extract every layer of an image into its own directory, leaving out what is
+# replaced or removed by the layers above it. Linking the directories into
+# one, in order, gives the merged filesystem of the image.
+#
+# Args:
+#    layer_tar_paths (list): Paths to the layer tarballs, bottom-most first
+#    directories (list): Directory to extract each layer into
+#    executor (concurrent.futures.Executor): Executor to index and extract
+#                                            layers with, or None to do it
+#                                            serially
+#    path_filter (PathFilter): Selects which paths to extract, if not all
+#    index_paths (list): Path to save the index of each layer to, see
+#                        load_layer_index(), or None to index every layer
+#                        again
+#
+# Returns:
+#    (list): The statistics of each layer, as returned by extract_layer()
+#
+def extract_layers(
+    layer_tar_paths,
+    directories,
+    executor=None,
+    path_filter=None,
+    index_paths=None,
+):
+    def run(function, *iterables):
+        if executor is None:
+            return list(map(function, *iterables))
+        return list(executor.map(function, *iterables))
+
+    levels = range(len(layer_tar_paths))
+    if index_paths is None:
+        indices = run(index_layer, layer_tar_paths[1:])
+    else:
+        indices = run(load_layer_index, layer_tar_paths[1:], index_paths[1:])
+    plan = plan_merge(indices, path_filter)
+
+    return run(
+        extract_layer,
+        layer_tar_paths,
+        directories,
+        [plan] * len(layer_tar_paths),
+        levels,
+    )
+
+
+# link_layer():
+#
+# Hard link the files of an extracted layer which are part of the merged
+# filesystem, and selected by the plan, into a directory. Linking every layer
+# of an image, bottom-most first, gives the same result as extract_layers().
+#
+# Args:
+#    layer_directory (str): The complete extracted layer
+#    directory (str): Directory to stage the merged filesystem in
+#    plan (MergePlan): The plan of the layers above this one
+#    level (int): The level of this layer
+#
+def link_layer(layer_directory, directory, plan, level):
+    def is_visible(path):
+        is_directory = os.path.isdir(
+            os.path.join(layer_directory, path)
+        ) and not os.path.islink(os.path.join(layer_directory, path))
+        path = _normalize(path)
+        return plan.is_visible(level, path, is_directory) and plan.is_selected(
+            path, is_directory
+        )
+
+    link_files(layer_directory, directory, filter_callback=is_visible)
+
+
+# Apply the attributes of directories, deepest first so that read-only
+# directories do not prevent setting attributes of their children.
+def _set_directory_attributes(tar, directories, directory):
+    directories.sort(key=lambda member: member.name, reverse=True)
+    for member in directories:
+        dirpath = os.path.join(directory, member.name)
+        try:
+            tar.chown(member, dirpath, False)
+            tar.utime(member, dirpath)
+            tar.chmod(member, dirpath)
+        except tarfile.ExtractError:
+            pass
+
+
+# Hard links to files which were replaced or removed by a layer above can not
+# be created as links, so extract the content of the target in their place.
+# This needs a second pass through the layer, which should be very rare.
+def _extract_orphan_links(layer_tar_path, directory, orphan_links, stats):
+    extracted = 0
+    with _open_layer(
+        layer_tar_path, tarinfo=ReadableTarInfo, stats=stats
+    ) as tar:
+        for member in tar:
+            links = orphan_links.get(_normalize(member.name))
+            if not links or not member.isreg():
+                continue
+            # The stream can only be read once, so extract the content for
+            # the first link and hard link the others to it.
+            target = copy.copy(member)
+            target.name = links[0].name
+            tar.extract(target, path=directory)
+            for link in links[1:]:
+                os.link(
+                    os.path.join(directory, links[0].name),
+                    os.path.join(directory, link.name),
+                )
+            extracted += len(links)
+    return extracted
@@ -0,0 +1,82 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# Per-layer metrics of the docker source.
+#
+# Metrics are plain dicts, so that they can be returned from worker
+# processes, with one dict per layer. Durations are in seconds and sizes in
+# bytes.
+
+import json
+import time
+
+from bst_plugins_container._utils import locked
+
+
+# throughput():
+#
+# Args:
+#    size (int): Number of bytes transferred
+#    seconds (float): Time the transfer took
+#
+# Returns:
+#    (float): Bytes per second, or None if nothing was transferred
+#
+def throughput(size, seconds):
+    if not size or not seconds:
+        return None
+    return size / seconds
+
+
+# format_metrics():
+#
+# Format the metrics of layers for the detail of a log message, with one
+# block of "key: value" lines per layer.
+#
+# Args:
+#    layers (list): Metrics of each layer
+#
+# Returns:
+#    (str): The formatted metrics
+#
+def format_metrics(layers):
+    lines = []
+    for metrics in layers:
+        lines.append("- digest: {}".format(metrics["digest"]))
+        for key, value in sorted(metrics.items()):
+            if key == "digest" or value is None:
+                continue
+            if key == "throughput":
+                value = "{:.1f} MiB/s".format(value / 2**20)
+            elif key.endswith("_seconds"):
+                value = "{:.3f}s".format(value)
+            lines.append("  {}: {}".format(key, value))
+    return "\n".join(lines)
+
+
+# write_metrics():
+#
+# Append a record to a metrics file, as one line of JSON. Several sources
+# and processes may write to the same file, so it is locked while writing.
+#
+# Args:
+#    path (str): Path to the metrics file
+#    record (dict): The record to write, the current time is added to it
+#
+def write_metrics(path, record):
+    record = dict(record, time=time.time())
+    with locked(path + ".lock"):
+        with open(path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
@@ -0,0 +1,148 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# Failover between several endpoints serving the same registry.
+
+import concurrent.futures
+import threading
+import time
+
+import requests
+
+from buildstream import SourceError
+
+from bst_plugins_container.sources._docker_registry import (
+    DockerRegistryV2Client,
+    urljoin,
+)
+
+# Latency of each registry endpoint, measured once per process, in seconds.
+# Endpoints which could not be reached are recorded as infinitely slow.
+_LATENCIES = {}
+_LATENCIES_LOCK = threading.Lock()
+
+
+# DockerRegistryMirrors
+#
+# Talks to the same registry through several endpoints, such as pull-through
+# caches in front of it, failing over to the next endpoint if one fails.
+#
+# It offers the same methods as DockerRegistryV2Client. Every endpoint is
+# trusted equally little: manifests and blobs are verified against their
+# digests whichever endpoint they come from, and corrupt content is treated
+# like any other failure.
+#
+# Args:
+#    clients (list): DockerRegistryV2Client for each endpoint, in order of
+#                    preference
+#    probe_latency (bool): Prefer the endpoints which respond the fastest,
+#                          rather than following the order of 'clients'
+#
+class DockerRegistryMirrors:
+    def __init__(self, clients, probe_latency=False):
+        self.clients = clients
+        self.probe_latency = probe_latency
+
+    @property
+    def endpoint(self):
+        return self.clients[0].endpoint
+
+    @staticmethod
+    def digest(content):
+        return DockerRegistryV2Client.digest(content)
+
+    def manifest(self, *args, **kwargs):
+        return self._call("manifest", *args, **kwargs)
+
+    def manifest_digest(self, *args, **kwargs):
+        return self._call("manifest_digest", *args, **kwargs)
+
+    def blob(self, *args, **kwargs):
+        return self._call("blob", *args, **kwargs)
+
+    # Call a method of each client in turn, until one succeeds
+    def _call(self, method, *args, **kwargs):
+        errors = []
+        for client in self._ordered_clients():
+            try:
+                return getattr(client, method)(*args, **kwargs)
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+            ) as e:
+                # Avoid this endpoint for the rest of the process
+                with _LATENCIES_LOCK:
+                    _LATENCIES[client.endpoint] = float("inf")
+                errors.append((client.endpoint, e))
+            except (requests.RequestException, SourceError) as e:
+                errors.append((client.endpoint, e))
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        raise SourceError(
+            "All registry mirrors failed",
+            detail="\n".join(
+                "{}: {}".format(endpoint, error) for endpoint, error in errors
+            ),
+        ) from errors[-1][1]
+
+    def _ordered_clients(self):
+        if len(self.clients) < 2:
+            return self.clients
+
+        if not self.probe_latency:
+            # Keep the order of preference, but only try the endpoints which
+            # could not be reached once the others failed
+            with _LATENCIES_LOCK:
+                return sorted(
+                    self.clients,
+                    key=lambda client: _LATENCIES.get(client.endpoint)
+                    == float("inf"),
+                )
+
+        with _LATENCIES_LOCK:
+            unknown = [
+                client
+                for client in self.clients
+                if client.endpoint not in _LATENCIES
+            ]
+        if unknown:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(unknown)
+            ) as executor:
+                latencies = list(executor.map(_probe_latency, unknown))
+            with _LATENCIES_LOCK:
+                for client, latency in zip(unknown, latencies):
+                    _LATENCIES.setdefault(client.endpoint, latency)
+
+        with _LATENCIES_LOCK:
+            # sorted() is stable, so endpoints which are as fast as each
+            # other stay in order of preference
+            return sorted(
+                self.clients, key=lambda client: _LATENCIES[client.endpoint]
+            )
+
+
+# How long it takes for an endpoint to answer a request to the base of the
+# API, whatever the answer is.
+def _probe_latency(client):
+    start = time.monotonic()
+    try:
+        client.session.get(
+            urljoin(client.endpoint, "v2/"), timeout=client.api_timeout
+        ).close()
+    except requests.RequestException:
+        return float("inf")
+    return time.monotonic() - start
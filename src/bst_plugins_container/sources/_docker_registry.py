@@ -0,0 +1,953 @@
+#  Copyright (C) 2017 Codethink Limited
+#  Copyright (C) 2018 Bloomberg Finance LP
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+#
+#  Authors:
+#        Sam Thursfield <sam.thursfield@codethink.co.uk>
+#        Chandan Singh <csingh43@bloomberg.net>
+
+# Client for the Docker registry HTTP API V2, used by the docker source.
+
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from buildstream import SourceError
+from buildstream.utils import move_atomic, save_file_atomic, sha256sum
+
+from bst_plugins_container._utils import locked
+
+DEFAULT_CONNECTION_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_SEGMENTS = 4
+
+_MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+_MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+# Manifests of a single image, and "fat" manifests listing the images of
+# several platforms
+_IMAGE_MANIFEST_TYPES = [_MANIFEST_V2, _OCI_MANIFEST]
+_INDEX_TYPES = [_MANIFEST_LIST_V2, _OCI_INDEX]
+_MANIFEST_TYPES = _IMAGE_MANIFEST_TYPES + _INDEX_TYPES
+
+# Size of the chunks in which blobs are streamed to disk
+_CHUNK_SIZE = 1024 * 1024
+
+# HTTP sessions shared by all clients talking to the same registry, so that
+# connections are kept alive and reused between requests.
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+# Bearer tokens shared by all clients, keyed by (realm, service, scope), as
+# (token, expiry) tuples.
+_TOKENS = {}
+# The (realm, service) each registry endpoint last challenged us with, and the
+# scope it asked for for each image.
+_CHALLENGES = {}
+_SCOPES = {}
+_TOKENS_LOCK = threading.Lock()
+
+# Retried requests wait for an exponentially growing delay, starting from
+# _BACKOFF_FACTOR seconds and capped to _BACKOFF_MAX seconds. This also bounds
+# how long we honour Retry-After headers for.
+_BACKOFF_FACTOR = 0.5
+_BACKOFF_MAX = 60
+
+# Consider tokens expired this many seconds early, so that they don't expire
+# while a request is in flight.
+_TOKEN_EXPIRY_MARGIN = 5
+
+
+def parse_bearer_authorization_challenge(text):
+    # Hand-written and probably broken parsing of the Www-Authenticate
+    # response. I can't find a built-in way to parse this, but I probably
+    # didn't look hard enough.
+    if not text.startswith("Bearer "):
+        raise SourceError(
+            "Unexpected Www-Authenticate response: %{}".format(text)
+        )
+
+    pairs = {}
+    text = text[len("Bearer ") :]
+    for pair in text.split(","):
+        key, value = pair.split("=")
+        pairs[key] = value[1:-1]
+    return pairs
+
+
+# Parse an RFC 3339 timestamp as found in token responses, e.g.
+# 2020-01-01T00:00:00.123456789Z, ignoring fractions of a second. Returns
+# None if the timestamp can not be parsed.
+def parse_timestamp(text):
+    try:
+        parsed = datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return parsed.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def default_architecture():
+    machine = platform.machine()
+    if machine == "x86_64":
+        return "amd64"
+    elif machine == "aarch64":
+        return "arm64"
+    else:
+        return machine
+
+
+def default_os():
+    return platform.system().lower()
+
+
+# Variant of urllib.parse.urljoin() allowing multiple path components at once.
+def urljoin(url, *args):
+    for arg in args:
+        if not url.endswith("/"):
+            url += "/"
+        url = urllib.parse.urljoin(url, arg.lstrip("/"))
+    return url
+
+
+# backoff_time():
+#
+# Args:
+#    delay (float): The exponential backoff delay, in seconds
+#
+# Returns:
+#    (float): How long to wait before retrying, capped to _BACKOFF_MAX and
+#             jittered, so that many clients failing at the same time do not
+#             retry all at once
+#
+def backoff_time(delay):
+    delay = min(delay, _BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+# Retry policy of urllib3, with the backoff delay bounded and jittered
+class _Retry(Retry):
+    def get_backoff_time(self):
+        delay = super().get_backoff_time()
+        return backoff_time(delay) if delay else 0
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, _BACKOFF_MAX)
+
+
+# get_session():
+#
+# Get the HTTP session to use for talking to the given registry endpoint.
+#
+# Sessions are shared across the whole process, so every client for the same
+# endpoint, pool size and retry policy reuses the same pool of keep-alive
+# connections.
+#
+# Requests which fail to connect, or get a transient server error or a 429
+# response, are retried with exponential backoff. The Retry-After header of
+# 429 and 503 responses is honoured, up to _BACKOFF_MAX seconds.
+#
+# Args:
+#    endpoint (str): The registry endpoint
+#    pool_size (int): Number of connections to keep open per host
+#    max_retries (int): Number of times to retry failed connections and
+#                       transient server errors
+#
+# Returns:
+#    (requests.Session): The session for this endpoint
+#
+def get_session(endpoint, pool_size, max_retries):
+    key = (endpoint, pool_size, max_retries)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            retry = _Retry(
+                total=max_retries,
+                backoff_factor=_BACKOFF_FACTOR,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _SESSIONS[key] = session
+        return session
+
+
+# manifest_media_type():
+#
+# The mediaType field is optional in OCI manifests and indexes, in which case
+# tell them apart by their content.
+#
+# Args:
+#    manifest (dict): A parsed manifest
+#
+# Returns:
+#    (str): The media type of the manifest
+#
+def manifest_media_type(manifest):
+    if "mediaType" in manifest:
+        return manifest["mediaType"]
+    if "manifests" in manifest:
+        return _OCI_INDEX
+    if "layers" in manifest:
+        return _OCI_MANIFEST
+    return None
+
+
+# DockerManifestError
+#
+# Raised if something goes wrong while querying an image manifest from a remote
+# registry.
+#
+class DockerManifestError(SourceError):
+    def __init__(self, message, manifest=None):
+        super().__init__(message)
+        self.manifest = manifest
+
+
+# The registry did not honour a Range request for a segment of a blob
+class _RangeNotSatisfied(Exception):
+    pass
+
+
+# The connection broke while reading a blob, after the registry answered
+#
+# Args:
+#    error (requests.RequestException): What broke the connection
+#
+class _DownloadInterrupted(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+# Iterate over the content of a blob response, raising _DownloadInterrupted
+# if the connection breaks before the end of it.
+def _iter_blob_content(response):
+    try:
+        yield from response.iter_content(chunk_size=_CHUNK_SIZE)
+    except (
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    ) as e:
+        raise _DownloadInterrupted(e) from e
+
+
+# DockerRegistryV2Client
+#
+# Args:
+#    endpoint (str): URL of the registry
+#    api_timeout (float or tuple): Timeout of requests, in seconds, or a
+#                                  (connect, read) tuple of timeouts. The
+#                                  read timeout bounds the time between two
+#                                  bytes of a response, not its whole
+#                                  duration.
+#    pool_size (int): Number of connections to keep open to the registry
+#    max_retries (int): Number of times to retry failed requests
+#    segment_threshold (int): Blobs of at least this size are downloaded in
+#                             several segments concurrently, 0 to disable
+#    segments (int): Number of segments to split large blobs into
+#
+class DockerRegistryV2Client:
+    def __init__(
+        self,
+        endpoint,
+        api_timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+        *,
+        pool_size=DEFAULT_CONNECTION_POOL_SIZE,
+        max_retries=DEFAULT_MAX_RETRIES,
+        segment_threshold=0,
+        segments=DEFAULT_SEGMENTS,
+    ):
+        # pylint: disable=too-many-arguments
+        self.endpoint = endpoint
+        self.api_timeout = api_timeout
+        self.max_retries = max_retries
+        self.session = get_session(endpoint, pool_size, max_retries)
+        self.segment_threshold = segment_threshold
+        self.segments = segments
+
+    def _request(
+        self,
+        image_path,
+        subpath,
+        extra_headers=None,
+        stream=False,
+        method="GET",
+        _reauthorized=False,
+        _token=None,
+    ):
+        if not extra_headers:
+            extra_headers = {}
+
+        headers = {"content-type": "application/json"}
+        headers.update(extra_headers)
+
+        token = _token or self._cached_token(image_path)
+        if token:
+            headers["Authorization"] = "Bearer {}".format(token)
+
+        url = urljoin(self.endpoint, "v2", image_path, subpath)
+        response = self.session.request(
+            method,
+            url,
+            headers=headers,
+            stream=stream,
+            timeout=self.api_timeout,
+        )
+
+        if (
+            response.status_code == requests.codes["unauthorized"]
+            and not _reauthorized
+        ):
+            # This request requires (re)authorization. See:
+            # https://docs.docker.com/registry/spec/auth/token/
+            auth_challenge = response.headers["Www-Authenticate"]
+            auth_vars = parse_bearer_authorization_challenge(auth_challenge)
+            with _TOKENS_LOCK:
+                _CHALLENGES[self.endpoint] = (
+                    auth_vars["realm"],
+                    auth_vars["service"],
+                )
+                _SCOPES[(self.endpoint, image_path)] = auth_vars["scope"]
+            token = self._auth(
+                auth_vars["realm"], auth_vars["service"], auth_vars["scope"]
+            )
+            return self._request(
+                image_path,
+                subpath,
+                extra_headers=extra_headers,
+                stream=stream,
+                method=method,
+                _reauthorized=True,
+                _token=token,
+            )
+        else:
+            response.raise_for_status()
+
+            return response
+
+    # Get a valid token for requests about the given image, if we know this
+    # registry requires one.
+    #
+    # Once a registry has challenged us, we know where to get tokens from, so
+    # we request them up front for other images rather than waiting for
+    # another challenge.
+    def _cached_token(self, image_path):
+        with _TOKENS_LOCK:
+            challenge = _CHALLENGES.get(self.endpoint)
+            if challenge is None:
+                return None
+            realm, service = challenge
+            scope = _SCOPES.get(
+                (self.endpoint, image_path),
+                "repository:{}:pull".format(image_path),
+            )
+            token, expiry = _TOKENS.get((realm, service, scope), (None, 0))
+
+        if token and expiry > time.time():
+            return token
+        return self._auth(realm, service, scope)
+
+    def _auth(self, realm, service, scope):
+        # Respond to an Www-Authenticate challenge by requesting the necessary
+        # token from the 'realm' (endpoint) that we were given in the challenge.
+        request_url = "{}?service={}&scope={}".format(realm, service, scope)
+        requested_at = time.time()
+        response = self.session.get(request_url, timeout=self.api_timeout)
+        response.raise_for_status()
+        auth = response.json()
+        token = auth.get("token") or auth["access_token"]
+
+        # Tokens are valid for 60 seconds unless the server says otherwise,
+        # counting from when the server issued them. If our clocks disagree
+        # by more than that, count from when we asked for the token instead.
+        expires_in = auth.get("expires_in", 60)
+        issued_at = parse_timestamp(auth.get("issued_at"))
+        if issued_at is None or not (
+            requested_at - expires_in < issued_at < requested_at
+        ):
+            issued_at = requested_at
+        expiry = issued_at + expires_in - _TOKEN_EXPIRY_MARGIN
+
+        with _TOKENS_LOCK:
+            _TOKENS[(realm, service, scope)] = (token, expiry)
+        return token
+
+    # digest():
+    #
+    # Calculate a Docker-compatible digest of an arbitrary string of bytes.
+    #
+    # Args:
+    #    content (bytes): Content to hash
+    #
+    # Returns:
+    #    (str) A Docker-compatible digest of 'content'
+    @staticmethod
+    def digest(content):
+        digest_hash = hashlib.sha256()
+        digest_hash.update(content)
+        return "sha256:" + digest_hash.hexdigest()
+
+    # manifest():
+    #
+    # Fetches the image manifest for a given image from the remote registry.
+    #
+    # If this is a "fat" (multiplatform) image, the 'artitecture' and 'os'
+    # parameters control which of the available images is chosen.
+    #
+    # The manifest is returned verbatim, so you need to parse it yourself
+    # with json.loads() to get at its contents. The verbatim text can be used
+    # to recalculate the content digest, just encode it and pass to .digest().
+    # If we returned only the parsed JSON data you wouldn't be able to do this.
+    #
+    # Args:
+    #    image_path (str): Relative path to the image, e.g. library/alpine
+    #    reference (str): Either a tag name (such as 'latest') or the content
+    #                     digest of an exact version of the image.
+    #    architecture (str): Architecture name (amd64, arm64, etc.)
+    #    os_ (str): OS name (e.g. linux)
+    #
+    # Raises:
+    #    requests.RequestException, if network errors occur
+    #
+    # Returns:
+    #    (str, str): A tuple of the manifest content as text, and its content hash
+    def manifest(
+        self,
+        image_path,
+        reference,
+        architecture=default_architecture(),
+        os_=default_os(),
+    ):
+        response = self._request(
+            image_path,
+            urljoin("manifests", urllib.parse.quote(reference)),
+            extra_headers={"Accept": ",".join(_MANIFEST_TYPES)},
+        )
+        manifest, digest = self._parse_manifest(
+            response.text, response.headers.get("Docker-Content-Digest")
+        )
+
+        if manifest_media_type(manifest) in _INDEX_TYPES:
+            # This is a "fat manifest", we need to narrow down to a specific
+            # architecture.
+            return self.manifest(
+                image_path,
+                self._select_platform(
+                    manifest, response.text, architecture, os_
+                ),
+                architecture=architecture,
+                os_=os_,
+            )
+        else:
+            return response.text, digest
+
+    # manifest_digest():
+    #
+    # Find the content digest of the image manifest that a tag refers to,
+    # downloading as little as possible. This is the same digest that
+    # manifest() returns, and is meant for tracking.
+    #
+    # A HEAD request tells us the digest of what the tag refers to. If that
+    # is an image manifest, we are done. If it is a "fat" manifest, it is
+    # only downloaded if it is not in 'cache_dir' already.
+    #
+    # For registries which do not send digests in response to HEAD requests,
+    # the manifest is requested with a conditional GET instead, so that it
+    # is only downloaded again if the tag changed since we last saw it.
+    #
+    # Args:
+    #    image_path (str): Relative path to the image, e.g. library/alpine
+    #    reference (str): A tag name, such as 'latest'
+    #    architecture (str): Architecture name (amd64, arm64, etc.)
+    #    os_ (str): OS name (e.g. linux)
+    #    cache_dir (str): Directory where manifests are cached
+    #
+    # Raises:
+    #    requests.RequestException, if network errors occur
+    #
+    # Returns:
+    #    (str): The content hash of the image manifest
+    def manifest_digest(
+        self,
+        image_path,
+        reference,
+        cache_dir,
+        architecture=default_architecture(),
+        os_=default_os(),
+    ):
+        manifest_subpath = urljoin("manifests", urllib.parse.quote(reference))
+        accept = {"Accept": ",".join(_MANIFEST_TYPES)}
+
+        response = self._request(
+            image_path, manifest_subpath, extra_headers=accept, method="HEAD"
+        )
+        digest = response.headers.get("Docker-Content-Digest")
+        media_type = response.headers.get("Content-Type", "").split(";")[0]
+
+        if digest and media_type in _IMAGE_MANIFEST_TYPES:
+            return digest
+
+        text = (
+            self._load_cached_manifest(cache_dir, digest) if digest else None
+        )
+        if text is None:
+            text, digest = self._get_manifest_conditionally(
+                image_path, manifest_subpath, cache_dir
+            )
+
+        manifest, _ = self._parse_manifest(text, digest)
+        if manifest_media_type(manifest) in _INDEX_TYPES:
+            return self._select_platform(manifest, text, architecture, os_)
+        else:
+            return digest
+
+    # GET a manifest, unless the tag still refers to the manifest we saw
+    # last time, as identified by its ETag. Returns the manifest as text and
+    # its digest.
+    def _get_manifest_conditionally(
+        self, image_path, manifest_subpath, cache_dir
+    ):
+        tag_record_path = os.path.join(
+            cache_dir,
+            "tags",
+            self.digest(
+                urljoin(self.endpoint, image_path, manifest_subpath).encode(
+                    "utf-8"
+                )
+            )
+            + ".json",
+        )
+        try:
+            with open(tag_record_path) as f:
+                tag_record = json.load(f)
+        except (OSError, ValueError):
+            tag_record = {}
+
+        cached_text = None
+        headers = {"Accept": ",".join(_MANIFEST_TYPES)}
+        if tag_record.get("etag"):
+            cached_text = self._load_cached_manifest(
+                cache_dir, tag_record["digest"]
+            )
+            if cached_text is not None:
+                headers["If-None-Match"] = tag_record["etag"]
+
+        response = self._request(
+            image_path, manifest_subpath, extra_headers=headers
+        )
+        if response.status_code == requests.codes["not_modified"]:
+            return cached_text, tag_record["digest"]
+
+        _, digest = self._parse_manifest(
+            response.text, response.headers.get("Docker-Content-Digest")
+        )
+        self._save_cached_manifest(cache_dir, digest, response.text)
+
+        os.makedirs(os.path.dirname(tag_record_path), exist_ok=True)
+        with save_file_atomic(tag_record_path, "w") as f:
+            json.dump(
+                {"digest": digest, "etag": response.headers.get("ETag")}, f
+            )
+
+        return response.text, digest
+
+    # Manifests are cached by digest, in the same way DockerSource keeps
+    # them in its mirror directory.
+    def _load_cached_manifest(self, cache_dir, digest):
+        try:
+            with open(
+                os.path.join(cache_dir, digest + ".manifest.json"), "rb"
+            ) as f:
+                content = f.read()
+        except OSError:
+            return None
+        if self.digest(content) != digest:
+            return None
+        return content.decode("utf-8")
+
+    @staticmethod
+    def _save_cached_manifest(cache_dir, digest, text):
+        manifest_file = os.path.join(cache_dir, digest + ".manifest.json")
+        with save_file_atomic(manifest_file, "wb") as f:
+            f.write(text.encode("utf-8"))
+
+    # Parse and validate a manifest, checking it against the digest the
+    # registry gave for it. Returns the parsed manifest and its digest.
+    def _parse_manifest(self, text, their_digest):
+        try:
+            manifest = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise DockerManifestError(
+                "Server did not return a valid manifest: {}".format(e),
+                manifest=text,
+            ) from e
+
+        schema_version = manifest.get("schemaVersion")
+        if schema_version == 1:
+            raise DockerManifestError(
+                "Schema version 1 is unsupported.", manifest=text
+            )
+        elif schema_version is None:
+            raise DockerManifestError(
+                "Manifest did not include the schemaVersion key.",
+                manifest=text,
+            )
+
+        our_digest = self.digest(text.encode("utf8"))
+
+        if not their_digest:
+            raise DockerManifestError(
+                "Server did not set the Docker-Content-Digest header.",
+                manifest=text,
+            )
+        if our_digest != their_digest:
+            raise DockerManifestError(
+                "Server returned a non-matching content digest. "
+                "Our digest: {}, their digest: {}".format(
+                    our_digest, their_digest
+                ),
+                manifest=text,
+            )
+
+        if manifest_media_type(manifest) not in _MANIFEST_TYPES:
+            raise DockerManifestError(
+                "Unsupported manifest type {}".format(
+                    manifest_media_type(manifest)
+                ),
+                manifest=text,
+            )
+
+        return manifest, our_digest
+
+    # Pick the digest of the image for the given platform out of a "fat"
+    # manifest.
+    @staticmethod
+    def _select_platform(manifest, text, architecture, os_):
+        for sub in manifest["manifests"]:
+            if (
+                sub["platform"]["architecture"] == architecture
+                and sub["platform"]["os"] == os_
+            ):
+                return sub["digest"]
+
+        raise DockerManifestError(
+            "No images found for architecture {}, OS {}".format(
+                architecture, os_
+            ),
+            manifest=text,
+        )
+
+    # blob():
+    #
+    # Fetch a blob from the remote registry. This is used for getting each
+    # layer of an image.
+    #
+    # The blob is first downloaded to 'partial_path', which is kept if the
+    # download is interrupted. A later call with the same 'partial_path'
+    # resumes the download with a Range request, or starts again from the
+    # beginning if the registry does not support ranges.
+    #
+    # The content hash of the blob is calculated while it is downloaded, and
+    # the file is only moved to 'download_to' if it matches 'blob_digest'.
+    #
+    # Blobs of at least 'segment_threshold' bytes, according to 'size', are
+    # split into several segments which are downloaded concurrently with
+    # Range requests, and only hashed once complete. If the registry does not
+    # support ranges, they are downloaded like any other blob.
+    #
+    # If 'lock_path' is given, the lock file is held while downloading, so
+    # that several processes needing the same blob only download it once.
+    # Processes which had to wait for the lock find 'download_to' existing,
+    # and return without downloading anything.
+    #
+    # Raises:
+    #    requests.RequestException, if network errors occur
+    #    SourceError, if the downloaded content does not match 'blob_digest'
+    #
+    # Args:
+    #    image_path (str): Relative path to the image, e.g. library/alpine
+    #    blob_digest (str): Content hash of the blob.
+    #    download_to (str): Path to a file where the content will be written.
+    #    partial_path (str): Path where the incomplete download is kept,
+    #                        defaults to 'download_to' with a .partial suffix.
+    #    lock_path (str): Path to a lock file for the blob, or None
+    #    size (int): Size of the blob according to the manifest, or None
+    #
+    # Returns:
+    #    (bool): True if the blob was downloaded, False if 'download_to'
+    #            already existed once the lock was acquired. The caller is
+    #            responsible for verifying the content of an existing blob.
+    #
+    def blob(
+        self,
+        image_path,
+        blob_digest,
+        download_to,
+        *,
+        partial_path=None,
+        lock_path=None,
+        size=None,
+    ):
+        # pylint: disable=too-many-arguments
+        method = blob_digest.split(":")[0]
+        if method != "sha256":
+            raise SourceError("Unsupported digest method: {}".format(method))
+
+        if partial_path is None:
+            partial_path = download_to + ".partial"
+
+        if lock_path is None:
+            self._download_blob_with_retries(
+                image_path, blob_digest, partial_path, size
+            )
+            move_atomic(partial_path, download_to)
+            return True
+
+        with locked(lock_path):
+            if os.path.exists(download_to):
+                return False
+            self._download_blob_with_retries(
+                image_path, blob_digest, partial_path, size
+            )
+            move_atomic(partial_path, download_to)
+            return True
+
+    # Connections which break in the middle of a blob are not retried by
+    # the session, retry them here, resuming from what we downloaded so far.
+    # Requests which fail before the registry answers have been retried by
+    # the session already, so they are not retried again.
+    def _download_blob_with_retries(
+        self, image_path, blob_digest, partial_path, size
+    ):
+        attempt = 0
+        while True:
+            try:
+                self._download_blob(
+                    image_path, blob_digest, partial_path, size
+                )
+                return
+            except _DownloadInterrupted as e:
+                if attempt >= self.max_retries:
+                    raise e.error from e
+                time.sleep(backoff_time(_BACKOFF_FACTOR * 2**attempt))
+                attempt += 1
+
+    # Download and verify a blob, leaving it at 'partial_path'
+    def _download_blob(self, image_path, blob_digest, partial_path, size):
+        blob_subpath = urljoin("blobs", urllib.parse.quote(blob_digest))
+
+        if (
+            self.segment_threshold
+            and self.segments > 1
+            and size
+            and size >= self.segment_threshold
+            # Interrupted downloads are resumed from where they stopped
+            and not os.path.exists(partial_path)
+        ):
+            if self._download_segments(
+                image_path, blob_subpath, partial_path, size
+            ):
+                self._verify_partial_blob(partial_path, blob_digest)
+                return
+
+        digest_hash = hashlib.sha256()
+        offset = self._hash_partial_blob(partial_path, digest_hash)
+        response = self._request_blob_range(image_path, blob_subpath, offset)
+
+        if offset and not self._is_range_response(response, offset):
+            # The registry did not honour our Range header, start over.
+            if response.status_code == requests.codes["partial_content"]:
+                response.close()
+                response = self._request(image_path, blob_subpath, stream=True)
+            offset = 0
+            digest_hash = hashlib.sha256()
+
+        with open(partial_path, "ab" if offset else "wb") as f:
+            for chunk in _iter_blob_content(response):
+                digest_hash.update(chunk)
+                f.write(chunk)
+
+        self._verify_partial_blob(
+            partial_path, blob_digest, "sha256:" + digest_hash.hexdigest()
+        )
+
+    @staticmethod
+    def _verify_partial_blob(partial_path, blob_digest, our_digest=None):
+        if our_digest is None:
+            our_digest = "sha256:" + sha256sum(partial_path)
+        if our_digest != blob_digest:
+            os.remove(partial_path)
+            raise SourceError(
+                "Blob {} is corrupt; got content hash of {}.".format(
+                    blob_digest, our_digest
+                )
+            )
+
+    # _download_segments():
+    #
+    # Download a blob as several segments concurrently, each written at its
+    # offset of a preallocated file.
+    #
+    # The segments of an interrupted download can not be resumed, so
+    # 'partial_path' is removed unless the download succeeds.
+    #
+    # Returns:
+    #    (bool): False if the registry does not support Range requests
+    #
+    def _download_segments(self, image_path, blob_subpath, partial_path, size):
+        segment_size = -(-size // self.segments)
+        segments = [
+            (start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)
+        ]
+
+        try:
+            with open(partial_path, "wb") as f:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except (AttributeError, OSError):
+                    # Not supported by the platform or filesystem
+                    f.truncate(size)
+
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(segments)
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            self._download_segment,
+                            image_path,
+                            blob_subpath,
+                            f.fileno(),
+                            segment,
+                        )
+                        for segment in segments
+                    ]
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+        except _RangeNotSatisfied:
+            os.remove(partial_path)
+            return False
+        except BaseException:
+            os.remove(partial_path)
+            raise
+
+        return True
+
+    def _download_segment(self, image_path, blob_subpath, fd, segment):
+        start, end = segment
+        response = self._request(
+            image_path,
+            blob_subpath,
+            extra_headers={"Range": "bytes={}-{}".format(start, end)},
+            stream=True,
+        )
+        with response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status_code != requests.codes[
+                "partial_content"
+            ] or not content_range.startswith(
+                "bytes {}-{}/".format(start, end)
+            ):
+                raise _RangeNotSatisfied()
+
+            offset = start
+            for chunk in _iter_blob_content(response):
+                if offset + len(chunk) > end + 1:
+                    raise SourceError(
+                        "Registry sent more data than requested for blob "
+                        "segment {}-{}".format(start, end)
+                    )
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            raise _DownloadInterrupted(
+                requests.exceptions.ChunkedEncodingError(
+                    "Blob segment {}-{} ended after {} bytes".format(
+                        start, end, offset - start
+                    )
+                )
+            )
+
+    # Feed the content of an interrupted download to 'digest_hash', and
+    # return how many bytes of the blob we already have.
+    @staticmethod
+    def _hash_partial_blob(partial_path, digest_hash):
+        try:
+            with open(partial_path, "rb") as f:
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                    digest_hash.update(chunk)
+                return f.tell()
+        except FileNotFoundError:
+            return 0
+
+    def _request_blob_range(self, image_path, blob_subpath, offset):
+        if not offset:
+            return self._request(image_path, blob_subpath, stream=True)
+
+        try:
+            return self._request(
+                image_path,
+                blob_subpath,
+                extra_headers={"Range": "bytes={}-".format(offset)},
+                stream=True,
+            )
+        except requests.HTTPError as e:
+            # Our partial download is not a prefix of the blob, download all
+            # of it again.
+            if (
+                e.response is not None
+                and e.response.status_code
+                == requests.codes["requested_range_not_satisfiable"]
+            ):
+                return self._request(image_path, blob_subpath, stream=True)
+            raise
+
+    @staticmethod
+    def _is_range_response(response, offset):
+        if response.status_code != requests.codes["partial_content"]:
+            return False
+        content_range = response.headers.get("Content-Range", "")
+        return content_range.startswith("bytes {}-".format(offset))
@@ -0,0 +1,86 @@
+#  Copyright (C) 2026 BuildStream Developers
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 2 of the License, or (at your option) any later version.
+#
+#  This library is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public
+#  License along with this library. If not, see <http://www.gnu.org/licenses/>.
+
+# An index of the blobs of a source mirror which were verified, so that they
+# are not hashed again every time they are checked or staged.
+#
+# A blob is trusted as long as its size, mtime, ctime and inode did not change
+# since it was verified. Unlike the mtime, the ctime cannot be set from
+# userspace, so a blob rewritten in place is never trusted, even if its mtime
+# was reset. Hard linking a blob also changes its ctime, so blobs shared
+# through a blob store are hashed again once after being linked elsewhere.
+#
+# The index has one small file per blob, rather than a single file for all of
+# them, so that parallel fetch and stage jobs sharing the mirror directory
+# never overwrite each other's records.
+
+import json
+import os
+
+from buildstream.utils import save_file_atomic
+
+
+class VerifiedBlobs:
+    def __init__(self, directory):
+        self.directory = directory
+
+    # is_verified():
+    #
+    # Args:
+    #    path (str): Path to the blob
+    #    digest (str): Digest of the blob
+    #
+    # Returns:
+    #    (bool): Whether the blob was verified and did not change since
+    #
+    # Raises:
+    #    FileNotFoundError, if the blob was verified but does not exist
+    #
+    def is_verified(self, path, digest):
+        try:
+            with open(self._record_path(digest)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return record == _record(path, digest)
+
+    # add():
+    #
+    # Record that a blob was verified.
+    #
+    # Args:
+    #    path (str): Path to the verified blob
+    #    digest (str): Digest of the blob
+    #
+    def add(self, path, digest):
+        record_path = self._record_path(digest)
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        record = _record(path, digest)
+        with save_file_atomic(record_path, "w") as f:
+            json.dump(record, f)
+
+    def _record_path(self, digest):
+        return os.path.join(self.directory, digest + ".json")
+
+
+def _record(path, digest):
+    blob_stat = os.stat(path)
+    return {
+        "digest": digest,
+        "size": blob_stat.st_size,
+        "mtime": blob_stat.st_mtime_ns,
+        "ctime": blob_stat.st_ctime_ns,
+        "inode": blob_stat.st_ino,
+    }
@@ -32,6 +32,18 @@ docker - stage files from Docker images
    # Specify the registry endpoint, defaults to Docker Hub (optional)
    registry-url: https://registry.hub.docker.com
 
+   # Other endpoints to get the image from, such as pull-through caches of
+   # the registry, tried in order before 'registry-url'. If one of them does
+   # not have the image or fails, the next one is used. Content from every
+   # endpoint is verified against the image's digests (optional)
+   #registry-mirrors:
+   #- https://docker-cache.example.com
+
+   # Set to "latency" to try the endpoints which respond the fastest first,
+   # as measured once by every BuildStream process, rather than in order
+   # (optional)
+   mirror-selection: ordered
+
    # Image path (required)
    image: library/alpine
 
@@ -41,6 +53,16 @@ docker - stage files from Docker images
    # Specify the digest of the exact image to use (required)
    ref: 6c9f6f68a131ec6381da82f2bff978083ed7f4f7991d931bfa767b7965ebc94b
 
+   # Only stage the paths of the image matching these shell-style glob
+   # patterns, and none of those matching the exclude patterns. Patterns
+   # are matched one path component at a time, so '*' never matches a '/',
+   # and a pattern matching a directory also matches everything in it.
+   # Everything is staged by default (optional)
+   #include:
+   #- /usr/lib/python3*
+   #exclude:
+   #- /usr/lib/python3*/test
+
    # Some images are built for multiple platforms. When tracking a tag, we
    # will choose which image to use based on these settings. Default values
    # are chosen based on the output of `uname -m` and `uname -s`, but you
@@ -48,305 +70,130 @@ docker - stage files from Docker images
    #architecture: arm64
    #os: linux
 
+   # Maximum number of layers to download concurrently (optional)
+   max-parallel-downloads: 4
+
+   # Layers of at least this size are downloaded as several parts
+   # concurrently, if the registry supports range requests. Parts are
+   # downloaded on connections of their own, so consider raising
+   # 'connection-pool-size' too. Disabled by default (optional)
+   #segmented-download-threshold: 512M
+   #segmented-download-parts: 4
+
+   # Number of connections to keep open to each registry host, and how many
+   # times to retry requests that fail to connect, get a transient server
+   # error or are rate limited, or whose connection breaks in the middle of
+   # a layer. Retries wait for an exponentially growing, jittered delay, or
+   # as long as the registry asks with a Retry-After header (optional)
+   connection-pool-size: 10
+   max-retries: 3
+
+   # Seconds to wait for connections to registries to be established, and
+   # for data once connected (optional)
+   connect-timeout: 5
+   read-timeout: 30
+
+   # Layers are hashed once when they are downloaded, and then trusted as
+   # long as the files in the source mirror are not modified. Enable this to
+   # hash every layer again whenever it is checked or staged (optional)
+   strict-verification: False
+
+   # Number of worker processes used to decompress and extract layers when
+   # staging, by default layers are extracted one at a time (optional)
+   max-parallel-extractions: 1
+
+   # Maximum disk space used by a cache of extracted layers, shared by all
+   # docker sources. Staging an image whose layers are in the cache only
+   # hard links files from it. Every source trims the cache down to its own
+   # maximum after staging, so the value of the last source staged wins: set
+   # it for all docker sources in the `sources` section of project.conf
+   # rather than in individual elements. The cache is disabled by default
+   # (optional)
+   #layer-cache-size: 20G
+
+   # Directory of a content-addressed blob store shared by all docker
+   # sources, and by every user of the build host that can write to it.
+   # Layers found in the store are hard linked from it instead of being
+   # downloaded, and downloaded layers are added to it. It must be on the
+   # same filesystem as the BuildStream source cache (optional)
+   #blob-store: /srv/buildstream/docker-blobs
+
+   # File to append metrics of every fetch and stage to, as one JSON object
+   # per line. The same metrics are always written to the BuildStream log
+   # (optional)
+   #metrics-file: ~/docker-source-metrics.jsonl
+
+Both Docker and OCI images are supported, with layers which are plain
+tarballs or compressed with gzip or zstd. Extracting zstd compressed layers
+requires the `zstandard <https://pypi.org/project/zstandard/>`_ Python
+package.
+
+Layers whose download was interrupted are kept in the source mirror and
+resumed by the next fetch, if the registry supports range requests.
+
+For each layer, the metrics of a fetch are where the layer came from, the
+number of bytes downloaded, and the time spent downloading and verifying it.
+The metrics of staging are the time spent verifying, decompressing,
+extracting and linking the layer, and the number of members extracted,
+whiteouts applied and members hidden by upper layers.
+
 Note that Docker images may contain device nodes. BuildStream elements cannot
 contain device nodes so those will be dropped. Any regular files in the /dev
 directory will also be dropped.
 """
 
-import hashlib
+import concurrent.futures
+import contextlib
 import json
+import multiprocessing
 import os
-import platform
-import shutil
 import tarfile
-import urllib.parse
+import time
 
 import requests
 
 from buildstream import Source, SourceError
 from buildstream.utils import (
+    UtilError,
     save_file_atomic,
     sha256sum,
     link_files,
     move_atomic,
 )
 
-_DOCKER_HUB_URL = "https://registry.hub.docker.com"
-
-
-def parse_bearer_authorization_challenge(text):
-    # Hand-written and probably broken parsing of the Www-Authenticate
-    # response. I can't find a built-in way to parse this, but I probably
-    # didn't look hard enough.
-    if not text.startswith("Bearer "):
-        raise SourceError(
-            "Unexpected Www-Authenticate response: %{}".format(text)
-        )
-
-    pairs = {}
-    text = text[len("Bearer ") :]
-    for pair in text.split(","):
-        key, value = pair.split("=")
-        pairs[key] = value[1:-1]
-    return pairs
-
-
-def default_architecture():
-    machine = platform.machine()
-    if machine == "x86_64":
-        return "amd64"
-    elif machine == "aarch64":
-        return "arm64"
-    else:
-        return machine
-
-
-def default_os():
-    return platform.system().lower()
-
-
-# Variant of urllib.parse.urljoin() allowing multiple path components at once.
-def urljoin(url, *args):
-    for arg in args:
-        if not url.endswith("/"):
-            url += "/"
-        url = urllib.parse.urljoin(url, arg.lstrip("/"))
-    return url
-
-
-# DockerManifestError
-#
-# Raised if something goes wrong while querying an image manifest from a remote
-# registry.
-#
-class DockerManifestError(SourceError):
-    def __init__(self, message, manifest=None):
-        super().__init__(message)
-        self.manifest = manifest
-
-
-class DockerRegistryV2Client:
-    def __init__(self, endpoint, api_timeout=3):
-        self.endpoint = endpoint
-        self.api_timeout = api_timeout
-
-        self.token = None
-
-    def _request(
-        self, subpath, extra_headers=None, stream=False, _reauthorized=False
-    ):
-        if not extra_headers:
-            extra_headers = {}
-
-        headers = {"content-type": "application/json"}
-        headers.update(extra_headers)
-
-        if self.token:
-            headers["Authorization"] = "Bearer {}".format(self.token)
-
-        url = urljoin(self.endpoint, "v2", subpath)
-        response = requests.get(
-            url, headers=headers, stream=stream, timeout=self.api_timeout
-        )
-
-        if (
-            response.status_code == requests.codes["unauthorized"]
-            and not _reauthorized
-        ):
-            # This request requires (re)authorization. See:
-            # https://docs.docker.com/registry/spec/auth/token/
-            auth_challenge = response.headers["Www-Authenticate"]
-            auth_vars = parse_bearer_authorization_challenge(auth_challenge)
-            self._auth(
-                auth_vars["realm"], auth_vars["service"], auth_vars["scope"]
-            )
-            return self._request(
-                subpath, extra_headers=extra_headers, _reauthorized=True
-            )
-        else:
-            response.raise_for_status()
-
-            return response
-
-    def _auth(self, realm, service, scope):
-        # Respond to an Www-Authenticate challenge by requesting the necessary
-        # token from the 'realm' (endpoint) that we were given in the challenge.
-        request_url = "{}?service={}&scope={}".format(realm, service, scope)
-        response = requests.get(request_url, timeout=self.api_timeout)
-        response.raise_for_status()
-        self.token = response.json()["token"]
-
-    # digest():
-    #
-    # Calculate a Docker-compatible digest of an arbitrary string of bytes.
-    #
-    # Args:
-    #    content (bytes): Content to hash
-    #
-    # Returns:
-    #    (str) A Docker-compatible digest of 'content'
-    @staticmethod
-    def digest(content):
-        digest_hash = hashlib.sha256()
-        digest_hash.update(content)
-        return "sha256:" + digest_hash.hexdigest()
-
-    # manifest():
-    #
-    # Fetches the image manifest for a given image from the remote registry.
-    #
-    # If this is a "fat" (multiplatform) image, the 'artitecture' and 'os'
-    # parameters control which of the available images is chosen.
-    #
-    # The manifest is returned verbatim, so you need to parse it yourself
-    # with json.loads() to get at its contents. The verbatim text can be used
-    # to recalculate the content digest, just encode it and pass to .digest().
-    # If we returned only the parsed JSON data you wouldn't be able to do this.
-    #
-    # Args:
-    #    image_path (str): Relative path to the image, e.g. library/alpine
-    #    reference (str): Either a tag name (such as 'latest') or the content
-    #                     digest of an exact version of the image.
-    #    architecture (str): Architecture name (amd64, arm64, etc.)
-    #    os_ (str): OS name (e.g. linux)
-    #
-    # Raises:
-    #    requests.RequestException, if network errors occur
-    #
-    # Returns:
-    #    (str, str): A tuple of the manifest content as text, and its content hash
-    def manifest(
-        self,
-        image_path,
-        reference,
-        architecture=default_architecture(),
-        os_=default_os(),
-    ):
-        # pylint: disable=too-many-locals
-
-        accept_types = [
-            "application/vnd.docker.distribution.manifest.v2+json",
-            "application/vnd.docker.distribution.manifest.list.v2+json",
-        ]
-
-        manifest_url = urljoin(
-            image_path, "manifests", urllib.parse.quote(reference)
-        )
-        response = self._request(
-            manifest_url, extra_headers={"Accept": ",".join(accept_types)}
-        )
-
-        try:
-            manifest = json.loads(response.text)
-        except json.JSONDecodeError as e:
-            raise DockerManifestError(
-                "Server did not return a valid manifest: {}".format(e),
-                manifest=response.text,
-            ) from e
-
-        schema_version = manifest.get("schemaVersion")
-        if schema_version == 1:
-            raise DockerManifestError(
-                "Schema version 1 is unsupported.", manifest=response.text
-            )
-        elif schema_version is None:
-            raise DockerManifestError(
-                "Manifest did not include the schemaVersion key.",
-                manifest=response.text,
-            )
-
-        our_digest = self.digest(response.text.encode("utf8"))
-        their_digest = response.headers.get("Docker-Content-Digest")
-
-        if not their_digest:
-            raise DockerManifestError(
-                "Server did not set the Docker-Content-Digest header.",
-                manifest=response.text,
-            )
-        if our_digest != their_digest:
-            raise DockerManifestError(
-                "Server returned a non-matching content digest. "
-                "Our digest: {}, their digest: {}".format(
-                    our_digest, their_digest
-                ),
-                manifest=response.text,
-            )
-
-        if (
-            manifest["mediaType"]
-            == "application/vnd.docker.distribution.manifest.list.v2+json"
-        ):
-            # This is a "fat manifest", we need to narrow down to a specific
-            # architecture.
-            for sub in manifest["manifests"]:
-                if (
-                    sub["platform"]["architecture"] == architecture
-                    and sub["platform"]["os"]
-                ):
-                    sub_digest = sub["digest"]
-                    return self.manifest(
-                        image_path,
-                        sub_digest,
-                        architecture=architecture,
-                        os_=os_,
-                    )
-                else:
-                    raise DockerManifestError(
-                        "No images found for architecture {}, OS {}".format(
-                            architecture, os_
-                        ),
-                        manifest=response.text,
-                    )
-        elif (
-            manifest["mediaType"]
-            == "application/vnd.docker.distribution.manifest.v2+json"
-        ):
-            return response.text, our_digest
-        else:
-            raise DockerManifestError(
-                "Unsupported manifest type {}".format(manifest["mediaType"]),
-                manifest=response.text,
-            )
-
-    # blob():
-    #
-    # Fetch a blob from the remote registry. This is used for getting each
-    # layer of an image in tar.gz format.
-    #
-    # Raises:
-    #    requests.RequestException, if network errors occur
-    #
-    # Args:
-    #    image_path (str): Relative path to the image, e.g. library/alpine
-    #    blob_digest (str): Content hash of the blob.
-    #    download_to (str): Path to a file where the content will be written.
-    def blob(self, image_path, blob_digest, download_to):
-        blob_url = urljoin(
-            image_path, "blobs", urllib.parse.quote(blob_digest)
-        )
-
-        response = self._request(blob_url, stream=True)
-
-        with save_file_atomic(download_to, "wb") as f:
-            shutil.copyfileobj(response.raw, f)
-
-
-class ReadableTarInfo(tarfile.TarInfo):
-    """
-    The goal is to override`TarFile`'s `extractall` semantics by ensuring that on extraction, the
-    files are readable by the owner of the file. This is done by over-riding the accessor for the
-    mode` attribute in `TarInfo`, class that encapsulates the internal meta-data of the tarball,
-    so that the owner-read bit is always set.
-    """
-
-    @property
-    def mode(self):
-        # ensure file is readable by owner
-        return self.__permission | 0o400
+from bst_plugins_container._utils import parse_size
+from bst_plugins_container.sources._docker_blob_store import BlobStore
+from bst_plugins_container.sources._docker_fetch import LayerFetcher
+from bst_plugins_container.sources._docker_layer_cache import LayerCache
+from bst_plugins_container.sources._docker_layers import (
+    LAYER_MEDIA_TYPES,
+    PathFilter,
+    extract_layers,
+    link_layer,
+    plan_merge,
+)
+from bst_plugins_container.sources._docker_metrics import (
+    format_metrics,
+    write_metrics,
+)
+from bst_plugins_container.sources._docker_mirrors import (
+    DockerRegistryMirrors,
+)
+from bst_plugins_container.sources._docker_registry import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_CONNECTION_POOL_SIZE,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_SEGMENTS,
+    DockerManifestError,
+    DockerRegistryV2Client,
+    default_architecture,
+    default_os,
+)
+from bst_plugins_container.sources._docker_verified import VerifiedBlobs
 
-    @mode.setter
-    def mode(self, permission):
-        self.__permission = permission
+_DOCKER_HUB_URL = "https://registry.hub.docker.com"
+_DEFAULT_MAX_PARALLEL_DOWNLOADS = 4
 
 
 class DockerSource(Source):
@@ -375,7 +222,31 @@ class DockerSource(Source):
         # url is deprecated, but accept it as a valid key so that we can raise
         # a nicer warning.
         node.validate_keys(
-            ["registry-url", "image", "ref", "track", "url"]
+            [
+                "registry-url",
+                "registry-mirrors",
+                "mirror-selection",
+                "image",
+                "ref",
+                "track",
+                "url",
+                "architecture",
+                "os",
+                "max-parallel-downloads",
+                "connection-pool-size",
+                "max-retries",
+                "connect-timeout",
+                "read-timeout",
+                "strict-verification",
+                "max-parallel-extractions",
+                "blob-store",
+                "layer-cache-size",
+                "segmented-download-threshold",
+                "segmented-download-parts",
+                "metrics-file",
+                "include",
+                "exclude",
+            ]
             + Source.COMMON_CONFIG_KEYS
         )
 
@@ -390,6 +261,10 @@ class DockerSource(Source):
             "registry-url", _DOCKER_HUB_URL
         )
         self.registry_url = self.translate_url(self.original_registry_url)
+        self.registry_mirrors = [
+            self.translate_url(url)
+            for url in node.get_str_list("registry-mirrors", [])
+        ]
 
         if "ref" in node:
             self.digest = self._ref_to_digest(node.get_str("ref"))
@@ -397,6 +272,13 @@ class DockerSource(Source):
             self.digest = None
         self.tag = node.get_str("track", "") or None
 
+        self.include = self._get_patterns(node, "include")
+        self.exclude = self._get_patterns(node, "exclude")
+        if self.include or self.exclude:
+            self.path_filter = PathFilter(self.include, self.exclude)
+        else:
+            self.path_filter = None
+
         self.architecture = (
             node.get_str("architecture", "") or default_architecture()
         )
@@ -409,15 +291,118 @@ class DockerSource(Source):
                 )
             )
 
-        self.client = DockerRegistryV2Client(self.registry_url)
+        self.max_parallel_downloads = self._get_int(
+            node, "max-parallel-downloads", _DEFAULT_MAX_PARALLEL_DOWNLOADS
+        )
+
+        self.strict_verification = node.get_bool("strict-verification", False)
+
+        self.max_parallel_extractions = self._get_int(
+            node, "max-parallel-extractions", 1
+        )
+
+        blob_store = node.get_str("blob-store", None)
+        if blob_store:
+            self.blob_store = BlobStore(os.path.expanduser(blob_store))
+        else:
+            self.blob_store = None
+
+        self.layer_cache_size = self._get_size(node, "layer-cache-size")
+
+        metrics_file = node.get_str("metrics-file", None)
+        if metrics_file:
+            self.metrics_file = os.path.expanduser(metrics_file)
+        else:
+            self.metrics_file = None
 
+        self.client = self._create_client(node)
         self.manifest = None
 
+    # Create the client for the registry, and its mirrors if there are any
+    def _create_client(self, node):
+        mirror_selection = node.get_str("mirror-selection", "ordered")
+        if mirror_selection not in ("ordered", "latency"):
+            raise SourceError(
+                "{}: 'mirror-selection' must be 'ordered' or 'latency'".format(
+                    self
+                )
+            )
+
+        connection_pool_size = self._get_int(
+            node, "connection-pool-size", DEFAULT_CONNECTION_POOL_SIZE
+        )
+        max_retries = self._get_int(
+            node, "max-retries", DEFAULT_MAX_RETRIES, minimum=0
+        )
+        timeout = (
+            self._get_int(node, "connect-timeout", DEFAULT_CONNECT_TIMEOUT),
+            self._get_int(node, "read-timeout", DEFAULT_READ_TIMEOUT),
+        )
+
+        segment_threshold = self._get_size(
+            node, "segmented-download-threshold"
+        )
+        segments = self._get_int(
+            node, "segmented-download-parts", DEFAULT_SEGMENTS
+        )
+        clients = [
+            DockerRegistryV2Client(
+                registry_url,
+                timeout,
+                pool_size=connection_pool_size,
+                max_retries=max_retries,
+                segment_threshold=segment_threshold,
+                segments=segments,
+            )
+            for registry_url in self.registry_mirrors + [self.registry_url]
+        ]
+        if len(clients) > 1:
+            return DockerRegistryMirrors(
+                clients, probe_latency=mirror_selection == "latency"
+            )
+        else:
+            return clients[0]
+
+    def _get_int(self, node, key, default, minimum=1):
+        value = node.get_int(key, default)
+        if value < minimum:
+            if minimum == 0:
+                raise SourceError(
+                    "{}: '{}' must not be negative".format(self, key)
+                )
+            raise SourceError(
+                "{}: '{}' must be at least {}".format(self, key, minimum)
+            )
+        return value
+
+    def _get_patterns(self, node, key):
+        patterns = node.get_str_list(key, [])
+        for pattern in patterns:
+            if not pattern.strip("/."):
+                raise SourceError(
+                    "{}: Invalid pattern in '{}': '{}'".format(
+                        self, key, pattern
+                    )
+                )
+        return patterns
+
+    def _get_size(self, node, key):
+        try:
+            return parse_size(node.get_str(key, "0"))
+        except ValueError as e:
+            raise SourceError(
+                "{}: '{}' is not a valid size: {}".format(self, key, e)
+            ) from e
+
     def preflight(self):
         return
 
     def get_unique_key(self):
-        return [self.original_registry_url, self.image, self.digest]
+        key = [self.original_registry_url, self.image, self.digest]
+        # Keep the keys of sources which stage the whole image unchanged
+        if self.path_filter:
+            key.append({"include": self.include, "exclude": self.exclude})
+        return key
 
     def get_ref(self):
         return (
@@ -441,7 +426,13 @@ class DockerSource(Source):
             )
         ):
             try:
-                _, digest = self.client.manifest(self.image, self.tag)
+                digest = self.client.manifest_digest(
+                    self.image,
+                    self.tag,
+                    self.get_mirror_directory(),
+                    architecture=self.architecture,
+                    os_=self.os,
+                )
             except DockerManifestError as e:
                 self.log("Problem downloading manifest", detail=e.manifest)
                 raise
@@ -493,8 +484,27 @@ class DockerSource(Source):
         with save_file_atomic(manifest_file, "wb") as f:
             f.write(text.encode("utf-8"))
 
-    @staticmethod
-    def _verify_blob(path, expected_digest):
+    # _verify_blob():
+    #
+    # Check that the blob at 'path' has the content hash 'expected_digest'.
+    #
+    # Blobs which were verified before are trusted without being hashed
+    # again, as long as their size, mtime, ctime and inode did not change
+    # since, unless 'strict-verification' is enabled.
+    #
+    # Raises:
+    #    FileNotFoundError, if the blob does not exist
+    #    SourceError, if the blob is corrupt
+    #
+    def _verify_blob(self, path, expected_digest):
+        if not self.strict_verification and self._verified_blobs().is_verified(
+            path, expected_digest
+        ):
+            return
+
+        # sha256sum() reports missing files as a UtilError in recent
+        # versions of BuildStream, so look for them first
+        os.stat(path)
         blob_digest = "sha256:" + sha256sum(path)
         if expected_digest != blob_digest:
             raise SourceError(
@@ -503,9 +513,17 @@ class DockerSource(Source):
                 )
             )
 
+        self._verified_blobs().add(path, expected_digest)
+
+    def _verified_blobs(self):
+        return VerifiedBlobs(
+            os.path.join(self.get_mirror_directory(), "verified")
+        )
+
     def fetch(self):
         # pylint: disable=arguments-differ
 
+        start = time.monotonic()
         with self.timed_activity(
             "Fetching image {}:{} with digest {}".format(
                 self.image, self.tag, self.digest
@@ -538,36 +556,28 @@ class DockerSource(Source):
                 except (OSError, requests.RequestException) as e:
                     raise SourceError(e) from e
 
+                # Digests of the layers to fetch, mapped to their size
+                layer_sizes = {}
                 for layer in manifest["layers"]:
-                    if (
-                        layer["mediaType"]
-                        != "application/vnd.docker.image.rootfs.diff.tar.gzip"
-                    ):
+                    if layer["mediaType"] not in LAYER_MEDIA_TYPES:
                         raise SourceError(
                             "Unsupported layer type: {}".format(
                                 layer["mediaType"]
                             )
                         )
+                    # The same blob may appear more than once in an image,
+                    # only download it once.
+                    layer_sizes[layer["digest"]] = layer.get("size")
 
-                    layer_digest = layer["digest"]
-                    blob_path = os.path.join(tmpdir, layer_digest + ".tar.gz")
-
-                    if not os.path.exists(blob_path):
-                        try:
-                            self.client.blob(
-                                self.image, layer_digest, download_to=blob_path
-                            )
-                        except (OSError, requests.RequestException) as e:
-                            if os.path.exists(blob_path):
-                                shutil.rmtree(blob_path)
-                            raise SourceError(e) from e
-
-                    self._verify_blob(blob_path, expected_digest=layer_digest)
-
-                # Only if all sources are successfully fetched, move files to staging directory
+                fetcher = LayerFetcher(
+                    self, self._verify_blob, self._verified_blobs()
+                )
+                layer_metrics = fetcher.fetch_layers(layer_sizes, tmpdir)
 
-                # As both the manifest and blobs are content addressable, we can optimize space by having
-                # a flat mirror directory. We check one-by-one if there is any need to copy a file out of the tmpdir.
+                # Only if all layers are successfully fetched, move the
+                # manifest to the mirror, which marks the image as cached.
+                # Layers are moved to the mirror one by one as soon as they
+                # are verified, so that other sources can use them.
                 for fetched_file in os.listdir(tmpdir):
                     move_atomic(
                         os.path.join(tmpdir, fetched_file),
@@ -576,7 +586,15 @@ class DockerSource(Source):
                         ),
                     )
 
+                if self.blob_store:
+                    fetcher.share_blobs(layer_sizes)
+
+            self._report_metrics(
+                "fetch", layer_metrics, time.monotonic() - start
+            )
+
     def stage(self, directory):
+        stage_start = time.monotonic()
         mirror_dir = self.get_mirror_directory()
 
         try:
@@ -585,75 +603,212 @@ class DockerSource(Source):
             raise SourceError("Unable to load manifest: {}".format(e)) from e
 
         try:
-            for layer in manifest["layers"]:
-                layer_digest = layer["digest"]
-                blob_path = os.path.join(mirror_dir, layer_digest + ".tar.gz")
-
-                self._verify_blob(blob_path, expected_digest=layer_digest)
-                (
-                    extract_fileset,
-                    white_out_fileset,
-                ) = self._get_extract_and_remove_files(blob_path)
-
-                # remove files associated with whiteouts
-                for white_out_file in white_out_fileset:
-                    white_out_file = os.path.join(directory, white_out_file)
-                    os.remove(white_out_file)
-
-                # extract files for the current layer
-                with tarfile.open(blob_path, tarinfo=ReadableTarInfo) as tar:
-                    with self.tempdir() as td:
-                        tar.extractall(path=td, members=extract_fileset)
-                        link_files(td, directory)
+            layer_digests = [layer["digest"] for layer in manifest["layers"]]
+            blob_paths = [
+                os.path.join(mirror_dir, layer_digest + ".tar.gz")
+                for layer_digest in layer_digests
+            ]
+            layer_metrics = self._verify_layers(layer_digests, blob_paths)
+
+            if self.layer_cache_size:
+                stage_metrics = self._stage_from_layer_cache(
+                    layer_digests, blob_paths, directory
+                )
+            else:
+                stage_metrics = self._stage_layers(
+                    layer_digests, blob_paths, directory
+                )
 
-        except (OSError, SourceError, tarfile.TarError) as e:
+        except (
+            OSError,
+            SourceError,
+            UtilError,
+            tarfile.TarError,
+            concurrent.futures.BrokenExecutor,
+        ) as e:
             raise SourceError(
                 "{}: Error staging source: {}".format(self, e)
             ) from e
 
-    @staticmethod
-    def _get_extract_and_remove_files(layer_tar_path):
-        """Return the set of files to remove and extract for a given layer
-
-        :param layer_tar_path: The path where a layer has been extracted
-        :return: Tuple of filesets
-          - extract_fileset: files to extract into staging directory
-          - delete_fileset: files to remove from staging directory as the current layer
-            contains a whiteout corresponding to a staged file in the previous layers
-
-        """
-
-        def strip_wh(white_out_file):
-            """Strip the prefixing .wh. for given file
-
-            :param white_out_file: path of file
-            :return: path without white-out prefix
-            """
-            # whiteout files have the syntax of `*/.wh.*`
-            file_name = os.path.basename(white_out_file)
-            path = os.path.join(
-                os.path.dirname(white_out_file), file_name.split(".wh.")[1]
+        for metrics, stats in zip(layer_metrics, stage_metrics):
+            metrics.update(stats)
+        self._report_metrics(
+            "stage", layer_metrics, time.monotonic() - stage_start
+        )
+
+    # Verify the layer blobs of the image, returning the metrics of each
+    def _verify_layers(self, layer_digests, blob_paths):
+        layer_metrics = []
+        for layer_digest, blob_path in zip(layer_digests, blob_paths):
+            start = time.monotonic()
+            self._verify_blob(blob_path, expected_digest=layer_digest)
+            layer_metrics.append(
+                {
+                    "digest": layer_digest,
+                    "verify_seconds": time.monotonic() - start,
+                }
             )
-            return path
-
-        def is_regular_file(info):
-            """Check if file is a non-device file
-
-            :param info: tar member metadata
-            :return: if the file is a non-device file
-            """
-            return not (info.name.startswith("dev/") or info.isdev())
-
-        with tarfile.open(layer_tar_path) as tar:
-            extract_fileset = []
-            delete_fileset = []
-            for member in tar.getmembers():
-                if os.path.basename(member.name).startswith(".wh."):
-                    delete_fileset.append(strip_wh(member.name))
-                elif is_regular_file(member):
-                    extract_fileset.append(member)
-
-        return extract_fileset, delete_fileset
+        return layer_metrics
+
+    # _stage_layers():
+    #
+    # Stage the merged filesystem of the image by extracting every layer.
+    #
+    # Returns:
+    #    (list): The statistics of each layer
+    #
+    def _stage_layers(self, layer_digests, blob_paths, directory):
+        # Indices are saved next to the blobs, so that layers are only
+        # decompressed twice the first time they are staged
+        index_paths = [
+            os.path.join(
+                self.get_mirror_directory(), "indices", layer_digest + ".json"
+            )
+            for layer_digest in layer_digests
+        ]
+        with self.tempdir() as td:
+            layer_dirs = []
+            for level in range(len(blob_paths)):
+                layer_dirs.append(os.path.join(td, str(level)))
+                os.mkdir(layer_dirs[-1])
+
+            with self._extraction_pool(len(blob_paths)) as executor:
+                layer_stats = extract_layers(
+                    blob_paths,
+                    layer_dirs,
+                    executor,
+                    self.path_filter,
+                    index_paths,
+                )
+
+            for layer_dir, stats in zip(layer_dirs, layer_stats):
+                start = time.monotonic()
+                link_files(layer_dir, directory)
+                stats["link_seconds"] = time.monotonic() - start
+
+        return layer_stats
+
+    # _stage_from_layer_cache():
+    #
+    # Stage the merged filesystem of the image by linking files from the
+    # layer cache, extracting the layers which are not in the cache yet.
+    #
+    # Returns:
+    #    (list): The statistics of each layer
+    #
+    def _stage_from_layer_cache(self, layer_digests, blob_paths, directory):
+        layer_cache = LayerCache(
+            os.path.join(self.get_mirror_directory(), "layers"),
+            self.layer_cache_size,
+        )
+
+        added = self._add_to_layer_cache(
+            layer_cache, layer_digests, blob_paths
+        )
+
+        layer_stats = []
+        with contextlib.ExitStack() as stack:
+            layers = [
+                stack.enter_context(layer_cache.use(layer_digest, blob_path))
+                for layer_digest, blob_path in zip(layer_digests, blob_paths)
+            ]
+            plan = plan_merge(
+                [index for _, index in layers[1:]], self.path_filter
+            )
+            for level, (layer_dir, _) in enumerate(layers):
+                # Layers added concurrently by another process were not
+                # extracted here either
+                stats = dict(added.get(layer_digests[level]) or {})
+                stats["cached"] = not stats
+                start = time.monotonic()
+                link_layer(layer_dir, directory, plan, level)
+                stats["link_seconds"] = time.monotonic() - start
+                layer_stats.append(stats)
+
+        removed = layer_cache.evict()
+        if removed:
+            self.info("Removed {} layers from the layer cache".format(removed))
+
+        return layer_stats
+
+    # Extract the layers which are not in the layer cache yet into it,
+    # returning the statistics of the extraction of each of them by digest
+    def _add_to_layer_cache(self, layer_cache, layer_digests, blob_paths):
+        missing = {
+            layer_digest: blob_path
+            for layer_digest, blob_path in zip(layer_digests, blob_paths)
+            if not layer_cache.has(layer_digest)
+        }
+        if not missing:
+            return {}
+
+        with self._extraction_pool(len(missing)) as executor:
+            run = map if executor is None else executor.map
+            return dict(
+                zip(
+                    missing.keys(),
+                    run(layer_cache.add, missing.keys(), missing.values()),
+                )
+            )
+
+    # _report_metrics():
+    #
+    # Write the metrics of the layers of the image to the log, and to the
+    # metrics file if there is one.
+    #
+    # Args:
+    #    operation (str): Either 'fetch' or 'stage'
+    #    layer_metrics (list): The metrics of each layer
+    #    seconds (float): How long the whole operation took
+    #
+    def _report_metrics(self, operation, layer_metrics, seconds):
+        self.log(
+            "Metrics of {} {} in {:.3f}s".format(
+                operation, self.image, seconds
+            ),
+            detail=format_metrics(layer_metrics),
+        )
+        if not self.metrics_file:
+            return
+
+        try:
+            write_metrics(
+                self.metrics_file,
+                {
+                    "operation": operation,
+                    "source": str(self),
+                    "image": self.image,
+                    "digest": self.digest,
+                    "seconds": seconds,
+                    "layers": layer_metrics,
+                },
+            )
+        except OSError as e:
+            self.warn("Unable to write metrics: {}".format(e))
+
+    # _extraction_pool():
+    #
+    # Create a pool of worker processes to extract layers with, according to
+    # 'max-parallel-extractions'.
+    #
+    # Args:
+    #    jobs (int): The number of layers to extract
+    #
+    # Yields:
+    #    (concurrent.futures.Executor): The pool, or None to extract the
+    #                                   layers serially
+    #
+    @contextlib.contextmanager
+    def _extraction_pool(self, jobs):
+        if self.max_parallel_extractions < 2 or jobs < 2:
+            yield None
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(self.max_parallel_extractions, jobs),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            yield executor
 
 
 # Plugin entry point
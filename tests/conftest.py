@@ -26,22 +26,53 @@ def pytest_addoption(parser):
         default=False,
         help="Run tests that require docker daemon running",
     )
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Run benchmarks",
+    )
 
 
 def pytest_configure(config):
     config.addinivalue_line(
         "markers", "docker: mark test as requiring docker daemon"
     )
+    config.addinivalue_line(
+        "markers", "benchmark: mark test as a benchmark, run with --benchmark"
+    )
 
 
 def pytest_collection_modifyitems(config, items):
-    if config.getoption("--docker"):
-        # do not skip docker tests
+    for option in ("docker", "benchmark"):
+        if config.getoption("--" + option):
+            # do not skip these tests
+            continue
+        skip = pytest.mark.skip(reason="need --{} flag to run".format(option))
+        for item in items:
+            if option in item.keywords:
+                item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not config.getoption("--benchmark"):
+        return
+
+    # Benchmarks record their measurements as user properties
+    reports = [
+        report
+        for report in terminalreporter.getreports("passed")
+        if report.when == "call" and report.user_properties
+    ]
+    if not reports:
         return
-    docker_tests = pytest.mark.skip(reason="need --docker flag to run")
-    for item in items:
-        if "docker" in item.keywords:
-            item.add_marker(docker_tests)
+    terminalreporter.section("benchmarks")
+    for report in reports:
+        terminalreporter.write_line(report.nodeid)
+        for name, value in report.user_properties:
+            if isinstance(value, float):
+                value = "{:.3f}".format(value)
+            terminalreporter.write_line("    {}: {}".format(name, value))
 
 
 #################################################
@@ -55,13 +86,20 @@ def docker_client():
 
 
 @pytest.fixture(autouse=True, scope="session")
-def teardown_generated_test_images(docker_client):
+def teardown_generated_test_images():
     yield
 
     # delete generated images from bst-plugins-container-tests
+    #
+    # The client is only created here, so that tests which don't need Docker
+    # can run on hosts without it.
     try:
+        docker_client = docker.from_env()
         docker_client.info()
-    except requests.exceptions.ConnectionError:
+    except (
+        docker.errors.DockerException,
+        requests.exceptions.ConnectionError,
+    ):
         # Don't bother doing anything if we can't connect to the Docker daemon.
         return
 
@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import time
+
+import pytest
+from ruamel.yaml import YAML
+
+from .fake_registry import FakeRegistry, create_gzip_layer
+from .utils import create_element
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "project")
+
+# These only run with --benchmark, see 'tox -e benchmark'. Measurements are
+# recorded as user properties of each benchmark, which are summarized at the
+# end of the run and included in JUnit XML reports.
+pytestmark = pytest.mark.benchmark
+
+MIB = 1024 * 1024
+
+# Number of layers, and size of each layer, of the benchmarked images
+IMAGES = [(1, 32 * MIB), (8, 4 * MIB), (64, MIB // 2)]
+
+# Settings of the fake registry for each simulated network
+NETWORKS = {
+    "loopback": {},
+    "wan": {"latency": 0.02, "bandwidth": 50 * MIB},
+}
+
+# Values of 'max-parallel-extractions', to compare serial staging with
+# staging on a pool of worker processes
+EXTRACTIONS = [1, 4]
+
+# Size of the files in the layers
+FILE_SIZE = 64 * 1024
+
+IMAGE = "benchmark/image"
+
+
+def _create_layers(count, size):
+    return [
+        create_gzip_layer(
+            {
+                "layer{}/file{}".format(level, i): os.urandom(FILE_SIZE)
+                for i in range(max(1, size // FILE_SIZE))
+            }
+        )
+        for level in range(count)
+    ]
+
+
+def _run(cli, project, *args):
+    start = time.perf_counter()
+    result = cli.run(project=project, args=list(args))
+    seconds = time.perf_counter() - start
+    result.assert_success()
+    return seconds
+
+
+# Time spent by the docker source itself, according to the metrics it
+# wrote since this was last called
+def _source_seconds(metrics_file, operation):
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f]
+    os.unlink(metrics_file)
+    return sum(
+        record["seconds"]
+        for record in records
+        if record["operation"] == operation
+    )
+
+
+# Forget the sources staged into BuildStream's own source cache, so that
+# BuildStream has to ask the docker source whether it is cached, and have it
+# stage the image again
+def _clear_source_cache(cli):
+    for name in ("elementsources", "source_protos"):
+        shutil.rmtree(os.path.join(cli.directory, name), ignore_errors=True)
+
+
+@pytest.mark.datafiles(DATA_DIR)
+@pytest.mark.parametrize("extractions", EXTRACTIONS, ids="{}-jobs".format)
+@pytest.mark.parametrize("network", sorted(NETWORKS))
+@pytest.mark.parametrize(
+    "image",
+    IMAGES,
+    ids=["{}x{}K".format(count, size // 1024) for count, size in IMAGES],
+)
+def test_fetch_and_stage(
+    cli, datafiles, record_property, network, image, extractions
+):
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    project = str(datafiles)
+    metrics_file = os.path.join(cli.directory, "metrics.jsonl")
+
+    with FakeRegistry(**NETWORKS[network]) as registry:
+        digest = registry.add_image(IMAGE, _create_layers(*image))
+        create_element(
+            YAML(),
+            "image.bst",
+            {
+                "kind": "import",
+                "sources": [
+                    {
+                        "kind": "docker",
+                        "registry-url": registry.url,
+                        "image": IMAGE,
+                        "ref": digest[len("sha256:") :],
+                        "metrics-file": metrics_file,
+                        "max-parallel-extractions": extractions,
+                    }
+                ],
+            },
+            project,
+        )
+
+        record_property(
+            "bytes", sum(len(blob) for blob in registry.blobs.values())
+        )
+        # Fetching also stages the image into BuildStream's source cache
+        record_property(
+            "fetch_command_seconds",
+            _run(cli, project, "source", "fetch", "image.bst"),
+        )
+        record_property(
+            "fetch_seconds", _source_seconds(metrics_file, "fetch")
+        )
+
+    # The registry is gone, none of this may need it
+    _clear_source_cache(cli)
+    record_property(
+        "is_cached_command_seconds",
+        _run(
+            cli,
+            project,
+            "show",
+            "--deps",
+            "none",
+            "--format",
+            "%{state}",
+            "image.bst",
+        ),
+    )
+
+    _clear_source_cache(cli)
+    record_property(
+        "stage_command_seconds",
+        _run(
+            cli,
+            project,
+            "source",
+            "checkout",
+            "--directory",
+            os.path.join(cli.directory, "checkout"),
+            "image.bst",
+        ),
+    )
+    record_property("stage_seconds", _source_seconds(metrics_file, "stage"))
@@ -0,0 +1,44 @@
+import hashlib
+import os
+
+from bst_plugins_container.sources._docker_blob_store import BlobStore
+
+
+def _write_blob(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def test_blob_shared_between_mirrors(tmp_path):
+    store = BlobStore(str(tmp_path / "store"))
+    first_mirror = tmp_path / "first"
+    first_mirror.mkdir()
+    second_mirror = tmp_path / "second"
+    second_mirror.mkdir()
+
+    digest = _write_blob(str(first_mirror / "blob"), b"layer")
+    assert not store.link_to(digest, str(second_mirror / "blob"))
+
+    assert store.add(digest, str(first_mirror / "blob"))
+    assert store.link_to(digest, str(second_mirror / "blob"))
+
+    assert os.path.samefile(
+        str(first_mirror / "blob"), str(second_mirror / "blob")
+    )
+    assert os.stat(store.path(digest)).st_nlink == 3
+
+
+def test_prune_removes_unused_blobs(tmp_path):
+    store = BlobStore(str(tmp_path / "store"))
+    used = _write_blob(str(tmp_path / "used"), b"used")
+    unused = _write_blob(str(tmp_path / "unused"), b"unused")
+    store.add(used, str(tmp_path / "used"))
+    store.add(unused, str(tmp_path / "unused"))
+
+    # The mirror which used this blob was removed
+    os.unlink(str(tmp_path / "unused"))
+
+    assert store.prune() == [unused]
+    assert os.path.exists(store.path(used))
+    assert not os.path.exists(store.path(unused))
@@ -1,12 +1,18 @@
 from datetime import datetime
+import gzip
+import hashlib
+import io
+import json
 import os
 import tarfile
 
 import pytest
 from buildstream._exceptions import ErrorDomain
+from ruamel.yaml import YAML
 
 from tests.utils import (
     build_and_checkout,
+    create_element,
     untar,
     load_image,
     get_image_tag,
@@ -268,6 +274,166 @@ def test_invalid_tag(cli, datafiles):
     assert "Invalid image name" in result.stderr
 
 
+@pytest.mark.datafiles(DATA_DIR)
+def test_streamed_assembly(cli, datafiles, tmp_path):
+    project = str(datafiles)
+    checkout_dir = os.path.join(str(tmp_path), "checkout")
+    create_element(
+        YAML(),
+        "multiple-deps-streamed.bst",
+        {
+            "kind": "docker_image",
+            "config": {
+                "image-names": [
+                    "bst-plugins-container-tests/multiple-build-deps-bst:latest"
+                ],
+                "timestamp": "deterministic",
+                "assembly": "streamed",
+            },
+            "build-depends": ["layer1.bst", "layer2.bst", "layer3.bst"],
+        },
+        project,
+    )
+
+    images = []
+    for element in ("multiple-deps.bst", "multiple-deps-streamed.bst"):
+        element_checkout_dir = os.path.join(checkout_dir, element)
+        build_and_checkout(element, element_checkout_dir, cli, project)
+        images.append(
+            _read_image_files(os.path.join(element_checkout_dir, "image.tar"))
+        )
+
+    # Only the order of the files in the image tarballs differs
+    assert images[0] == images[1]
+
+
+@pytest.mark.datafiles(DATA_DIR)
+@pytest.mark.parametrize("assembly", ["staged", "streamed"])
+def test_parallel_layers(cli, datafiles, tmp_path, assembly):
+    project = str(datafiles)
+    checkout_dir = os.path.join(str(tmp_path), "checkout")
+
+    images = []
+    for max_parallel_layers in (1, 3):
+        element = "multiple-deps-{}.bst".format(max_parallel_layers)
+        create_element(
+            YAML(),
+            element,
+            {
+                "kind": "docker_image",
+                "config": {
+                    "timestamp": "deterministic",
+                    "assembly": assembly,
+                    "max-parallel-layers": max_parallel_layers,
+                },
+                "build-depends": ["layer1.bst", "layer2.bst", "layer3.bst"],
+            },
+            project,
+        )
+        element_checkout_dir = os.path.join(checkout_dir, element)
+        build_and_checkout(element, element_checkout_dir, cli, project)
+        with open(os.path.join(element_checkout_dir, "image.tar"), "rb") as f:
+            images.append(f.read())
+
+    assert images[0] == images[1]
+
+
+@pytest.mark.datafiles(DATA_DIR)
+def test_layer_cache(cli, datafiles, tmp_path):
+    project = str(datafiles)
+    checkout_dir = os.path.join(str(tmp_path), "checkout")
+    layer_cache = os.path.join(str(tmp_path), "layer-cache")
+
+    images = []
+    for name in ("first", "second"):
+        element = "{}.bst".format(name)
+        create_element(
+            YAML(),
+            element,
+            {
+                "kind": "docker_image",
+                "config": {
+                    "image-names": ["{}:latest".format(name)],
+                    "timestamp": "deterministic",
+                    "layer-cache": layer_cache,
+                },
+                "build-depends": ["layer1.bst", "layer2.bst", "layer3.bst"],
+            },
+            project,
+        )
+        element_checkout_dir = os.path.join(checkout_dir, element)
+        build_and_checkout(element, element_checkout_dir, cli, project)
+        images.append(
+            _read_image_files(os.path.join(element_checkout_dir, "image.tar"))
+        )
+
+    # The second image reused the layers of the first one
+    assert len(os.listdir(os.path.join(layer_cache, "entries"))) == 3
+    layers = [
+        {name: content for name, content in files.items() if "/" in name}
+        for files in images
+    ]
+    assert layers[0] == layers[1]
+
+
+@pytest.mark.datafiles(DATA_DIR)
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_compressed_layers(cli, datafiles, tmp_path, compression):
+    zstandard = (
+        pytest.importorskip("zstandard") if compression == "zstd" else None
+    )
+    project = str(datafiles)
+    checkout_dir = os.path.join(str(tmp_path), "checkout")
+    create_element(
+        YAML(),
+        "compressed.bst",
+        {
+            "kind": "docker_image",
+            "config": {
+                "timestamp": "deterministic",
+                "compression": compression,
+                "compression-threads": 2,
+            },
+            "build-depends": ["layer1.bst", "layer2.bst", "layer3.bst"],
+        },
+        project,
+    )
+
+    build_and_checkout("compressed.bst", checkout_dir, cli, project)
+    files = _read_image_files(os.path.join(checkout_dir, "image.tar"))
+
+    manifest = json.loads(files["manifest.json"])[0]
+    config = json.loads(files[manifest["Config"]])
+    diff_ids = config["rootfs"]["diff_ids"]
+    assert len(manifest["Layers"]) == len(diff_ids) == 3
+    for layer_path, diff_id in zip(manifest["Layers"], diff_ids):
+        layer = files[layer_path]
+        assert layer_path == "{}/layer.tar.{}".format(
+            hashlib.sha256(layer).hexdigest(),
+            "gz" if compression == "gzip" else "zst",
+        )
+        if compression == "gzip":
+            uncompressed = gzip.decompress(layer)
+        else:
+            uncompressed = (
+                zstandard.ZstdDecompressor()
+                .stream_reader(io.BytesIO(layer), read_across_frames=True)
+                .read()
+            )
+        assert diff_id == "sha256:{}".format(
+            hashlib.sha256(uncompressed).hexdigest()
+        )
+
+
+def _read_image_files(image_path):
+    with tarfile.open(image_path) as tar_handle:
+        return {
+            member.name: tar_handle.extractfile(member).read()
+            for member in tar_handle.getmembers()
+            if member.isfile()
+        }
+
+
 def _get_layer_files(extract_path):
     layer_files = []
     for layer in os.listdir(extract_path):
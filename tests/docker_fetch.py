@@ -0,0 +1,59 @@
+import hashlib
+import os
+import threading
+import types
+
+from buildstream import SourceError
+
+from bst_plugins_container.sources._docker_fetch import LayerFetcher
+
+
+def _verify_blob(path, expected_digest):
+    with open(path, "rb") as f:
+        digest = "sha256:" + hashlib.sha256(f.read()).hexdigest()
+    if digest != expected_digest:
+        raise SourceError("Blob {} is corrupt".format(path))
+
+
+def test_warnings_reported_from_calling_thread(tmp_path):
+    layers = {
+        "sha256:" + hashlib.sha256(content).hexdigest(): content
+        for content in (b"first", b"second")
+    }
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    for digest in layers:
+        (mirror / (digest + ".tar.gz")).write_bytes(b"corrupt")
+
+    def blob(image, digest, download_to, **kwargs):
+        # pylint: disable=unused-argument
+        with open(download_to, "wb") as f:
+            f.write(layers[digest])
+        return True
+
+    warnings = []
+    source = types.SimpleNamespace(
+        get_mirror_directory=lambda: str(mirror),
+        max_parallel_downloads=2,
+        blob_store=None,
+        client=types.SimpleNamespace(blob=blob),
+        image="image",
+        warn=lambda message: warnings.append(
+            (message, threading.current_thread())
+        ),
+    )
+    fetcher = LayerFetcher(
+        source, _verify_blob, types.SimpleNamespace(add=lambda *args: None)
+    )
+    os.mkdir(str(tmp_path / "tmp"))
+
+    metrics = fetcher.fetch_layers(
+        {digest: len(content) for digest, content in layers.items()},
+        str(tmp_path / "tmp"),
+    )
+
+    assert [layer["source"] for layer in metrics] == ["registry"] * 2
+    assert len(warnings) == 2
+    for message, thread in warnings:
+        assert message.startswith("Fetching layer again")
+        assert thread is threading.current_thread()
@@ -0,0 +1,149 @@
+import contextlib
+import hashlib
+import os
+import time
+
+from bst_plugins_container._utils import parse_size
+from bst_plugins_container.sources._docker_layer_cache import LayerCache
+from bst_plugins_container.sources._docker_layers import (
+    PathFilter,
+    link_layer,
+    plan_merge,
+)
+
+from .docker_layers import create_layer, list_files, stage_layers
+
+
+def _digest(path):
+    with open(path, "rb") as f:
+        return "sha256:" + hashlib.sha256(f.read()).hexdigest()
+
+
+def _stage_from_cache(cache, layer_paths, directory, path_filter=None):
+    with contextlib.ExitStack() as stack:
+        layers = [
+            stack.enter_context(cache.use(_digest(path), path))
+            for path in layer_paths
+        ]
+        plan = plan_merge([index for _, index in layers[1:]], path_filter)
+        for level, (layer_dir, _) in enumerate(layers):
+            link_layer(layer_dir, directory, plan, level)
+
+
+def test_staging_from_cache_matches_extraction(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [
+                ("bin", None),
+                ("bin/tool", b"tool"),
+                ("bin/alias", ("link", "bin/tool")),
+                ("lib", None),
+                ("lib/libc.so", b"libc"),
+                ("var", None),
+                ("var/cache", None),
+                ("var/cache/old", b"old"),
+            ],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [
+                ("bin", None),
+                ("bin/tool", b"new tool"),
+                ("lib", b"file"),
+                ("var", None),
+                ("var/cache", None),
+                ("var/cache/.wh..wh..opq", b""),
+                ("var/cache/new", b"new"),
+            ],
+        ),
+    ]
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    stage_layers(layers, str(extracted))
+
+    cache = LayerCache(str(tmp_path / "cache"), parse_size("1G"))
+    for attempt in range(2):
+        staged = tmp_path / "staged"
+        staged.mkdir()
+        _stage_from_cache(cache, layers, str(staged))
+        assert list_files(str(staged)) == list_files(str(extracted))
+        os.rename(str(staged), str(tmp_path / "staged-{}".format(attempt)))
+
+    # The second time, files are linked from the same cache entries
+    assert os.path.samefile(
+        str(tmp_path / "staged-0" / "bin" / "tool"),
+        str(tmp_path / "staged-1" / "bin" / "tool"),
+    )
+
+
+def test_staging_from_cache_filtered(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "layer.tar.gz"),
+            [
+                ("etc", None),
+                ("etc/hostname", b"host"),
+                ("usr", None),
+                ("usr/bin", None),
+                ("usr/bin/tool", b"tool"),
+            ],
+        )
+    ]
+    path_filter = PathFilter(include=["usr"], exclude=["usr/bin/tool"])
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    stage_layers(layers, str(extracted), path_filter=path_filter)
+
+    staged = tmp_path / "staged"
+    staged.mkdir()
+    cache = LayerCache(str(tmp_path / "cache"), parse_size("1G"))
+    _stage_from_cache(cache, layers, str(staged), path_filter)
+
+    assert list_files(str(staged)) == list_files(str(extracted))
+    assert list_files(str(staged)) == {"usr": None, "usr/bin": None}
+
+
+def test_least_recently_used_layers_evicted(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "layer{}.tar.gz".format(i)),
+            [("file{}".format(i), os.urandom(1024))],
+        )
+        for i in range(3)
+    ]
+    cache = LayerCache(str(tmp_path / "cache"), 2048)
+    for path in layers:
+        cache.add(_digest(path), path)
+        # Make sure that modification times differ
+        time.sleep(0.01)
+
+    # Use the oldest layer again
+    with cache.use(_digest(layers[0]), layers[0]):
+        pass
+
+    assert cache.evict() == 1
+    assert cache.has(_digest(layers[0]))
+    assert not cache.has(_digest(layers[1]))
+    assert cache.has(_digest(layers[2]))
+
+
+def test_layers_in_use_not_evicted(tmp_path):
+    layer = create_layer(str(tmp_path / "layer.tar.gz"), [("file", b"data")])
+    cache = LayerCache(str(tmp_path / "cache"), 0)
+
+    with cache.use(_digest(layer), layer):
+        assert cache.evict() == 0
+    assert cache.evict() == 1
+    assert not cache.has(_digest(layer))
+
+
+def test_unknown_temp_dirs_kept(tmp_path):
+    layer = create_layer(str(tmp_path / "layer.tar.gz"), [("file", b"data")])
+    cache = LayerCache(str(tmp_path / "cache"), 0)
+    unknown = tmp_path / "cache" / "tmp" / "not-a-pid"
+    unknown.mkdir(parents=True)
+
+    cache.add(_digest(layer), layer)
+    assert cache.evict() == 1
+    assert unknown.exists()
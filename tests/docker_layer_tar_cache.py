@@ -0,0 +1,51 @@
+import os
+import time
+
+from bst_plugins_container.elements._docker_layer_cache import LayerTarCache
+
+
+def _add(cache, key, content):
+    with cache.tempdir() as tmpdir:
+        tar_name = os.path.join(tmpdir, "layer.tar")
+        with open(tar_name, "wb") as f:
+            f.write(content)
+        cache.add(key, tar_name, ("digest-" + key, "diff-id-" + key))
+
+
+def test_add_and_use(tmp_path):
+    cache = LayerTarCache(str(tmp_path), 1024)
+    with cache.use("key") as layer_file:
+        assert layer_file is None
+
+    _add(cache, "key", b"layer")
+    with cache.use("key") as layer_file:
+        layer, tar_name = layer_file
+        assert layer == ("digest-key", "diff-id-key")
+        with open(tar_name, "rb") as f:
+            assert f.read() == b"layer"
+
+    # The first layer added for a key is kept
+    _add(cache, "key", b"other layer")
+    with cache.use("key") as (_, tar_name):
+        with open(tar_name, "rb") as f:
+            assert f.read() == b"layer"
+
+    # Temporary directories are removed
+    assert not os.listdir(str(tmp_path / "tmp"))
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = LayerTarCache(str(tmp_path), 250)
+    for key in ("in-use", "unused", "new"):
+        _add(cache, key, b"x" * 100)
+        # Make sure modification times differ
+        time.sleep(0.01)
+
+    with cache.use("in-use"):
+        assert cache.evict() == 1
+
+    with cache.use("unused") as layer_file:
+        assert layer_file is None
+    for key in ("in-use", "new"):
+        with cache.use(key) as layer_file:
+            assert layer_file is not None
@@ -0,0 +1,387 @@
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import tarfile
+
+from buildstream.utils import link_files
+import pytest
+
+from bst_plugins_container.sources import _docker_layers
+from bst_plugins_container.sources._docker_layers import (
+    MergePlan,
+    PathFilter,
+    extract_layer,
+    extract_layers,
+    index_layer,
+)
+
+
+def create_layer(path, members, compression="gz"):
+    """Create a layer tarball
+
+    :param path: path of the tarball to create
+    :param members: list of (name, content) tuples. content is bytes for
+      regular files, None for directories, or a ("link", target) tuple for
+      hard links
+    :param compression: "gz", "zstd" or "" for an uncompressed tarball
+    :return: path of the tarball
+    """
+    if compression == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        create_layer(path + ".tar", members, compression="")
+        with open(path + ".tar", "rb") as src, open(path, "wb") as dest:
+            zstandard.ZstdCompressor().copy_stream(src, dest)
+        os.unlink(path + ".tar")
+        return path
+
+    with tarfile.open(path, "w:" + compression) as tar:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif isinstance(content, tuple):
+                info.type = tarfile.LNKTYPE
+                info.linkname = content[1]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(content))
+    return path
+
+
+def stage_layers(
+    layer_paths, directory, executor=None, path_filter=None, index_paths=None
+):
+    layer_dirs = []
+    for level in range(len(layer_paths)):
+        layer_dirs.append(os.path.join(directory + "-scratch", str(level)))
+        os.makedirs(layer_dirs[-1])
+
+    extract_layers(layer_paths, layer_dirs, executor, path_filter, index_paths)
+
+    for layer_dir in layer_dirs:
+        link_files(layer_dir, directory)
+
+
+def list_files(directory):
+    files = {}
+    for root, dirs, filenames in os.walk(directory):
+        for dirname in dirs:
+            path = os.path.join(root, dirname)
+            files[os.path.relpath(path, directory)] = None
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, directory)] = f.read()
+    return files
+
+
+def test_overwrite_and_whiteout(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [
+                ("etc", None),
+                ("etc/hostname", b"base"),
+                ("etc/removed", b"removed"),
+                ("var", None),
+                ("var/cache", None),
+                ("var/cache/old", b"old"),
+                ("dev", None),
+                ("dev/console", b"console"),
+            ],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [
+                ("etc", None),
+                ("etc/hostname", b"upper"),
+                ("etc/.wh.removed", b""),
+                ("var", None),
+                ("var/cache", None),
+                ("var/cache/.wh..wh..opq", b""),
+                ("var/cache/new", b"new"),
+            ],
+        ),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(layers, str(staged))
+
+    assert list_files(str(staged)) == {
+        "dev": None,
+        "etc": None,
+        "etc/hostname": b"upper",
+        "var": None,
+        "var/cache": None,
+        "var/cache/new": b"new",
+    }
+
+
+def test_directory_replaced_by_file(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [("lib", None), ("lib/libc.so", b"libc")],
+        ),
+        create_layer(str(tmp_path / "upper.tar.gz"), [("lib", b"file")]),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(layers, str(staged))
+
+    assert list_files(str(staged)) == {"lib": b"file"}
+
+
+def test_directory_replaced_by_file_and_created_again(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"), [("a", None), ("a/c", b"c")]
+        ),
+        create_layer(str(tmp_path / "middle.tar.gz"), [("a", b"file")]),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"), [("a", None), ("a/b", b"b")]
+        ),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(layers, str(staged))
+
+    assert list_files(str(staged)) == {"a": None, "a/b": b"b"}
+
+
+def test_overwritten_files_not_extracted(tmp_path):
+    base = create_layer(
+        str(tmp_path / "base.tar.gz"),
+        [("a", b"base"), ("b", b"base")],
+    )
+    upper = create_layer(str(tmp_path / "upper.tar.gz"), [("a", b"upper")])
+    plan = MergePlan()
+    plan.add_layer(1, index_layer(upper))
+
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    extract_layer(base, str(scratch), plan, 0)
+
+    assert list_files(str(scratch)) == {"b": b"base"}
+
+
+def test_hard_link_to_overwritten_file(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [
+                ("bin", None),
+                ("bin/tool", b"tool"),
+                ("bin/alias1", ("link", "bin/tool")),
+                ("bin/alias2", ("link", "bin/tool")),
+            ],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [("bin", None), ("bin/tool", b"new tool")],
+        ),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(layers, str(staged))
+
+    assert list_files(str(staged)) == {
+        "bin": None,
+        "bin/tool": b"new tool",
+        "bin/alias1": b"tool",
+        "bin/alias2": b"tool",
+    }
+
+
+def test_parallel_extraction_matches_serial(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "layer{}.tar.gz".format(level)),
+            [
+                ("shared", None),
+                ("shared/file", "layer {}".format(level).encode()),
+                ("layer{}".format(level), b"content"),
+                (".wh.layer{}".format(level - 1), b""),
+            ],
+        )
+        for level in range(4)
+    ]
+    serial = tmp_path / "serial"
+    serial.mkdir()
+    parallel = tmp_path / "parallel"
+    parallel.mkdir()
+
+    stage_layers(layers, str(serial))
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        stage_layers(layers, str(parallel), executor)
+
+    assert list_files(str(parallel)) == list_files(str(serial))
+    assert list_files(str(serial)) == {
+        "shared": None,
+        "shared/file": b"layer 3",
+        "layer3": b"content",
+    }
+
+
+def test_saved_layer_indices(tmp_path, monkeypatch):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [("etc", None), ("etc/hostname", b"base"), ("etc/os", b"os")],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [("etc", None), ("etc/hostname", b"upper"), ("etc/.wh.os", b"")],
+        ),
+    ]
+    index_paths = [
+        str(tmp_path / "indices" / "{}.json".format(level))
+        for level in range(len(layers))
+    ]
+    expected = {"etc": None, "etc/hostname": b"upper"}
+
+    staged = tmp_path / "staged"
+    staged.mkdir()
+    stage_layers(layers, str(staged), index_paths=index_paths)
+    assert list_files(str(staged)) == expected
+    # The bottom layer is never indexed
+    assert not os.path.exists(index_paths[0])
+    assert os.path.exists(index_paths[1])
+
+    def fail(layer_tar_path):
+        raise AssertionError("Indexed {} again".format(layer_tar_path))
+
+    monkeypatch.setattr(_docker_layers, "index_layer", fail)
+    staged_again = tmp_path / "staged-again"
+    staged_again.mkdir()
+    stage_layers(layers, str(staged_again), index_paths=index_paths)
+    assert list_files(str(staged_again)) == expected
+
+
+@pytest.mark.parametrize("compression", ["", "gz", "zstd"])
+def test_layer_compression(tmp_path, compression):
+    layers = [
+        create_layer(
+            str(tmp_path / "base"),
+            [("etc", None), ("etc/hostname", b"base"), ("etc/os", b"os")],
+            compression=compression,
+        ),
+        create_layer(
+            str(tmp_path / "upper"),
+            [("etc", None), ("etc/hostname", b"upper")],
+            compression=compression,
+        ),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(layers, str(staged))
+
+    assert list_files(str(staged)) == {
+        "etc": None,
+        "etc/hostname": b"upper",
+        "etc/os": b"os",
+    }
+
+
+def test_extraction_statistics(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [("etc", None), ("etc/hostname", b"base"), ("etc/os", b"os")],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [("etc", None), ("etc/.wh.os", b""), ("etc/hostname", b"upper")],
+        ),
+    ]
+    layer_dirs = []
+    for level in range(len(layers)):
+        layer_dirs.append(str(tmp_path / str(level)))
+        os.mkdir(layer_dirs[-1])
+
+    base, upper = extract_layers(layers, layer_dirs)
+
+    assert (base["members"], base["whiteouts"], base["hidden"]) == (0, 0, 3)
+    assert (upper["members"], upper["whiteouts"], upper["hidden"]) == (
+        2,
+        1,
+        0,
+    )
+    for stats in (base, upper):
+        assert 0 <= stats["decompress_seconds"] <= stats["extract_seconds"]
+
+
+def test_path_filter():
+    path_filter = PathFilter(
+        include=["/usr/lib/python3*"], exclude=["usr/lib/*/test"]
+    )
+
+    assert path_filter.matches("usr/lib/python3.9/os.py", False)
+    assert path_filter.matches("usr/lib/python3.9", True)
+    # Directories which may contain included paths
+    assert path_filter.matches("usr/lib", True)
+    assert not path_filter.matches("usr/lib", False)
+    # '*' does not match across directories
+    assert not path_filter.matches("usr/lib/libc.so", False)
+    assert not path_filter.matches("usr/bin/python3", False)
+    assert not path_filter.matches("usr/lib/python3.9/test", True)
+    assert not path_filter.matches("usr/lib/python3.9/test/a.py", False)
+
+
+def test_filtered_extraction(tmp_path):
+    layers = [
+        create_layer(
+            str(tmp_path / "base.tar.gz"),
+            [
+                ("usr", None),
+                ("usr/bin", None),
+                ("usr/bin/python3", b"python"),
+                ("usr/lib", None),
+                ("usr/lib/libc.so", b"libc"),
+                ("usr/lib/python3.9", None),
+                ("usr/lib/python3.9/os.py", b"os"),
+                ("usr/lib/python3.9/python", ("link", "usr/bin/python3")),
+            ],
+        ),
+        create_layer(
+            str(tmp_path / "upper.tar.gz"),
+            [
+                ("usr", None),
+                ("usr/lib", None),
+                ("usr/lib/python3.9", None),
+                ("usr/lib/python3.9/test", None),
+                ("usr/lib/python3.9/test/test_os.py", b"test"),
+            ],
+        ),
+    ]
+    staged = tmp_path / "staged"
+    staged.mkdir()
+
+    stage_layers(
+        layers,
+        str(staged),
+        path_filter=PathFilter(
+            include=["usr/lib/python3*"], exclude=["usr/lib/*/test"]
+        ),
+    )
+
+    # Hard links to files which are not staged get their content
+    assert list_files(str(staged)) == {
+        "usr": None,
+        "usr/lib": None,
+        "usr/lib/python3.9": None,
+        "usr/lib/python3.9/os.py": b"os",
+        "usr/lib/python3.9/python": b"python",
+    }
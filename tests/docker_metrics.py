@@ -0,0 +1,39 @@
+import json
+
+from bst_plugins_container.sources._docker_metrics import (
+    format_metrics,
+    throughput,
+    write_metrics,
+)
+
+
+def test_format_metrics():
+    detail = format_metrics(
+        [
+            {
+                "digest": "sha256:1234",
+                "bytes_downloaded": 2**20,
+                "download_seconds": 0.5,
+                "throughput": throughput(2**20, 0.5),
+                "verify_seconds": None,
+            }
+        ]
+    )
+
+    assert detail.splitlines() == [
+        "- digest: sha256:1234",
+        "  bytes_downloaded: 1048576",
+        "  download_seconds: 0.500s",
+        "  throughput: 2.0 MiB/s",
+    ]
+
+
+def test_metrics_appended_to_file(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    write_metrics(path, {"operation": "fetch", "layers": []})
+    write_metrics(path, {"operation": "stage", "layers": []})
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record["operation"] for record in records] == ["fetch", "stage"]
+    assert all("time" in record for record in records)
@@ -0,0 +1,99 @@
+import hashlib
+
+from bst_plugins_container.sources import _docker_mirrors
+from bst_plugins_container.sources._docker_mirrors import (
+    DockerRegistryMirrors,
+)
+from bst_plugins_container.sources._docker_registry import (
+    DockerRegistryV2Client,
+)
+
+from .fake_registry import FakeRegistry
+
+
+def _mirrors(*endpoints, probe_latency=False):
+    return DockerRegistryMirrors(
+        [
+            DockerRegistryV2Client(endpoint, max_retries=0)
+            for endpoint in endpoints
+        ],
+        probe_latency=probe_latency,
+    )
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_fail_over_to_next_mirror(tmp_path):
+    with FakeRegistry() as mirror, FakeRegistry() as origin:
+        digest = origin.add_blob(b"layer")
+        client = _mirrors(mirror.url, origin.url)
+        client.blob("library/alpine", digest, str(tmp_path / "blob"))
+
+        assert len(mirror.blob_requests(digest)) == 1
+        assert len(origin.blob_requests(digest)) == 1
+
+    assert _read(str(tmp_path / "blob")) == b"layer"
+
+
+def test_corrupt_blob_from_mirror_not_used(tmp_path):
+    digest = "sha256:" + hashlib.sha256(b"layer").hexdigest()
+    with FakeRegistry() as mirror, FakeRegistry() as origin:
+        mirror.blobs[digest] = b"corrupt"
+        origin.add_blob(b"layer")
+        client = _mirrors(mirror.url, origin.url)
+        client.blob("library/alpine", digest, str(tmp_path / "blob"))
+
+    assert _read(str(tmp_path / "blob")) == b"layer"
+
+
+def test_unreachable_mirror_skipped(tmp_path):
+    with FakeRegistry() as origin:
+        digest = origin.add_blob(b"layer")
+        # Nothing listens on port 1
+        client = _mirrors("http://127.0.0.1:1", origin.url)
+        client.blob("library/alpine", digest, str(tmp_path / "blob"))
+
+    assert _read(str(tmp_path / "blob")) == b"layer"
+
+
+def test_unreachable_mirror_not_tried_again(tmp_path):
+    with FakeRegistry() as dead:
+        dead_url = dead.url
+    calls = []
+    try:
+        with FakeRegistry() as origin:
+            digest = origin.add_blob(b"layer")
+            client = _mirrors(dead_url, origin.url)
+            dead_client = client.clients[0]
+            dead_blob = dead_client.blob
+
+            def blob(*args, **kwargs):
+                calls.append(args)
+                return dead_blob(*args, **kwargs)
+
+            dead_client.blob = blob
+            for name in ("first", "second"):
+                client.blob("library/alpine", digest, str(tmp_path / name))
+
+            assert len(origin.blob_requests(digest)) == 2
+    finally:
+        # pylint: disable=protected-access
+        _docker_mirrors._LATENCIES.pop(dead_url, None)
+
+    assert len(calls) == 1
+    assert _read(str(tmp_path / "second")) == b"layer"
+
+
+def test_fastest_mirror_preferred(tmp_path):
+    with FakeRegistry(latency=0.5) as slow, FakeRegistry() as fast:
+        digest = slow.add_blob(b"layer")
+        fast.add_blob(b"layer")
+        client = _mirrors(slow.url, fast.url, probe_latency=True)
+        for name in ("first", "second"):
+            client.blob("library/alpine", digest, str(tmp_path / name))
+
+        assert not slow.blob_requests(digest)
+        assert len(fast.blob_requests(digest)) == 2
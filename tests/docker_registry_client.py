@@ -0,0 +1,591 @@
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import threading
+from urllib.parse import quote
+
+from buildstream import SourceError
+import pytest
+import requests
+import responses
+
+from bst_plugins_container.sources._docker_registry import (
+    DockerRegistryV2Client,
+)
+
+from .fake_registry import FakeRegistry
+
+# Pylint and responses don't play well together
+# pylint: disable=no-member
+
+REGISTRY_URL = "https://registry.example.com"
+
+
+def test_clients_share_session():
+    client_a = DockerRegistryV2Client(REGISTRY_URL)
+    client_b = DockerRegistryV2Client(REGISTRY_URL)
+    other_registry = DockerRegistryV2Client("https://other.example.com")
+
+    assert client_a.session is client_b.session
+    assert client_a.session is not other_registry.session
+
+
+@responses.activate
+def test_reauthorize_with_shared_session(tmp_path):
+    digest = "sha256:" + hashlib.sha256(b"data").hexdigest()
+    blob_url = REGISTRY_URL + "/v2/library/alpine/blobs/" + quote(digest)
+    responses.add(
+        responses.GET,
+        blob_url,
+        status=401,
+        headers={
+            "Www-Authenticate": 'Bearer realm="https://auth.example.com/token",'
+            'service="registry.example.com",'
+            'scope="repository:library/alpine:pull"'
+        },
+    )
+    responses.add(
+        responses.GET,
+        "https://auth.example.com/token",
+        json={"token": "secret"},
+    )
+    responses.add(responses.GET, blob_url, body=b"data")
+
+    client = DockerRegistryV2Client(REGISTRY_URL)
+    blob_path = str(tmp_path / "blob")
+    client.blob("library/alpine", digest, download_to=blob_path)
+
+    with open(blob_path, "rb") as f:
+        assert f.read() == b"data"
+    assert responses.calls[2].request.headers["Authorization"] == (
+        "Bearer secret"
+    )
+
+
+@responses.activate
+def test_blob_digest_verified_while_downloading(tmp_path):
+    content = b"layer content"
+    digest = "sha256:" + hashlib.sha256(content).hexdigest()
+    responses.add(
+        responses.GET,
+        REGISTRY_URL + "/v2/library/alpine/blobs/" + quote(digest),
+        body=content,
+    )
+
+    client = DockerRegistryV2Client(REGISTRY_URL)
+    blob_path = str(tmp_path / "blob")
+    client.blob("library/alpine", digest, download_to=blob_path)
+
+    with open(blob_path, "rb") as f:
+        assert f.read() == content
+
+
+@responses.activate
+def test_corrupt_blob_not_saved(tmp_path):
+    digest = "sha256:" + hashlib.sha256(b"expected").hexdigest()
+    responses.add(
+        responses.GET,
+        REGISTRY_URL + "/v2/library/alpine/blobs/" + quote(digest),
+        body=b"corrupted",
+    )
+
+    client = DockerRegistryV2Client(REGISTRY_URL)
+    blob_path = str(tmp_path / "blob")
+    with pytest.raises(SourceError):
+        client.blob("library/alpine", digest, download_to=blob_path)
+
+    assert not os.listdir(str(tmp_path))
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_resume_interrupted_blob_download(tmp_path, support_ranges):
+    content = os.urandom(3 * 1024 * 1024)
+    blob_path = str(tmp_path / "blob")
+    partial_path = str(tmp_path / "blob.partial")
+
+    with FakeRegistry(support_ranges=support_ranges) as registry:
+        digest = registry.add_blob(content)
+        registry.drop_after[digest] = 2 * 1024 * 1024
+        client = DockerRegistryV2Client(registry.url, max_retries=0)
+
+        with pytest.raises(requests.RequestException):
+            client.blob(
+                "library/alpine",
+                digest,
+                download_to=blob_path,
+                partial_path=partial_path,
+            )
+        assert not os.path.exists(blob_path)
+        partial_size = os.path.getsize(partial_path)
+        assert partial_size > 0
+
+        client.blob(
+            "library/alpine",
+            digest,
+            download_to=blob_path,
+            partial_path=partial_path,
+        )
+
+        blob_requests = registry.blob_requests(digest)
+
+    with open(blob_path, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(partial_path)
+
+    assert len(blob_requests) == 2
+    assert "Range" not in blob_requests[0]
+    assert blob_requests[1]["Range"] == "bytes={}-".format(partial_size)
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_segmented_blob_download(tmp_path, support_ranges):
+    content = os.urandom(3 * 1024 * 1024 + 1)
+    blob_path = str(tmp_path / "blob")
+
+    with FakeRegistry(support_ranges=support_ranges) as registry:
+        digest = registry.add_blob(content)
+        client = DockerRegistryV2Client(
+            registry.url, segment_threshold=1024 * 1024, segments=3
+        )
+        client.blob(
+            "library/alpine", digest, download_to=blob_path, size=len(content)
+        )
+        blob_requests = registry.blob_requests(digest)
+
+    with open(blob_path, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(blob_path + ".partial")
+
+    if support_ranges:
+        assert sorted(headers["Range"] for headers in blob_requests) == [
+            "bytes=0-1048576",
+            "bytes=1048577-2097153",
+            "bytes=2097154-3145728",
+        ]
+    else:
+        # Once the registry ignored a Range request, the blob is downloaded
+        # at once
+        assert "Range" not in blob_requests[-1]
+
+
+def test_small_blob_not_segmented(tmp_path):
+    content = os.urandom(1024)
+
+    with FakeRegistry() as registry:
+        digest = registry.add_blob(content)
+        client = DockerRegistryV2Client(
+            registry.url, segment_threshold=1024 * 1024, segments=3
+        )
+        client.blob(
+            "library/alpine",
+            digest,
+            download_to=str(tmp_path / "blob"),
+            size=len(content),
+        )
+
+        assert len(registry.blob_requests(digest)) == 1
+
+
+def _fetch_blobs(registry_url, digests, directory):
+    client = DockerRegistryV2Client(registry_url)
+    downloaded = []
+    for digest in digests:
+        downloaded.append(
+            client.blob(
+                "library/alpine",
+                digest,
+                download_to=os.path.join(directory, digest),
+                partial_path=os.path.join(directory, "partial", digest),
+                lock_path=os.path.join(directory, "locks", digest),
+            )
+        )
+    return downloaded
+
+
+def test_concurrent_fetchers_download_blob_once(tmp_path):
+    mirror = str(tmp_path)
+    os.makedirs(os.path.join(mirror, "partial"))
+
+    with FakeRegistry(latency=0.2) as registry:
+        digests = [registry.add_blob(os.urandom(1024)) for _ in range(3)]
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=4, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(
+                executor.map(
+                    _fetch_blobs,
+                    [registry.url] * 4,
+                    [digests] * 4,
+                    [mirror] * 4,
+                )
+            )
+
+        for digest in digests:
+            assert len(registry.blob_requests(digest)) == 1
+            with open(os.path.join(mirror, digest), "rb") as f:
+                assert f.read() == registry.blobs[digest]
+
+    # Each blob was downloaded by exactly one of the fetchers
+    for downloads in zip(*results):
+        assert sorted(downloads) == [False, False, False, True]
+
+
+def test_broken_blob_download_resumed_by_retry(tmp_path):
+    content = os.urandom(3 * 1024 * 1024)
+    blob_path = str(tmp_path / "blob")
+
+    with FakeRegistry() as registry:
+        digest = registry.add_blob(content)
+        registry.drop_after[digest] = 2 * 1024 * 1024
+        client = DockerRegistryV2Client(registry.url, max_retries=1)
+        client.blob("library/alpine", digest, download_to=blob_path)
+        blob_requests = registry.blob_requests(digest)
+
+    with open(blob_path, "rb") as f:
+        assert f.read() == content
+    assert len(blob_requests) == 2
+    assert blob_requests[1]["Range"].startswith("bytes=")
+
+
+@pytest.mark.parametrize(
+    "status,headers",
+    [(429, {"Retry-After": "0"}), (503, {}), (500, {})],
+)
+def test_transient_errors_retried(tmp_path, status, headers):
+    blob_path = str(tmp_path / "blob")
+
+    with FakeRegistry() as registry:
+        digest = registry.add_blob(b"layer")
+        registry.errors[digest] = [(status, headers)]
+        client = DockerRegistryV2Client(registry.url, max_retries=1)
+        client.blob("library/alpine", digest, download_to=blob_path)
+
+        assert len(registry.blob_requests(digest)) == 2
+
+
+def test_retries_exhausted(tmp_path):
+    with FakeRegistry() as registry:
+        digest = registry.add_blob(b"layer")
+        registry.errors[digest] = [(429, {"Retry-After": "0"})] * 2
+        client = DockerRegistryV2Client(registry.url, max_retries=1)
+        with pytest.raises(requests.HTTPError):
+            client.blob(
+                "library/alpine", digest, download_to=str(tmp_path / "blob")
+            )
+
+
+def test_failed_connections_not_retried_twice(tmp_path):
+    # Accept connections and close them before answering
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            connection.close()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        client = DockerRegistryV2Client(
+            "http://127.0.0.1:{}".format(listener.getsockname()[1]),
+            max_retries=2,
+        )
+        with pytest.raises(requests.ConnectionError):
+            client.blob(
+                "library/alpine",
+                "sha256:" + hashlib.sha256(b"layer").hexdigest(),
+                download_to=str(tmp_path / "blob"),
+            )
+    finally:
+        # Closing the socket alone does not interrupt accept()
+        listener.shutdown(socket.SHUT_RDWR)
+        listener.close()
+        thread.join()
+
+    assert len(connections) == 3
+
+
+def _add_token_challenge(registry_url, blob_digest, image="library/alpine"):
+    responses.add(
+        responses.GET,
+        "{}/v2/{}/blobs/{}".format(registry_url, image, quote(blob_digest)),
+        status=401,
+        headers={
+            "Www-Authenticate": 'Bearer realm="{}/token",'
+            'service="registry",'
+            'scope="repository:{}:pull"'.format(registry_url, image)
+        },
+    )
+
+
+def _add_blob(registry_url, content, image="library/alpine"):
+    digest = "sha256:" + hashlib.sha256(content).hexdigest()
+    responses.add(
+        responses.GET,
+        "{}/v2/{}/blobs/{}".format(registry_url, image, quote(digest)),
+        body=content,
+    )
+    return digest
+
+
+@responses.activate
+def test_token_shared_between_clients(tmp_path):
+    registry_url = "https://shared-token.example.com"
+    first_digest = "sha256:" + hashlib.sha256(b"first").hexdigest()
+    _add_token_challenge(registry_url, first_digest)
+    responses.add(
+        responses.GET,
+        registry_url + "/token",
+        json={"token": "shared", "expires_in": 300},
+    )
+    _add_blob(registry_url, b"first")
+    second_digest = _add_blob(registry_url, b"second")
+
+    DockerRegistryV2Client(registry_url).blob(
+        "library/alpine", first_digest, str(tmp_path / "first")
+    )
+    DockerRegistryV2Client(registry_url).blob(
+        "library/alpine", second_digest, str(tmp_path / "second")
+    )
+
+    # The second client neither gets challenged nor requests a token
+    assert len(responses.calls) == 4
+    assert responses.calls[3].request.headers["Authorization"] == (
+        "Bearer shared"
+    )
+
+
+@responses.activate
+def test_token_requested_up_front_for_other_images(tmp_path):
+    registry_url = "https://up-front-token.example.com"
+    first_digest = "sha256:" + hashlib.sha256(b"first").hexdigest()
+    _add_token_challenge(registry_url, first_digest)
+    responses.add(
+        responses.GET, registry_url + "/token", json={"token": "alpine"}
+    )
+    _add_blob(registry_url, b"first")
+    responses.add(
+        responses.GET, registry_url + "/token", json={"token": "debian"}
+    )
+    second_digest = _add_blob(registry_url, b"second", image="library/debian")
+
+    client = DockerRegistryV2Client(registry_url)
+    client.blob("library/alpine", first_digest, str(tmp_path / "first"))
+    client.blob("library/debian", second_digest, str(tmp_path / "second"))
+
+    assert len(responses.calls) == 5
+    assert "scope=repository:library/debian:pull" in (
+        responses.calls[3].request.url
+    )
+    assert responses.calls[4].request.headers["Authorization"] == (
+        "Bearer debian"
+    )
+
+
+@responses.activate
+def test_expired_token_renewed(tmp_path):
+    registry_url = "https://expired-token.example.com"
+    first_digest = "sha256:" + hashlib.sha256(b"first").hexdigest()
+    _add_token_challenge(registry_url, first_digest)
+    responses.add(
+        responses.GET,
+        registry_url + "/token",
+        json={"token": "old", "expires_in": 1},
+    )
+    _add_blob(registry_url, b"first")
+    responses.add(
+        responses.GET, registry_url + "/token", json={"token": "new"}
+    )
+    second_digest = _add_blob(registry_url, b"second")
+
+    client = DockerRegistryV2Client(registry_url)
+    client.blob("library/alpine", first_digest, str(tmp_path / "first"))
+    client.blob("library/alpine", second_digest, str(tmp_path / "second"))
+
+    assert responses.calls[3].request.url.startswith(registry_url + "/token")
+    assert responses.calls[4].request.headers["Authorization"] == (
+        "Bearer new"
+    )
+
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MANIFEST_LIST_V2 = "application/vnd.docker.distribution.manifest.list.v2+json"
+
+
+def _manifest_list(image_digest):
+    text = json.dumps(
+        {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_LIST_V2,
+            "manifests": [
+                {
+                    "digest": "sha256:" + "0" * 64,
+                    "platform": {"architecture": "arm64", "os": "linux"},
+                },
+                {
+                    "digest": image_digest,
+                    "platform": {"architecture": "amd64", "os": "linux"},
+                },
+            ],
+        }
+    )
+    return text, "sha256:" + hashlib.sha256(text.encode()).hexdigest()
+
+
+@responses.activate
+def test_track_image_manifest_with_head_request(tmp_path):
+    registry_url = "https://track-image.example.com"
+    image_digest = "sha256:" + "1" * 64
+    responses.add(
+        responses.HEAD,
+        registry_url + "/v2/library/alpine/manifests/latest",
+        headers={
+            "Docker-Content-Digest": image_digest,
+            "Content-Type": MANIFEST_V2,
+        },
+    )
+
+    client = DockerRegistryV2Client(registry_url)
+    digest = client.manifest_digest(
+        "library/alpine", "latest", str(tmp_path), architecture="amd64"
+    )
+
+    assert digest == image_digest
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_track_cached_manifest_list(tmp_path):
+    registry_url = "https://track-list.example.com"
+    image_digest = "sha256:" + "1" * 64
+    list_text, list_digest = _manifest_list(image_digest)
+    manifest_url = registry_url + "/v2/library/alpine/manifests/latest"
+    responses.add(
+        responses.HEAD,
+        manifest_url,
+        headers={
+            "Docker-Content-Digest": list_digest,
+            "Content-Type": MANIFEST_LIST_V2,
+        },
+    )
+    responses.add(
+        responses.GET,
+        manifest_url,
+        body=list_text,
+        headers={"Docker-Content-Digest": list_digest},
+    )
+
+    client = DockerRegistryV2Client(registry_url)
+    for _ in range(2):
+        digest = client.manifest_digest(
+            "library/alpine", "latest", str(tmp_path), architecture="amd64"
+        )
+        assert digest == image_digest
+
+    # The manifest list is only downloaded once
+    assert [call.request.method for call in responses.calls] == [
+        "HEAD",
+        "GET",
+        "HEAD",
+    ]
+
+
+@responses.activate
+def test_track_with_conditional_get(tmp_path):
+    registry_url = "https://track-etag.example.com"
+    image_digest = "sha256:" + "1" * 64
+    list_text, list_digest = _manifest_list(image_digest)
+    manifest_url = registry_url + "/v2/library/alpine/manifests/latest"
+    # This registry does not tell us digests in response to HEAD requests
+    responses.add(responses.HEAD, manifest_url)
+    responses.add(
+        responses.GET,
+        manifest_url,
+        body=list_text,
+        headers={
+            "Docker-Content-Digest": list_digest,
+            "ETag": '"{}"'.format(list_digest),
+        },
+    )
+    responses.add(responses.GET, manifest_url, status=304)
+
+    client = DockerRegistryV2Client(registry_url)
+    for _ in range(2):
+        digest = client.manifest_digest(
+            "library/alpine", "latest", str(tmp_path), architecture="amd64"
+        )
+        assert digest == image_digest
+
+    assert "If-None-Match" not in responses.calls[1].request.headers
+    assert responses.calls[3].request.headers["If-None-Match"] == (
+        '"{}"'.format(list_digest)
+    )
+
+
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+
+
+@responses.activate
+def test_oci_index_without_media_type():
+    registry_url = "https://oci-index.example.com"
+    manifest_text = json.dumps(
+        {
+            "schemaVersion": 2,
+            "config": {"digest": "sha256:" + "2" * 64},
+            "layers": [
+                {
+                    "mediaType": "application/vnd.oci.image.layer.v1.tar+zstd",
+                    "digest": "sha256:" + "3" * 64,
+                }
+            ],
+        }
+    )
+    manifest_digest = (
+        "sha256:" + hashlib.sha256(manifest_text.encode()).hexdigest()
+    )
+    index_text = json.dumps(
+        {
+            "schemaVersion": 2,
+            "manifests": [
+                {
+                    "mediaType": OCI_MANIFEST,
+                    "digest": manifest_digest,
+                    "platform": {"architecture": "amd64", "os": "linux"},
+                }
+            ],
+        }
+    )
+    index_digest = "sha256:" + hashlib.sha256(index_text.encode()).hexdigest()
+    responses.add(
+        responses.GET,
+        registry_url + "/v2/library/alpine/manifests/latest",
+        body=index_text,
+        headers={"Docker-Content-Digest": index_digest},
+    )
+    responses.add(
+        responses.GET,
+        registry_url
+        + "/v2/library/alpine/manifests/"
+        + quote(manifest_digest),
+        body=manifest_text,
+        headers={"Docker-Content-Digest": manifest_digest},
+    )
+
+    client = DockerRegistryV2Client(registry_url)
+    text, digest = client.manifest(
+        "library/alpine", "latest", architecture="amd64", os_="linux"
+    )
+
+    assert text == manifest_text
+    assert digest == manifest_digest
+    assert OCI_MANIFEST in responses.calls[0].request.headers["Accept"]
@@ -5,6 +5,7 @@ import pytest
 import responses
 from ruamel.yaml import YAML
 
+from .fake_registry import FakeRegistry, create_gzip_layer
 from .utils import create_element
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "project")
@@ -44,6 +45,51 @@ def test_docker_source_checkout(cli, datafiles):
     )
 
 
+@pytest.mark.datafiles(DATA_DIR)
+def test_checkout_from_fake_registry(cli, datafiles):
+    project = str(datafiles)
+    checkout = os.path.join(cli.directory, "checkout")
+
+    with FakeRegistry(auth=True) as registry:
+        digest = registry.add_image(
+            "library/hello",
+            [
+                create_gzip_layer({"etc/hello": b"hello", "etc/os": b"os"}),
+                create_gzip_layer({"etc/hello": b"hello world"}),
+            ],
+        )
+        create_element(
+            YAML(),
+            "hello.bst",
+            {
+                "kind": "import",
+                "sources": [
+                    {
+                        "kind": "docker",
+                        "registry-url": registry.url,
+                        "image": "library/hello",
+                        "ref": digest[len("sha256:") :],
+                    }
+                ],
+            },
+            project,
+        )
+        result = cli.run(
+            project=project, args=["source", "fetch", "hello.bst"]
+        )
+        result.assert_success()
+
+    # Everything must come from the source mirror now
+    result = cli.run(
+        project=project,
+        args=["source", "checkout", "--directory", checkout, "hello.bst"],
+    )
+    result.assert_success()
+    with open(os.path.join(checkout, "hello", "etc", "hello")) as f:
+        assert f.read() == "hello world"
+    assert os.path.isfile(os.path.join(checkout, "hello", "etc", "os"))
+
+
 @pytest.mark.datafiles(DATA_DIR)
 @responses.activate
 def test_handle_network_error(cli, datafiles):
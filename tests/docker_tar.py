@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from bst_plugins_container.elements._docker_tar import (
+    CompressingWriter,
+    HashingWriter,
+    LayerCompression,
+    TarStreamWriter,
+    zstandard,
+)
+
+
+def _create_tar(fileobj, files):
+    with tarfile.open(fileobj=fileobj, mode="w") as tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def test_hashing_writer():
+    files = {"hello": b"Hello, world!\n", "empty": b""}
+    expected = io.BytesIO()
+    _create_tar(expected, files)
+
+    output = io.BytesIO()
+    writer = HashingWriter(output)
+    _create_tar(writer, files)
+
+    assert output.getvalue() == expected.getvalue()
+    assert writer.size == len(expected.getvalue())
+    assert (
+        writer.hexdigest() == hashlib.sha256(expected.getvalue()).hexdigest()
+    )
+
+
+def test_tar_stream_writer(tmp_path):
+    path = str(tmp_path / "image.tar")
+    path_to_copy = str(tmp_path / "copy.tar")
+    with open(path_to_copy, "wb") as f:
+        _create_tar(f, {"copy": b"copy"})
+    with open(path, "wb") as f:
+        image_tar = TarStreamWriter(f)
+        with image_tar.add_stream() as member:
+            _create_tar(member, {"hello": b"Hello, world!\n"})
+            digest = member.hexdigest()
+            member.name = "{}/layer.tar".format(digest)
+        image_tar.add_file("{}/VERSION".format(digest), b"1.0")
+        image_tar.add_directory(digest)
+        image_tar.add_file("manifest.json", b"[]")
+        image_tar.add_path("copy.tar", path_to_copy)
+        image_tar.close()
+
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == [
+            "{}/layer.tar".format(digest),
+            "{}/VERSION".format(digest),
+            digest,
+            "manifest.json",
+            "copy.tar",
+        ]
+        assert tar.getmember(digest).isdir()
+        layer = tar.extractfile("{}/layer.tar".format(digest)).read()
+        assert hashlib.sha256(layer).hexdigest() == digest
+        assert tar.extractfile("{}/VERSION".format(digest)).read() == b"1.0"
+        assert tar.extractfile("manifest.json").read() == b"[]"
+        with open(path_to_copy, "rb") as f:
+            assert tar.extractfile("copy.tar").read() == f.read()
+
+    assert os.path.getsize(path) % tarfile.RECORDSIZE == 0
+
+
+def _decompress(algorithm, data):
+    if algorithm == "gzip":
+        return gzip.decompress(data)
+    return (
+        zstandard.ZstdDecompressor()
+        .stream_reader(io.BytesIO(data), read_across_frames=True)
+        .read()
+    )
+
+
+@pytest.mark.parametrize("algorithm", ["gzip", "zstd"])
+def test_compressing_writer(monkeypatch, algorithm):
+    if algorithm == "zstd":
+        pytest.importorskip("zstandard")
+    # Compress the data in several blocks
+    monkeypatch.setattr(CompressingWriter, "BLOCK_SIZE", 1024)
+    data = os.urandom(4096) + b"\0" * 4096 + b"end"
+
+    outputs = []
+    for threads in (1, 4):
+        output = io.BytesIO()
+        compression = LayerCompression(algorithm, threads=threads)
+        with CompressingWriter(output, compression) as writer:
+            writer.write(data[:1000])
+            writer.write(data[1000:])
+        assert writer.hexdigest() == hashlib.sha256(data).hexdigest()
+        outputs.append(output.getvalue())
+
+    # The output does not depend on the number of threads
+    assert outputs[0] == outputs[1]
+    assert _decompress(algorithm, outputs[0]) == data
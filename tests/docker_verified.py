@@ -0,0 +1,25 @@
+import os
+import time
+
+from bst_plugins_container.sources._docker_verified import VerifiedBlobs
+
+
+def test_blob_rewritten_in_place(tmp_path):
+    verified = VerifiedBlobs(str(tmp_path / "verified"))
+    path = str(tmp_path / "blob")
+    with open(path, "wb") as f:
+        f.write(b"layer")
+    verified.add(path, "sha256:digest")
+    assert verified.is_verified(path, "sha256:digest")
+
+    # Make sure the ctime differs
+    time.sleep(0.05)
+
+    # Rewrite the blob with the same size and mtime
+    blob_stat = os.stat(path)
+    with open(path, "r+b") as f:
+        f.write(b"LAYER")
+    os.utime(path, ns=(blob_stat.st_atime_ns, blob_stat.st_mtime_ns))
+    assert os.stat(path).st_mtime_ns == blob_stat.st_mtime_ns
+
+    assert not verified.is_verified(path, "sha256:digest")
@@ -0,0 +1,347 @@
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+from socketserver import ThreadingMixIn
+import tarfile
+import threading
+import time
+import urllib.parse
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+LAYER_V2 = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+CONFIG_V2 = "application/vnd.docker.container.image.v1+json"
+
+# Size of the chunks blobs are sent in when the bandwidth is capped
+_CHUNK_SIZE = 64 * 1024
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeRegistry:
+    """A minimal in-process stand-in for a Docker registry
+
+    Serves manifests and blobs over the registry v2 API, optionally behind
+    token authentication, and allows injecting faults and slowing it down to
+    exercise the client's error handling and measure its performance.
+
+    :param support_ranges: whether to honour Range requests for blobs
+    :param latency: seconds to wait before answering each request
+    :param bandwidth: maximum number of bytes per second to send, shared by
+      all connections, or None for no limit
+    :param auth: whether to require a bearer token from the registry's
+      token endpoint
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self, support_ranges=True, latency=0, bandwidth=None, auth=False
+    ):
+        self.support_ranges = support_ranges
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.auth = auth
+        self.token = "fake-token"
+        self.blobs = {}
+        # digest -> (media type, manifest text)
+        self.manifests = {}
+        # (image, tag) -> digest of the manifest
+        self.tags = {}
+        # (method, path, headers) for every request received
+        self.requests = []
+        # digest -> number of bytes to send before dropping the connection,
+        # consumed by the next request for that blob
+        self.drop_after = {}
+        # digest or tag -> list of (status, headers) to respond with instead
+        # of the blob or manifest, one per request
+        self.errors = {}
+
+        self._lock = threading.Lock()
+        # When the shared link is free to send more data
+        self._link_free_at = 0
+        self._server = _ThreadingHTTPServer(
+            ("127.0.0.1", 0), _make_handler(self)
+        )
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add_blob(self, content):
+        """Add a blob to the registry
+
+        :param content: bytes of the blob
+        :return: digest of the blob
+        """
+        digest = "sha256:" + hashlib.sha256(content).hexdigest()
+        self.blobs[digest] = content
+        return digest
+
+    def add_manifest(self, image, manifest, media_type=MANIFEST_V2, tag=None):
+        """Add a manifest to the registry
+
+        :param image: path of the image, e.g. library/alpine
+        :param manifest: the manifest, as a dict
+        :param media_type: the media type to serve the manifest as
+        :param tag: tag to point at the manifest, if any
+        :return: digest of the manifest
+        """
+        text = json.dumps(manifest, indent=3)
+        digest = "sha256:" + hashlib.sha256(text.encode()).hexdigest()
+        self.manifests[digest] = (media_type, text)
+        if tag:
+            self.tags[(image, tag)] = digest
+        return digest
+
+    def add_image(self, image, layers, tag=None):
+        """Add an image made of the given layers to the registry
+
+        :param image: path of the image, e.g. library/alpine
+        :param layers: list of layer blobs, as bytes
+        :param tag: tag to point at the image, if any
+        :return: digest of the image's manifest
+        """
+        config = json.dumps(
+            {"architecture": "amd64", "os": "linux", "rootfs": {}}
+        ).encode()
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_V2,
+            "config": {
+                "mediaType": CONFIG_V2,
+                "size": len(config),
+                "digest": self.add_blob(config),
+            },
+            "layers": [
+                {
+                    "mediaType": LAYER_V2,
+                    "size": len(layer),
+                    "digest": self.add_blob(layer),
+                }
+                for layer in layers
+            ],
+        }
+        return self.add_manifest(image, manifest, tag=tag)
+
+    def blob_requests(self, digest):
+        """Return the headers of every GET request made for a blob"""
+        path_suffix = "/blobs/" + urllib.parse.quote(digest)
+        return [
+            headers
+            for method, path, headers in self.requests
+            if method == "GET" and path.endswith(path_suffix)
+        ]
+
+    def record_request(self, method, path, headers):
+        with self._lock:
+            self.requests.append((method, path, dict(headers)))
+
+    def pop_drop_after(self, digest):
+        with self._lock:
+            return self.drop_after.pop(digest, None)
+
+    def pop_error(self, reference):
+        with self._lock:
+            errors = self.errors.get(reference)
+            return errors.pop(0) if errors else None
+
+    def throttle(self, size):
+        """Wait until 'size' bytes may be sent within the bandwidth cap"""
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._link_free_at = (
+                max(now, self._link_free_at) + size / self.bandwidth
+            )
+            delay = self._link_free_at - now
+        time.sleep(delay)
+
+
+def create_gzip_layer(files):
+    """Create a gzip compressed layer tarball
+
+    :param files: dict of file names to their content, as bytes
+    :return: the layer, as bytes
+    """
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w") as tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(content))
+    # Random content does not compress anyway, so spend as little time as
+    # possible trying.
+    return gzip.compress(tar_buffer.getvalue(), compresslevel=1, mtime=0)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The FakeRegistry to serve, set by _make_handler()
+    registry = None
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def _handle(self, method):
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        self.registry.record_request(method, path, self.headers)
+        time.sleep(self.registry.latency)
+
+        if path == "/token":
+            self._send_token(parsed.query)
+            return
+
+        image = kind = reference = None
+        parts = path[len("/v2/") :].rsplit("/", 2)
+        if path.startswith("/v2/") and len(parts) == 3:
+            image, kind, reference = parts
+            reference = urllib.parse.unquote(reference)
+        if self.registry.auth and not self._authorized(image):
+            return
+
+        if image is None:
+            # The API version check, and anything unknown
+            self._send_empty(200 if path in ("/v2", "/v2/") else 404)
+            return
+
+        error = self.registry.pop_error(reference)
+        if error is not None:
+            self._send_empty(*error)
+        elif kind == "blobs" and reference in self.registry.blobs:
+            self._send_blob(method, reference, self.registry.blobs[reference])
+        elif kind == "manifests":
+            self._send_manifest(method, image, reference)
+        else:
+            self._send_empty(404)
+
+    def _authorized(self, image):
+        if self.headers.get("Authorization") == "Bearer {}".format(
+            self.registry.token
+        ):
+            return True
+        challenge = 'Bearer realm="{}/token",service="fake-registry"'
+        if image:
+            challenge += ',scope="repository:{}:pull"'.format(image)
+        self._send_empty(
+            401, {"Www-Authenticate": challenge.format(self.registry.url)}
+        )
+        return False
+
+    def _send_token(self, query):
+        if "service=fake-registry" not in query:
+            self._send_empty(400)
+            return
+        body = json.dumps(
+            {"token": self.registry.token, "expires_in": 300}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_manifest(self, method, image, reference):
+        digest = self.registry.tags.get((image, reference), reference)
+        if digest not in self.registry.manifests:
+            self._send_empty(404)
+            return
+
+        media_type, text = self.registry.manifests[digest]
+        body = text.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", media_type)
+        self.send_header("Docker-Content-Digest", digest)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if method == "GET":
+            self.wfile.write(body)
+
+    def _send_blob(self, method, digest, content):
+        start = 0
+        end = len(content) - 1
+        range_header = self.headers.get("Range")
+        if range_header and self.registry.support_ranges:
+            first, last = range_header[len("bytes=") :].split("-")
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            if start >= len(content):
+                self._send_empty(416)
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range",
+                "bytes {}-{}/{}".format(start, end, len(content)),
+            )
+        else:
+            self.send_response(200)
+
+        body = content[start : end + 1]
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if method == "HEAD":
+            return
+
+        drop_after = self.registry.pop_drop_after(digest)
+        if drop_after is not None:
+            # Simulate the connection dying in the middle of the body
+            self._write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self._write(body)
+
+    def _write(self, body):
+        if not self.registry.bandwidth:
+            self.wfile.write(body)
+            return
+        for offset in range(0, len(body), _CHUNK_SIZE):
+            chunk = body[offset : offset + _CHUNK_SIZE]
+            self.registry.throttle(len(chunk))
+            self.wfile.write(chunk)
+
+
+def _make_handler(registry):
+    return type("Handler", (_Handler,), {"registry": registry})
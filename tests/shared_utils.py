@@ -0,0 +1,14 @@
+import pytest
+
+from bst_plugins_container._utils import parse_size
+
+
+def test_parse_size():
+    assert parse_size("1024") == 1024
+    assert parse_size("20G") == 20 * 1024**3
+    assert parse_size("512 MB") == 512 * 1024**2
+
+
+def test_parse_invalid_size():
+    with pytest.raises(ValueError):
+        parse_size("20 GiB")